@@ -18,7 +18,8 @@ from queue import Queue, Empty
 from flask import Flask, render_template, jsonify, request
 from flask_socketio import SocketIO
 from dotenv import load_dotenv
-from telegram_sync import TelegramSync, logger as telegram_logger
+from telegram_sync import TelegramSync, ANCHOR_CHATS, match_anchor_chats, logger as telegram_logger
+from telegram_cache import DialogIndex
 
 # Log inicial
 logging.basicConfig(
@@ -282,9 +283,10 @@ def disconnect_route():
     async def stop_client_async():
         global telegram_client # Apenas acessa
         logger.info("[_async_stop] Iniciando desconexão...")
-        if telegram_client and telegram_client.client.is_connected():
-            await telegram_client.client.disconnect()
-        logger.info("[_async_stop] client.disconnect() chamado.")
+        if telegram_client:
+            # disconnect() também fecha as sessões HTTP do webhook e grava outbox, deduplicação e perfis
+            await telegram_client.disconnect()
+        logger.info("[_async_stop] disconnect() chamado.")
         # O reset do estado global será feito após parar o loop/thread
         return True
 
@@ -420,46 +422,36 @@ def get_chats():
             async def get_recent_chats_async():
                 global telegram_client # Acessa global
                 chats = []
-                reconquest_map_id = None
                 seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
-                logger.info(f"[_async_get_chats] Buscando diálogos desde {seven_days_ago.isoformat()}")
-                async for dialog in telegram_client.client.iter_dialogs():
-                    if dialog.date < seven_days_ago: continue
-                    entity = dialog.entity
-                    chat_info = {
-                        "id": entity.id,
-                        "name": dialog.name or "(Nome Indisponível)",
-                        "type": entity.__class__.__name__ # 'User', 'Chat', 'Channel'
-                    }
-                    
-                    # Adicionar informações específicas do tipo
-                    if hasattr(entity, 'username') and entity.username:
-                        chat_info["username"] = entity.username
-                    if hasattr(entity, 'first_name') and entity.first_name:
-                        chat_info["first_name"] = entity.first_name
-                    if hasattr(entity, 'last_name') and entity.last_name:
-                        chat_info["last_name"] = entity.last_name
-                        # Formatar nome completo para usuários
-                        if chat_info["type"] == 'User':
-                             chat_info["name"] = f"{entity.first_name or ''} {entity.last_name or ''}".strip()
-                    
-                    # Verificar se é o grupo alvo pelo nome
-                    if dialog.name and "TheReconquestMap" in dialog.name:
-                        reconquest_map_id = entity.id
-                        logger.info(f"Encontrado ID do grupo TheReconquestMap: {reconquest_map_id}")
-                    
-                    chats.append(chat_info)
+                if telegram_client.dialog_index.ready:
+                    # Índice em memória mantido pelos handlers: nenhuma requisição ao Telegram
+                    chats = [item for _, _, item in telegram_client.dialog_index.recent(seven_days_ago)]
+                else:
+                    logger.info(f"[_async_get_chats] Buscando diálogos desde {seven_days_ago.isoformat()}")
+                    async for dialog in telegram_client.client.iter_dialogs():
+                        if dialog.date < seven_days_ago:
+                            # Diálogos vêm do mais recente ao mais antigo (fixados primeiro): o resto é mais antigo
+                            if dialog.pinned: continue
+                            break
+                        chats.append(DialogIndex.describe(dialog.entity, dialog.name))
+
+                # Chats âncora (TELEGRAM_ANCHOR_CHATS), resolvidos como em main.py
+                anchors = dict.fromkeys(ANCHOR_CHATS)
+                for chat_info in chats:
+                    match_anchor_chats(chat_info, anchors)
+                anchors = await telegram_client.find_anchor_chats(seven_days_ago, anchors)
                 logger.info(f"[_async_get_chats] Encontrados {len(chats)} diálogos recentes.")
-                return chats, reconquest_map_id
+                return chats, anchors
             
             logger.info("Enviando get_recent_chats_async para o loop do cliente...")
             future = asyncio.run_coroutine_threadsafe(get_recent_chats_async(), loop)
-            chats, reconquest_map_id = future.result(timeout=60)
+            chats, anchors = future.result(timeout=60)
             logger.info("Busca de chats via run_coroutine_threadsafe concluída.")
             return jsonify({
                 "status": "success",
                 "chats": chats,
-                "reconquest_map_id": reconquest_map_id
+                "reconquest_map_id": anchors.get("reconquest_map"),
+                "anchors": anchors
             })
         else:
              logger.error("Não foi possível buscar chats: loop ou cliente indisponível.")
@@ -744,14 +736,14 @@ def run_telegram_client_thread(session_name, phone=None):
                 
         except TimeoutError as te:
              logger.error(f"[_async_run] Timeout durante a autenticação ({s_name}): {te}")
-             if temp_client and hasattr(temp_client, 'client') and temp_client.client.is_connected():
-                try: await temp_client.client.disconnect(); logger.info("[_async_run] Cliente temporário desconectado após timeout.")
+             if temp_client and hasattr(temp_client, 'client'):
+                try: await temp_client.disconnect(); logger.info("[_async_run] Cliente temporário desconectado após timeout.")
                 except Exception as disconn_err: logger.error(f"[_async_run] Erro ao desconectar cliente temp após timeout: {disconn_err}")
              return False # Indica falha
         except Exception as e:
             logger.error(f"[_async_run] Erro fatal durante a conexão ({s_name}): {str(e)}", exc_info=True)
-            if temp_client and hasattr(temp_client, 'client') and temp_client.client.is_connected():
-                try: await temp_client.client.disconnect(); logger.info("[_async_run] Cliente temporário desconectado após erro.")
+            if temp_client and hasattr(temp_client, 'client'):
+                try: await temp_client.disconnect(); logger.info("[_async_run] Cliente temporário desconectado após erro.")
                 except Exception as disconn_err: logger.error(f"[_async_run] Erro ao desconectar cliente temp após erro: {disconn_err}")
             return False # Indica falha
         finally:
@@ -1,22 +1,27 @@
 import os
 import glob
+import hashlib
 import logging
 import asyncio
 from datetime import datetime, timezone, timedelta
 from contextlib import suppress
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import socketio
 from pydantic import BaseModel, Field
 from typing import Optional
+from telegram_cache import DialogIndex, DialogCursor
+from webhook_delivery import encode_json
+from telegram_outbound import SendJobQueue, IdempotencyCache, IdempotencyConflict, JOB_FAILED
 from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, PasswordHashInvalidError, ForbiddenError, UserIsBlockedError
+from telegram_outbound import FLOOD_ERRORS, MediaTransferError
 
 # Importe sua classe TelegramSync (assumindo que está em telegram_sync.py)
 try:
-    from telegram_sync import TelegramSync
+    from telegram_sync import TelegramSync, ANCHOR_CHATS, match_anchor_chats
 except ImportError:
     print("Certifique-se de que telegram_sync.py está no mesmo diretório.")
     exit(1)
@@ -55,6 +60,23 @@ AUTO_CLEAR_LOGS = True
 AUTO_CLEAR_INTERVAL = 15 * 60  # 15 minutos em segundos
 log_clear_task: Optional[asyncio.Task] = None
 
+# Envios assíncronos (async_job nas rotas de envio): workers simultâneos, tamanho da fila e
+# por quanto tempo (segundos) o resultado de um job continua disponível em /api/jobs/{id}
+SEND_JOB_WORKERS = int(os.environ.get("TELEGRAM_SEND_JOB_WORKERS", "4"))
+SEND_JOB_QUEUE_SIZE = int(os.environ.get("TELEGRAM_SEND_JOB_QUEUE_SIZE", "1000"))
+SEND_JOB_RETENTION = float(os.environ.get("TELEGRAM_SEND_JOB_RETENTION", "3600"))
+send_jobs = SendJobQueue(workers=SEND_JOB_WORKERS, max_pending=SEND_JOB_QUEUE_SIZE, retention=SEND_JOB_RETENTION)
+
+# Envio em lote (/api/send-batch): itens por requisição e envios simultâneos por lote
+SEND_BATCH_MAX_ITEMS = int(os.environ.get("TELEGRAM_SEND_BATCH_MAX_ITEMS", "1000"))
+SEND_BATCH_CONCURRENCY = int(os.environ.get("TELEGRAM_SEND_BATCH_CONCURRENCY", "8"))
+
+# Chaves de idempotência dos envios (cabeçalho Idempotency-Key ou campo idempotency_key):
+# quantos resultados guardar e por quanto tempo (segundos)
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("TELEGRAM_IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_TTL = float(os.environ.get("TELEGRAM_IDEMPOTENCY_TTL", "86400"))
+send_idempotency = IdempotencyCache(max_size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+
 # --- Funções Auxiliares ---
 def log_and_store(message: str, level: str = "info"):
     """Adiciona log à lista global e ao logger padrão."""
@@ -92,6 +114,7 @@ async def startup_event():
     """Inicia tarefas de fundo na inicialização."""
     global log_clear_task
     logger.info("Aplicativo iniciado.")
+    send_jobs.start()
     if AUTO_CLEAR_LOGS:
         log_clear_task = asyncio.create_task(schedule_log_clearing_async())
         logger.info(f"Agendamento de limpeza automática de logs iniciado (intervalo: {AUTO_CLEAR_INTERVAL // 60} min).")
@@ -103,6 +126,8 @@ async def shutdown_event():
     if log_clear_task and not log_clear_task.done():
         log_clear_task.cancel()
         logger.info("Tarefa de limpeza de logs cancelada.")
+
+    await send_jobs.close()
     
     logger.info("Tentando desconexão do Telegram no shutdown...")
     await disconnect_telegram_logic() 
@@ -137,7 +162,19 @@ async def get_status():
         "user_info": user_info,
         "current_session": current_session,
         "auto_clear_logs": AUTO_CLEAR_LOGS,
-        "auto_clear_interval": AUTO_CLEAR_INTERVAL // 60 # Retorna em minutos
+        "auto_clear_interval": AUTO_CLEAR_INTERVAL // 60, # Retorna em minutos
+        "webhook": telegram_client.webhook_router.stats() if telegram_client else None,
+        "webhook_dedup": telegram_client.webhook_dedup.stats() if telegram_client and telegram_client.webhook_dedup else None,
+        "user_cache": telegram_client.user_cache.stats() if telegram_client else None,
+        "chat_cache": telegram_client.chat_cache.stats() if telegram_client else None,
+        "profile_store": telegram_client.profile_store.stats() if telegram_client and telegram_client.profile_store else None,
+        "dialog_index": telegram_client.dialog_index.stats() if telegram_client else None,
+        "entity_resolution": telegram_client.entity_stats if telegram_client else None,
+        "send_jobs": send_jobs.stats(),
+        "idempotency": send_idempotency.stats(),
+        "send_scheduler": telegram_client.send_scheduler.stats() if telegram_client else None,
+        "media_cache": telegram_client.media_cache.stats() if telegram_client else None,
+        "media_uploads": telegram_client.media_uploader.stats() if telegram_client and telegram_client.media_uploader else None
     }
 
 @app.get("/api/sessions", summary="Lista as sessões salvas")
@@ -265,42 +302,228 @@ async def remove_session_api(payload: SessionRequest):
         logger.warning(f"Tentativa de remover sessão inexistente: {payload.session_name}")
         return {"status": "error", "message": "Sessão não encontrada"}
 
+CHAT_TYPES = {"user", "chat", "channel"}
+
+
+def parse_chat_types(value):
+    """Converte o parâmetro `type` ("user,channel") em conjunto, validando os valores"""
+    if not value:
+        return None
+    types = {item.strip().lower() for item in value.split(",") if item.strip()}
+    if not types <= CHAT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Tipo inválido: {', '.join(sorted(types - CHAT_TYPES))}")
+    return types
+
+async def stream_chats_ndjson(**filters):
+    """Gera a listagem de chats em NDJSON: um chat por linha, à medida que são lidos, e uma linha final de resumo"""
+    page = {}
+    count = 0
+    try:
+        async for item in iter_chats(page=page, **filters):
+            count += 1
+            yield encode_json(item) + b"\n"
+        anchors = page["anchors"]
+        yield encode_json({
+            "status": "success",
+            "done": True,
+            "count": count,
+            "reconquest_map_id": anchors.get("reconquest_map"),
+            "anchors": anchors,
+            "next_cursor": page["next_cursor"]
+        }) + b"\n"
+    except Exception as e:
+        # O status HTTP já foi enviado: o erro vai como última linha
+        logger.error(f"Erro ao transmitir chats: {e}", exc_info=True)
+        yield encode_json({"status": "error", "message": f"Erro ao buscar chats: {e}"}) + b"\n"
+
 @app.get("/api/chats", summary="Obtém a lista de chats recentes")
-async def get_chats_api():
-    """Retorna a lista de chats com mensagens nos últimos 7 dias."""
+async def get_chats_api(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Máximo de chats por página"),
+    cursor: Optional[str] = Query(None, description="Valor de next_cursor da página anterior"),
+    since: Optional[datetime] = Query(None, description="Só chats com atividade desde esta data (ISO 8601); padrão: últimos 7 dias"),
+    type: Optional[str] = Query(None, description="Tipos separados por vírgula: user, chat, channel"),
+    q: Optional[str] = Query(None, description="Texto a procurar no nome, username, nome ou sobrenome"),
+    format: Optional[str] = Query(None, description="'ndjson' para receber um chat por linha, à medida que são lidos"),
+):
+    """Retorna a lista de chats com mensagens recentes (por padrão, nos últimos 7 dias).
+
+    Com `limit`, a resposta traz `next_cursor` enquanto houver mais chats.
+    Com `format=ndjson` (ou Accept: application/x-ndjson) cada chat é enviado
+    numa linha assim que é lido, e a última linha traz o resumo (`done: true`).
+    Com o índice de diálogos pronto, a resposta traz `version` e um ETag;
+    clientes que reenviarem o ETag em If-None-Match recebem 304 se nada mudou.
+    """
     if not connected or not telegram_client:
         raise HTTPException(status_code=400, detail="Cliente não conectado")
 
+    types = parse_chat_types(type)
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    try:
+        DialogCursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    filters = dict(since=since, types=types, query=q.strip().lower() if q else None, cursor=cursor, limit=limit)
+    if format == "ndjson" or "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(stream_chats_ndjson(**filters), media_type="application/x-ndjson")
+
     # Chama a lógica async para buscar chats
     try:
-        chats, reconquest_map_id = await get_chats_logic()
-        return {
+        chats, anchors, next_cursor = await get_chats_logic(**filters)
+        index = telegram_client.dialog_index
+        if not index.ready:
+            return {
+                "status": "success",
+                "chats": chats,
+                "reconquest_map_id": anchors.get("reconquest_map"),
+                "anchors": anchors,
+                "next_cursor": next_cursor
+            }
+        # O tamanho entra no ETag porque chats também saem da janela de tempo sem nenhum evento
+        etag = index.etag(len(chats), request.url.query)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse({
             "status": "success",
             "chats": chats,
-            "reconquest_map_id": reconquest_map_id
-        }
+            "reconquest_map_id": anchors.get("reconquest_map"),
+            "anchors": anchors,
+            "next_cursor": next_cursor,
+            "version": index.version
+        }, headers={"ETag": etag})
+    except HTTPException:
+        raise
     except Exception as e:
          logger.error(f"Erro na API /api/chats: {e}", exc_info=True)
          raise HTTPException(status_code=500, detail=f"Erro ao buscar chats: {e}")
 
+@app.get("/api/search", summary="Procura chats e contatos pelo nome")
+async def search_chats_api(
+    q: str = Query(..., min_length=1, description="Texto a procurar (sem diferenciar maiúsculas nem acentos)"),
+    limit: int = Query(20, ge=1, le=200),
+    type: Optional[str] = Query(None, description="Tipos separados por vírgula: user, chat, channel"),
+):
+    """Busca por prefixo/trecho em nomes, usernames, nomes e sobrenomes de diálogos e contatos, com os mais relevantes primeiro."""
+    if not connected or not telegram_client:
+        raise HTTPException(status_code=400, detail="Cliente não conectado")
+    if not telegram_client.dialog_index.ready:
+        raise HTTPException(status_code=503, detail="Índice de diálogos ainda em construção", headers={"Retry-After": "5"})
+    types = parse_chat_types(type)
+    results = telegram_client.dialog_index.search.search(q, limit=limit, types=types)
+    return {
+        "status": "success",
+        "results": [item for _, item in results]
+    }
+
+IDEMPOTENT_REPLAY_HEADER = "Idempotent-Replayed"
+
+def get_idempotency_key(request: Request, payload) -> Optional[str]:
+    """Chave de idempotência do pedido: cabeçalho Idempotency-Key ou campo idempotency_key"""
+    key = request.headers.get("idempotency-key") or payload.idempotency_key
+    if key and len(key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key deve ter no máximo 255 caracteres")
+    return key or None
+
+async def run_idempotent(scope: str, key: Optional[str], payload: BaseModel, operation, is_valid=None):
+    """Executa `operation()` uma única vez por chave de idempotência.
+
+    `is_valid(resultado)`, se informado, decide numa repetição se o resultado
+    guardado ainda vale; se não valer, a operação é executada de novo.
+
+    Returns:
+        Tupla (resultado, True se o resultado veio de um pedido anterior com a mesma chave)
+    """
+    if not key:
+        return await operation(), False
+    # O conteúdo do pedido acompanha a chave: a mesma chave com outro conteúdo é recusada
+    fingerprint = hashlib.sha256(encode_json(payload.model_dump(exclude={"idempotency_key"}))).hexdigest()
+    try:
+        return await send_idempotency.run(f"{scope}:{key}", fingerprint, operation, is_valid)
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail=f"Idempotency-Key '{key}' já usada com outro conteúdo")
+
+def submit_send_job(kind, chat_id, run, callback_url=None) -> str:
+    """Enfileira um envio e devolve o ID do job, consultável em /api/jobs/{id}"""
+    if callback_url and not callback_url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="callback_url deve ser uma URL http(s)")
+    try:
+        job = send_jobs.submit(kind, chat_id, run, callback_url)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Fila de envios cheia, tente novamente em instantes", headers={"Retry-After": "5"})
+    logger.info(f"API: Job de envio {job.id} ({kind}) enfileirado para chat {chat_id}")
+    return job.id
+
+def job_still_valid(job_id: str) -> bool:
+    """Um job guardado por chave de idempotência só é repetido enquanto não falhou e ainda está na retenção"""
+    job = send_jobs.get(job_id)
+    return job is not None and job.status != JOB_FAILED
+
+def job_accepted_response(job_id: str, replayed: bool = False):
+    """Resposta 202 com o ID e o status atual do job"""
+    job = send_jobs.get(job_id)
+    status_url = f"/api/jobs/{job_id}"
+    headers = {"Location": status_url}
+    if replayed:
+        headers[IDEMPOTENT_REPLAY_HEADER] = "true"
+    return JSONResponse(status_code=202, content={
+        "status": "accepted",
+        "job_id": job_id,
+        "status_url": status_url,
+        "job": job.to_dict() if job else None
+    }, headers=headers)
+
+@app.get("/api/jobs/{job_id}", summary="Obtém o status de um envio assíncrono")
+async def get_job_api(job_id: str):
+    """Retorna o status do job (queued, running, succeeded ou failed) e o message_id quando enviado."""
+    job = send_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado (ou já expirado)")
+    return {"status": "success", "job": job.to_dict()}
+
 class SendMessageRequest(BaseModel):
     chat_id: str | int
     message: str
+    async_job: bool = False # Responde 202 na hora e envia em segundo plano
+    callback_url: Optional[str] = None # Recebe um POST com o resultado do job (implica async_job)
+    idempotency_key: Optional[str] = None # Alternativa ao cabeçalho Idempotency-Key
 
 @app.post("/api/send-message", summary="Envia uma mensagem para um chat")
-async def send_message_api(payload: SendMessageRequest):
-    """Envia uma mensagem de texto para o chat_id especificado."""
+async def send_message_api(payload: SendMessageRequest, request: Request, response: Response):
+    """Envia uma mensagem de texto para o chat_id especificado.
+
+    Com Idempotency-Key, repetições do mesmo pedido devolvem o resultado do
+    primeiro (cabeçalho Idempotent-Replayed) em vez de enviar de novo.
+    """
     if not connected or not telegram_client:
          raise HTTPException(status_code=400, detail="Cliente não conectado")
+    key = get_idempotency_key(request, payload)
+
+    if payload.async_job or payload.callback_url:
+        async def submit():
+            return submit_send_job(
+                "message", payload.chat_id,
+                lambda: send_message_logic(payload.chat_id, payload.message),
+                payload.callback_url
+            )
+        job_id, replayed = await run_idempotent("send-message", key, payload, submit, job_still_valid)
+        return job_accepted_response(job_id, replayed)
          
     # Chama a lógica async para enviar mensagem
     try:
-        message_id = await send_message_logic(payload.chat_id, payload.message)
+        message_id, replayed = await run_idempotent(
+            "send-message", key, payload, lambda: send_message_logic(payload.chat_id, payload.message)
+        )
+        if replayed:
+            response.headers[IDEMPOTENT_REPLAY_HEADER] = "true"
         return {
             "status": "success",
             "message": "Mensagem enviada com sucesso",
             "message_id": message_id
         }
+    except HTTPException:
+        raise
     except Exception as e:
         # send_message_logic já levanta HTTPException em caso de erro
         # Mas podemos capturar outros erros inesperados aqui
@@ -313,6 +536,9 @@ class SendPhotoRequest(BaseModel):
     photo: str  # Espera-se uma URL aqui
     caption: Optional[str] = None
     parse_mode: Optional[str] = None # 'markdown' or 'html'
+    async_job: bool = False # Responde 202 na hora e baixa/envia a foto em segundo plano
+    callback_url: Optional[str] = None # Recebe um POST com o resultado do job (implica async_job)
+    idempotency_key: Optional[str] = None # Alternativa ao cabeçalho Idempotency-Key
 
 # --- Lógica do Telegram (Adaptada para asyncio) ---
 
@@ -433,6 +659,9 @@ async def run_telegram_client(session_name: str, phone: str | None):
         await sio.emit('status_update', {"connected": False, "error": f"Erro inesperado: {e}", "session": session_name })
     finally:
         logger.info(f"[TG Task] Tarefa run_telegram_client para {session_name} finalizando.")
+        if temp_client:
+            try: await temp_client.close()
+            except Exception as close_err: logger.warning(f"[TG Task] Erro ao fechar recursos do cliente {session_name}: {close_err}")
         if current_session == session_name:
              logger.info(f"[TG Task] Limpando estado global para {session_name}.")
              connected = False
@@ -469,7 +698,7 @@ async def disconnect_telegram_logic() -> bool:
         # Tentar desconectar o cliente primeiro (melhor esforço)
         if telegram_client and telegram_client.client.is_connected():
             try:
-                await telegram_client.client.disconnect()
+                await telegram_client.disconnect()
                 logger.info("Cliente Telegram desconectado via API antes de cancelar task.")
             except Exception as e:
                 logger.warning(f"Erro ao desconectar cliente antes de cancelar task: {e}")
@@ -501,27 +730,55 @@ async def disconnect_telegram_logic() -> bool:
             await sio.emit('status_update', {"connected": False, "user_info": None, "session": None})
         return True 
 
-async def get_chats_logic():
-     """Lógica async para buscar chats recentes."""
+async def iter_chats(since=None, types=None, query=None, cursor=None, limit=None, page=None):
+     """Gera os chats recentes um a um, do mais recente ao mais antigo, já filtrados e paginados.
+
+     Ao terminar, preenche `page` com "next_cursor" (cursor da próxima página ou None) e "anchors" (IDs dos chats âncora).
+     """
+     page = {} if page is None else page
+     page["next_cursor"] = None
+     if since is None:
+         since = datetime.now(timezone.utc) - timedelta(days=7)
+     if telegram_client.dialog_index.ready:
+         # Índice em memória mantido pelos handlers: nenhuma requisição ao Telegram
+         chats, page["next_cursor"] = telegram_client.dialog_index.query(since, types, query, cursor, limit)
+         page["anchors"] = await telegram_client.find_anchor_chats(since)
+         for item in chats:
+             yield item
+         return
+
+     anchors = page["anchors"] = dict.fromkeys(ANCHOR_CHATS)
+     pager = DialogCursor(cursor)
+     count = 0
+     last = None
+     async for dialog in telegram_client.iter_recent_dialogs(since, until=pager.date):
+         telegram_client.remember_chat(dialog.entity) # Mantém o cache de chats dos handlers atualizado
+         item = DialogIndex.describe(dialog.entity, dialog.name)
+         match_anchor_chats(item, anchors) # Âncoras valem para todos os diálogos, não só os filtrados
+         if not pager.after(dialog.id, dialog.date) or not DialogIndex.matches(item, types, query):
+             continue
+         if limit is not None and count >= limit:
+             page["next_cursor"] = DialogCursor.encode(*last)
+             break
+         count += 1
+         last = (dialog.id, dialog.date)
+         yield item
+     # Âncoras antes do cursor ou depois do limite desta página
+     await telegram_client.find_anchor_chats(since, anchors)
+
+async def get_chats_logic(since=None, types=None, query=None, cursor=None, limit=None):
+     """Lógica async para buscar chats recentes.
+
+     Returns:
+         Tupla (chats, IDs dos chats âncora, cursor da próxima página ou None)
+     """
      if not telegram_client:
          raise HTTPException(status_code=500, detail="Cliente Telegram não inicializado")
      try:
-         chats = []
-         reconquest_map_id = None
-         seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
-         async for dialog in telegram_client.client.iter_dialogs():
-             if dialog.date < seven_days_ago: continue
-             entity = dialog.entity
-             chat_info = { "id": entity.id, "name": dialog.name or "(Nome Indisponível)", "type": entity.__class__.__name__ }
-             if hasattr(entity, 'username') and entity.username: chat_info["username"] = entity.username
-             if hasattr(entity, 'first_name') and entity.first_name: chat_info["first_name"] = entity.first_name
-             if hasattr(entity, 'last_name') and entity.last_name:
-                 chat_info["last_name"] = entity.last_name
-                 if chat_info["type"] == 'User': chat_info["name"] = f"{entity.first_name or ''} {entity.last_name or ''}".strip()
-             if dialog.name and "TheReconquestMap" in dialog.name: reconquest_map_id = entity.id
-             chats.append(chat_info)
+         page = {}
+         chats = [item async for item in iter_chats(since, types, query, cursor, limit, page=page)]
          logger.info(f"[Lógica Chats] Encontrados {len(chats)} diálogos recentes.")
-         return chats, reconquest_map_id
+         return chats, page["anchors"], page["next_cursor"]
      except Exception as e:
          logger.error(f"Erro na lógica get_chats_logic: {e}", exc_info=True)
          raise HTTPException(status_code=500, detail=f"Erro interno ao buscar chats: {e}")
@@ -541,25 +798,25 @@ async def send_message_logic(chat_id: str | int, message: str) -> int | None:
         sent_message = await telegram_client.send_message(parsed_chat_id, message)
         logger.info(f"[Lógica Envio] Mensagem enviada. ID: {getattr(sent_message, 'id', None)}")
         return getattr(sent_message, 'id', None)
+    except FLOOD_ERRORS as e:
+        # O agendador já esperou e tentou de novo; a espera pedida é longa demais para segurar a requisição
+        logger.error(f"Limite de envio do Telegram atingido para {chat_id}: espera de {e.seconds}s")
+        raise HTTPException(status_code=429, detail=f"Limite de envio do Telegram: tente novamente em {e.seconds}s", headers={"Retry-After": str(e.seconds)})
     except Exception as e:
         logger.error(f"Erro ao enviar mensagem (lógica async): {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao enviar mensagem: {e}")
 
-async def send_photo_logic(chat_id: str | int, photo_url: str, caption: Optional[str], parse_mode_str: Optional[str]) -> Optional[int]:
-    """Lógica async para enviar foto com legenda."""
-    if not telegram_client or not telegram_client.client.is_connected():
-         logger.warning("send_photo_logic chamado sem cliente conectado.")
-         raise HTTPException(status_code=400, detail="Cliente não conectado")
-
-    # Validar e usar parse_mode string diretamente
+def parse_mode_option(parse_mode_str: Optional[str]) -> Optional[str]:
+    """Valida o parse_mode ('markdown' ou 'html'); valores inválidos enviam sem formatação"""
     valid_parse_modes = ['markdown', 'html']
-    pm_to_use = None
     if parse_mode_str and parse_mode_str.lower() in valid_parse_modes:
-        pm_to_use = parse_mode_str.lower() # Usar a string diretamente
-    elif parse_mode_str:
-         logger.warning(f"send_photo_logic: parse_mode '{parse_mode_str}' inválido. Enviando sem formatação especial.")
-         # Não definir pm_to_use
+        return parse_mode_str.lower() # Usar a string diretamente
+    if parse_mode_str:
+         logger.warning(f"parse_mode '{parse_mode_str}' inválido. Enviando sem formatação especial.")
+    return None
 
+async def get_target_entity(chat_id: str | int):
+    """Resolve o chat_id (ID numérico ou username) na entidade de destino, com HTTPException se não existir."""
     # Tentar converter chat_id para int se parecer numérico
     entity_id_to_use: str | int = chat_id
     try:
@@ -570,29 +827,39 @@ async def send_photo_logic(chat_id: str | int, photo_url: str, caption: Optional
         logger.warning(f"Não foi possível converter chat_id '{chat_id}' para int. Usando como string.")
         # Mantém como string se a conversão falhar (ex: é um username)
 
+    # Tentar obter a entidade de destino usando o ID processado
     try:
-        # Tentar obter a entidade de destino usando o ID processado
-        try:
-             # Use a variável entity_id_to_use aqui!
-             target_entity = await telegram_client.client.get_entity(entity_id_to_use)
-             logger.info(f"[Lógica Envio Foto] Enviando para entidade: {target_entity.id} (Tipo: {type(target_entity).__name__})")
-        except ValueError as e:
-             # Logar o ID que foi tentado (string ou int)
-             logger.error(f"[Lógica Envio Foto] Não foi possível encontrar a entidade para chat_id '{entity_id_to_use}' (tipo: {type(entity_id_to_use).__name__}): {e}")
-             raise HTTPException(status_code=404, detail=f"Chat ID '{chat_id}' não encontrado ou inválido.")
-        except TypeError as e: # Capturar erro se get_entity não gostar do tipo mesmo assim
-             logger.error(f"[Lógica Envio Foto] Erro de tipo ao chamar get_entity com '{entity_id_to_use}' (tipo: {type(entity_id_to_use).__name__}): {e}")
-             raise HTTPException(status_code=400, detail=f"Tipo de Chat ID '{chat_id}' inválido para get_entity.")
-        except Exception as e_entity:
-             logger.error(f"[Lógica Envio Foto] Erro ao obter entidade para chat_id '{entity_id_to_use}': {e_entity}", exc_info=True)
-             raise HTTPException(status_code=500, detail=f"Erro ao verificar Chat ID '{chat_id}': {e_entity}")
+         target_entity = await telegram_client.client.get_entity(entity_id_to_use)
+         logger.info(f"[Lógica Envio] Enviando para entidade: {target_entity.id} (Tipo: {type(target_entity).__name__})")
+         return target_entity
+    except ValueError as e:
+         # Logar o ID que foi tentado (string ou int)
+         logger.error(f"[Lógica Envio] Não foi possível encontrar a entidade para chat_id '{entity_id_to_use}' (tipo: {type(entity_id_to_use).__name__}): {e}")
+         raise HTTPException(status_code=404, detail=f"Chat ID '{chat_id}' não encontrado ou inválido.")
+    except TypeError as e: # Capturar erro se get_entity não gostar do tipo mesmo assim
+         logger.error(f"[Lógica Envio] Erro de tipo ao chamar get_entity com '{entity_id_to_use}' (tipo: {type(entity_id_to_use).__name__}): {e}")
+         raise HTTPException(status_code=400, detail=f"Tipo de Chat ID '{chat_id}' inválido para get_entity.")
+    except Exception as e_entity:
+         logger.error(f"[Lógica Envio] Erro ao obter entidade para chat_id '{entity_id_to_use}': {e_entity}", exc_info=True)
+         raise HTTPException(status_code=500, detail=f"Erro ao verificar Chat ID '{chat_id}': {e_entity}")
 
+async def send_photo_logic(chat_id: str | int, photo_url: str, caption: Optional[str], parse_mode_str: Optional[str]) -> Optional[int]:
+    """Lógica async para enviar foto com legenda."""
+    if not telegram_client or not telegram_client.client.is_connected():
+         logger.warning("send_photo_logic chamado sem cliente conectado.")
+         raise HTTPException(status_code=400, detail="Cliente não conectado")
+
+    pm_to_use = parse_mode_option(parse_mode_str)
+    # Fora do try abaixo para que 404/400 da busca do chat cheguem ao cliente como estão
+    target_entity = await get_target_entity(chat_id)
+
+    try:
         # Enviar a foto usando a URL e a entidade validada
-        # Telethon baixa a URL automaticamente
+        # (reenvios da mesma URL usam a mídia em cache, sem baixar a imagem de novo)
         logger.info(f"[Lógica Envio Foto] Tentando enviar arquivo da URL: {photo_url} com parse_mode: {pm_to_use}")
-        sent_message = await telegram_client.client.send_file(
+        sent_message = await telegram_client.send_media(
             target_entity,
-            file=photo_url,
+            photo_url,
             caption=caption or '', # Usar string vazia se caption for None
             parse_mode=pm_to_use # Passar a string ('markdown', 'html') ou None
         )
@@ -604,6 +871,12 @@ async def send_photo_logic(chat_id: str | int, photo_url: str, caption: Optional
              logger.warning(f"[Lógica Envio Foto] Foto enviada para {target_entity.id}, mas não foi possível obter o ID da mensagem.")
         return message_id
 
+    except MediaTransferError as e:
+         logger.error(f"[Lógica Envio Foto] Erro ao transferir a mídia para {chat_id}: {e}")
+         raise HTTPException(status_code=e.status_code, detail=str(e))
+    except FLOOD_ERRORS as e:
+         logger.error(f"[Lógica Envio Foto] Limite de envio do Telegram atingido para {chat_id}: espera de {e.seconds}s")
+         raise HTTPException(status_code=429, detail=f"Limite de envio do Telegram: tente novamente em {e.seconds}s", headers={"Retry-After": str(e.seconds)})
     except ForbiddenError as e:
          logger.error(f"[Lógica Envio Foto] Erro de permissão ao enviar para {chat_id}: {e}", exc_info=True)
          raise HTTPException(status_code=403, detail=f"Permissão negada para enviar foto para '{chat_id}': {e}")
@@ -621,22 +894,65 @@ async def send_photo_logic(chat_id: str | int, photo_url: str, caption: Optional
         if hasattr(e, 'message'): error_msg = e.message # Usar mensagem específica se disponível
         raise HTTPException(status_code=500, detail=f"Erro ao enviar foto: {error_msg}")
 
+async def send_album_logic(chat_id: str | int, photos: list[str], captions: list[str], parse_mode_str: Optional[str]) -> list[int]:
+    """Lógica async para enviar várias fotos como um único álbum."""
+    if not telegram_client or not telegram_client.client.is_connected():
+         raise HTTPException(status_code=400, detail="Cliente não conectado")
+
+    pm_to_use = parse_mode_option(parse_mode_str)
+    target_entity = await get_target_entity(chat_id)
+    try:
+        logger.info(f"[Lógica Envio Álbum] Enviando {len(photos)} fotos para {target_entity.id}")
+        sent_messages = await telegram_client.send_album(target_entity, photos, captions, pm_to_use)
+        message_ids = [getattr(message, 'id', None) for message in sent_messages]
+        logger.info(f"[Lógica Envio Álbum] Álbum enviado para {target_entity.id}. IDs: {message_ids}")
+        return message_ids
+    except MediaTransferError as e:
+         logger.error(f"[Lógica Envio Álbum] Erro ao transferir a mídia para {chat_id}: {e}")
+         raise HTTPException(status_code=e.status_code, detail=str(e))
+    except FLOOD_ERRORS as e:
+         logger.error(f"[Lógica Envio Álbum] Limite de envio do Telegram atingido para {chat_id}: espera de {e.seconds}s")
+         raise HTTPException(status_code=429, detail=f"Limite de envio do Telegram: tente novamente em {e.seconds}s", headers={"Retry-After": str(e.seconds)})
+    except (ForbiddenError, UserIsBlockedError) as e:
+         logger.error(f"[Lógica Envio Álbum] Sem permissão para enviar para {chat_id}: {e}")
+         raise HTTPException(status_code=403, detail=f"Permissão negada para enviar o álbum para '{chat_id}': {e}")
+    except Exception as e:
+        logger.error(f"[Lógica Envio Álbum] Erro inesperado ao enviar álbum para {chat_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Erro ao enviar álbum: {getattr(e, 'message', str(e))}")
+
 # --- Rotas FastAPI ---
 
 @app.post("/api/send-photo", summary="Envia uma foto (via URL) com legenda para um chat")
-async def send_photo_api(payload: SendPhotoRequest):
-    """Recebe chat_id, URL da foto, legenda e parse_mode, e envia via Telegram."""
+async def send_photo_api(payload: SendPhotoRequest, request: Request, response: Response):
+    """Recebe chat_id, URL da foto, legenda e parse_mode, e envia via Telegram.
+
+    Com Idempotency-Key, repetições do mesmo pedido devolvem o resultado do
+    primeiro (cabeçalho Idempotent-Replayed) sem baixar nem enviar a foto de novo.
+    """
     logger.info(f"API: Recebida solicitação para /api/send-photo para chat {payload.chat_id}")
     if not connected or not telegram_client:
          raise HTTPException(status_code=400, detail="Cliente não conectado")
+    key = get_idempotency_key(request, payload)
+
+    if payload.async_job or payload.callback_url:
+        async def submit():
+            return submit_send_job(
+                "photo", payload.chat_id,
+                lambda: send_photo_logic(payload.chat_id, payload.photo, payload.caption, payload.parse_mode),
+                payload.callback_url
+            )
+        job_id, replayed = await run_idempotent("send-photo", key, payload, submit, job_still_valid)
+        return job_accepted_response(job_id, replayed)
 
     try:
-        message_id = await send_photo_logic(
+        message_id, replayed = await run_idempotent("send-photo", key, payload, lambda: send_photo_logic(
             chat_id=payload.chat_id,
             photo_url=payload.photo,
             caption=payload.caption,
             parse_mode_str=payload.parse_mode
-        )
+        ))
+        if replayed:
+            response.headers[IDEMPOTENT_REPLAY_HEADER] = "true"
         return {
             "status": "success",
             "message": "Foto enviada com sucesso",
@@ -650,6 +966,131 @@ async def send_photo_api(payload: SendPhotoRequest):
         logger.error(f"Erro inesperado na API /api/send-photo: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro inesperado no servidor ao enviar foto: {getattr(e, 'message', str(e))}")
 
+class SendAlbumItem(BaseModel):
+    photo: str # URL da foto
+    caption: Optional[str] = None
+
+class SendAlbumRequest(BaseModel):
+    chat_id: str | int
+    items: list[SendAlbumItem] = Field(..., min_length=1, max_length=10) # Limite do Telegram por álbum
+    parse_mode: Optional[str] = None # 'markdown' or 'html'
+    idempotency_key: Optional[str] = None # Alternativa ao cabeçalho Idempotency-Key
+
+@app.post("/api/send-album", summary="Envia até 10 fotos (via URL) como um único álbum")
+async def send_album_api(payload: SendAlbumRequest, request: Request, response: Response):
+    """Envia as fotos como uma única mensagem agrupada, com legenda por item."""
+    logger.info(f"API: Recebida solicitação para /api/send-album ({len(payload.items)} fotos) para chat {payload.chat_id}")
+    if not connected or not telegram_client:
+         raise HTTPException(status_code=400, detail="Cliente não conectado")
+
+    message_ids, replayed = await run_idempotent("send-album", get_idempotency_key(request, payload), payload, lambda: send_album_logic(
+        chat_id=payload.chat_id,
+        photos=[item.photo for item in payload.items],
+        captions=[item.caption or '' for item in payload.items],
+        parse_mode_str=payload.parse_mode
+    ))
+    if replayed:
+        response.headers[IDEMPOTENT_REPLAY_HEADER] = "true"
+    return {
+        "status": "success",
+        "message": "Álbum enviado com sucesso",
+        "message_ids": message_ids
+    }
+
+class SendBatchItem(BaseModel):
+    chat_id: str | int
+    message: Optional[str] = None # Texto; com `photo`, vira a legenda se `caption` não for informado
+    photo: Optional[str] = None # URL da foto
+    caption: Optional[str] = None
+    parse_mode: Optional[str] = None # 'markdown' or 'html' (só para fotos)
+    idempotency_key: Optional[str] = None # Item já enviado com esta chave não é enviado de novo
+
+class SendBatchRequest(BaseModel):
+    items: list[SendBatchItem] = Field(..., min_length=1)
+    concurrency: Optional[int] = Field(None, ge=1, le=64) # Padrão: TELEGRAM_SEND_BATCH_CONCURRENCY
+
+async def send_batch_item(index: int, item: SendBatchItem) -> dict:
+    """Envia um item do lote e devolve o resultado (message_id ou erro), sem levantar exceção"""
+    result = {"index": index, "chat_id": item.chat_id}
+    try:
+        if item.photo:
+            send = lambda: send_photo_logic(item.chat_id, item.photo, item.caption or item.message, item.parse_mode)
+        elif item.message:
+            send = lambda: send_message_logic(item.chat_id, item.message)
+        else:
+            raise HTTPException(status_code=400, detail="Informe message ou photo")
+        if item.idempotency_key and len(item.idempotency_key) > 255:
+            raise HTTPException(status_code=400, detail="idempotency_key deve ter no máximo 255 caracteres")
+        message_id, replayed = await run_idempotent("send-batch", item.idempotency_key, item, send)
+        result.update(status="success", message_id=message_id)
+        if replayed:
+            result["replayed"] = True
+    except HTTPException as e:
+        result.update(status="error", error=e.detail, status_code=e.status_code)
+    except Exception as e:
+        logger.error(f"Erro inesperado no item {index} do lote: {e}", exc_info=True)
+        result.update(status="error", error=str(e), status_code=500)
+    return result
+
+async def iter_send_batch(items, concurrency):
+    """Envia os itens com no máximo `concurrency` envios simultâneos, gerando cada resultado assim que termina"""
+    pending = iter(enumerate(items))
+    results = asyncio.Queue()
+
+    async def worker():
+        # Os workers compartilham o mesmo iterador: cada item é enviado uma única vez
+        for index, item in pending:
+            await results.put(await send_batch_item(index, item))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(items)))]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        # Cliente desistiu do streaming (ou o lote terminou): nada de envios soltos
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+async def stream_send_batch_ndjson(items, concurrency):
+    """Gera os resultados do lote em NDJSON, na ordem em que terminam, e uma linha final de resumo"""
+    sent = 0
+    async for result in iter_send_batch(items, concurrency):
+        sent += result["status"] == "success"
+        yield encode_json(result) + b"\n"
+    yield encode_json({"status": "success", "done": True, "total": len(items), "sent": sent, "failed": len(items) - sent}) + b"\n"
+
+@app.post("/api/send-batch", summary="Envia mensagens ou fotos para vários chats")
+async def send_batch_api(payload: SendBatchRequest, request: Request, format: Optional[str] = Query(None, description="'ndjson' para receber cada resultado assim que o envio termina")):
+    """Envia uma lista de itens `{chat_id, message | photo, caption}` com concorrência limitada.
+
+    A resposta traz um resultado por item (`message_id` ou `error`), na ordem
+    dos itens. Com `format=ndjson` (ou Accept: application/x-ndjson) cada
+    resultado é enviado assim que o envio termina, e a última linha traz o resumo.
+    """
+    if not connected or not telegram_client:
+         raise HTTPException(status_code=400, detail="Cliente não conectado")
+    if len(payload.items) > SEND_BATCH_MAX_ITEMS:
+         raise HTTPException(status_code=400, detail=f"Máximo de {SEND_BATCH_MAX_ITEMS} itens por lote")
+
+    concurrency = payload.concurrency or SEND_BATCH_CONCURRENCY
+    logger.info(f"API: Recebido lote de {len(payload.items)} envios (concorrência {concurrency})")
+    if format == "ndjson" or "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(stream_send_batch_ndjson(payload.items, concurrency), media_type="application/x-ndjson")
+
+    results = [None] * len(payload.items)
+    async for result in iter_send_batch(payload.items, concurrency):
+        results[result["index"]] = result
+    sent = sum(1 for result in results if result["status"] == "success")
+    logger.info(f"API: Lote concluído: {sent}/{len(results)} enviados")
+    return {
+        "status": "success",
+        "total": len(results),
+        "sent": sent,
+        "failed": len(results) - sent,
+        "results": results
+    }
+
 # --- Handlers Socket.IO ---
 
 # ... (connect, disconnect como antes) ...
@@ -528,31 +528,47 @@ async function fetchChats() {
     refreshChatsBtn.disabled = true; // Desabilitar botão durante busca
     
     try {
-        const response = await fetch('/api/chats');
-        const data = await response.json();
+        // NDJSON: um chat por linha à medida que o servidor lê os diálogos; a última linha traz o resumo
+        const response = await fetch('/api/chats?format=ndjson');
+        if (!response.ok) {
+            const error = await response.json().catch(() => ({}));
+            throw new Error(error.detail || `HTTP ${response.status}`);
+        }
         
-        if (data.status === 'success') {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let chatCount = 0;
+        let data = null;
+        
+        const handleLine = (line) => {
+            if (!line.trim()) return;
+            const item = JSON.parse(line);
+            if (item.status) {
+                data = item; // Linha final (resumo ou erro)
+            } else {
+                chatCount++;
+                // Popular o dropdown aqui (removido, mas manter lógica se voltar)
+            }
+        };
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop(); // Linha incompleta fica para o próximo pedaço
+            lines.forEach(handleLine);
+        }
+        handleLine(buffer + decoder.decode());
+        
+        if (data && data.status === 'success') {
             // Atualizar ID fixo global e na UI
-                reconquestMapId = data.reconquest_map_id;
+            reconquestMapId = data.reconquest_map_id;
             updateReconquestMapDisplay();
-            
-            // Popular o dropdown (removido, mas manter lógica se voltar)
-            /*
-            chatSelect.innerHTML = '<option value="">Selecione um chat</option>';
-            if (data.chats && data.chats.length > 0) {
-            data.chats.forEach(chat => {
-                        const option = document.createElement('option');
-                        option.value = chat.id;
-                    option.textContent = `${chat.name} (${chat.type})`;
-                    chatSelect.appendChild(option);
-                });
-                        } else {
-                 chatSelect.innerHTML = '<option value="">Nenhum chat recente encontrado</option>';
-            }
-            */
-            addLog(`Chats recentes atualizados. ID TheReconquestMap: ${reconquestMapId || 'Não encontrado'}.`, 'info');
+            addLog(`Chats recentes atualizados (${chatCount}). ID TheReconquestMap: ${reconquestMapId || 'Não encontrado'}.`, 'info');
         } else {
-            addLog(`Erro ao atualizar chats: ${data.message}`, 'error');
+            addLog(`Erro ao atualizar chats: ${data ? data.message : 'resposta incompleta'}`, 'error');
             updateReconquestMapDisplay(); // Atualiza display mesmo em erro
         }
     } catch (error) {
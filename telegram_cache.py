@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Caches usados pelo TelegramSync para evitar requisições repetidas à API do
+Telegram (usuários, chats etc.), em memória e persistidos ao lado da sessão.
+"""
+
+import re
+import json
+import time
+import uuid
+import heapq
+import sqlite3
+import asyncio
+import logging
+import unicodedata
+import collections
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from telethon.utils import get_display_name
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Cache LRU limitado por quantidade, com expiração por entrada.
+
+    Cada entrada guarda o próprio instante de expiração, o que permite
+    cachear falhas com um TTL menor (cache negativo) no mesmo dicionário.
+    Todas as operações são O(1).
+
+    Args:
+        max_size: Quantidade máxima de entradas; a menos usada recentemente sai primeiro
+        ttl: Validade padrão de cada entrada (segundos)
+        negative_ttl: Validade das entradas gravadas com `negative=True` (segundos)
+    """
+
+    def __init__(self, max_size=5000, ttl=3600.0, negative_ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = collections.OrderedDict()  # chave -> (valor, expira_em, negativo)
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """Devolve o valor em cache, ou `default` se não existir ou tiver expirado"""
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires_at, negative = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        if negative:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, negative=False, ttl=None):
+        """Grava o valor; com `negative=True` usa o TTL curto de falhas"""
+        if ttl is None:
+            ttl = self.negative_ttl if negative else self.ttl
+        self._data[key] = (value, time.monotonic() + ttl, negative)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove a entrada; devolve True se ela existia"""
+        if self._data.pop(key, None) is None:
+            return False
+        self.invalidations += 1
+        return True
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[1] > time.monotonic()
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.negative_hits) / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class ProfileStore:
+    """Perfis de usuários e chats persistidos em SQLite, para que os caches não comecem frios a cada reinício.
+
+    Os perfis ficam em memória; `put` só marca o que mudou e uma tarefa em
+    segundo plano grava as alterações em lote a cada `flush_interval`
+    segundos (write-behind), numa thread dedicada para não bloquear o loop.
+    Cada perfil guarda quando foi confirmado pela última vez (`updated_at`),
+    para que quem carrega possa respeitar o TTL entre reinícios; um perfil
+    reconfirmado sem mudanças só tem essa data regravada a cada
+    `refresh_interval` segundos.
+
+    Args:
+        path: Caminho do banco SQLite
+        flush_interval: Intervalo entre as gravações em lote (segundos)
+        refresh_interval: Intervalo mínimo para regravar a data de um perfil que não mudou (segundos)
+    """
+
+    def __init__(self, path, flush_interval=5.0, refresh_interval=3600.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+
+        self._profiles = {}    # (tipo, id) -> dicionário do perfil
+        self._updated_at = {}  # (tipo, id) -> time.time() da última confirmação
+        self._dirty = {}       # (tipo, id) -> dicionário do perfil, ou None para remover
+        self._executor = None
+        self._conn = None
+        self._flusher_task = None
+
+        self.writes = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open_sync(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS profiles (
+                kind TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (kind, id)
+            )
+        """)
+        conn.commit()
+        self._conn = conn
+        return conn.execute("SELECT kind, id, data, updated_at FROM profiles").fetchall()
+
+    async def open(self):
+        """Abre o banco e carrega todos os perfis em memória. Retorna {tipo: {id: perfil}}"""
+        if self._flusher_task:
+            return self.profiles()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile-store")
+        for kind, profile_id, data, updated_at in await self._run(self._open_sync):
+            try:
+                self._profiles[(kind, profile_id)] = json.loads(data)
+                self._updated_at[(kind, profile_id)] = updated_at
+            except ValueError:
+                logger.warning(f"Perfil inválido ignorado no cache persistente: {kind} {profile_id}")
+        self._flusher_task = asyncio.create_task(self._flusher(), name="profile-store-flusher")
+        logger.info(f"Cache persistente de perfis: {len(self._profiles)} perfis carregados de {self.path}")
+        return self.profiles()
+
+    def profiles(self):
+        result = {}
+        for (kind, profile_id), data in self._profiles.items():
+            result.setdefault(kind, {})[profile_id] = data
+        return result
+
+    def get(self, kind, profile_id):
+        return self._profiles.get((kind, profile_id))
+
+    def updated_at(self, kind, profile_id):
+        """Quando o perfil foi confirmado pela última vez (time.time()), ou None"""
+        return self._updated_at.get((kind, profile_id))
+
+    def put(self, kind, profile_id, data):
+        """Atualiza o perfil; só agenda gravação se algo mudou ou se a data de confirmação envelheceu"""
+        key = (kind, profile_id)
+        now = time.time()
+        if self._profiles.get(key) == data and now - self._updated_at.get(key, 0) < self.refresh_interval:
+            return
+        self._profiles[key] = data
+        self._updated_at[key] = now
+        self._dirty[key] = data
+
+    def delete(self, kind, profile_id):
+        key = (kind, profile_id)
+        self._updated_at.pop(key, None)
+        if self._profiles.pop(key, None) is not None:
+            self._dirty[key] = None
+
+    def _write_sync(self, changes):
+        now = time.time()
+        with self._conn:
+            for (kind, profile_id), data in changes.items():
+                if data is None:
+                    self._conn.execute("DELETE FROM profiles WHERE kind = ? AND id = ?", (kind, profile_id))
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO profiles (kind, id, data, updated_at) VALUES (?, ?, ?, ?)",
+                        (kind, profile_id, json.dumps(data, ensure_ascii=False), now)
+                    )
+
+    async def flush(self):
+        if not self._dirty or self._conn is None:
+            return
+        changes, self._dirty = self._dirty, {}
+        try:
+            await self._run(self._write_sync, changes)
+            self.writes += len(changes)
+        except Exception as e:
+            logger.error(f"Erro ao gravar {len(changes)} perfis no cache persistente: {e}", exc_info=True)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        """Grava as alterações pendentes e fecha o banco"""
+        if self._flusher_task:
+            self._flusher_task.cancel()
+            await asyncio.gather(self._flusher_task, return_exceptions=True)
+            self._flusher_task = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "profiles": len(self._profiles),
+            "pending_writes": len(self._dirty),
+            "writes": self.writes,
+        }
+
+
+def normalize_text(text):
+    """Texto em minúsculas e sem acentos (ex.: 'João' -> 'joao'), para buscas em nomes em português"""
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+class ChatSearchIndex:
+    """Índice de busca por prefixo/trecho nos nomes, usernames, nomes e sobrenomes dos chats.
+
+    Cada chat é indexado pelos trigramas do texto normalizado (sem acentos e
+    em minúsculas). Uma busca com 3 ou mais letras intersecta as listas dos
+    trigramas da consulta; consultas mais curtas não têm trigrama e conferem
+    todos os chats, para casar também no meio das palavras como as longas.
+    Os candidatos são conferidos e ordenados: nome/username igual à
+    consulta, começando com ela, alguma palavra começando com ela e, por
+    fim, trecho.
+    """
+
+    def __init__(self):
+        self._docs = {}                             # chat_id -> (item, nome, username, texto, palavras)
+        self._grams = collections.defaultdict(set)  # trigrama -> chat_ids
+
+    @staticmethod
+    def _grams_of(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, chat_id, item):
+        """Indexa (ou reindexa) o chat a partir do item no formato de /api/chats"""
+        self.remove(chat_id)
+        fields = [normalize_text(item.get(key)) for key in ("name", "username", "first_name", "last_name")]
+        text = "\n".join(field for field in fields if field)
+        words = {word for word in re.split(r"\W+", text) if word}
+        doc = (item, fields[0], fields[1], text, words)
+        self._docs[chat_id] = doc
+        for gram in self._grams_of(text):
+            self._grams[gram].add(chat_id)
+
+    def remove(self, chat_id):
+        doc = self._docs.pop(chat_id, None)
+        if doc is None:
+            return
+        for gram in self._grams_of(doc[3]):
+            self._grams[gram].discard(chat_id)
+            if not self._grams[gram]:
+                del self._grams[gram]
+
+    def clear(self):
+        self._docs.clear()
+        self._grams.clear()
+
+    def _candidates(self, query):
+        if len(query) < 3:
+            return self._docs.keys()
+        postings = []
+        for gram in self._grams_of(query):
+            ids = self._grams.get(gram)
+            if not ids:
+                return ()
+            postings.append(ids)
+        postings.sort(key=len)
+        return set.intersection(*postings) if len(postings) > 1 else postings[0]
+
+    def search(self, query, limit=20, types=None):
+        """Chats que casam com a consulta, do mais relevante ao menos relevante.
+
+        Returns:
+            Lista de tuplas (chat_id, item)
+        """
+        query = normalize_text(query).strip()
+        if not query:
+            return []
+        ranked = []
+        for chat_id in self._candidates(query):
+            item, name, username, text, words = self._docs[chat_id]
+            if types and item["type"].lower() not in types:
+                continue
+            if name == query or username == query:
+                rank = 0
+            elif name.startswith(query) or username.startswith(query):
+                rank = 1
+            elif any(word.startswith(query) for word in words):
+                rank = 2
+            elif query in text:
+                rank = 3
+            else:
+                continue  # Trigramas presentes, mas fora de ordem
+            ranked.append((rank, len(name), name, chat_id))
+        return [(chat_id, self._docs[chat_id][0]) for _, _, _, chat_id in heapq.nsmallest(limit, ranked)]
+
+    def __len__(self):
+        return len(self._docs)
+
+
+class DialogIndex:
+    """Índice em memória dos diálogos, em ordem de atividade, mantido pelos handlers de eventos.
+
+    É montado uma vez com `iter_dialogs()` após o login e depois atualizado a
+    cada mensagem/ação, de modo que listar os chats recentes não precisa de
+    nenhuma requisição ao Telegram. Cada alteração incrementa `version`, que
+    junto com `generation` (muda a cada processo) serve de ETag para as
+    respostas de /api/chats.
+    """
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()  # chat_id -> [data, item]; do menos ao mais recente
+        self.ready = False
+        self.version = 0
+        self.generation = uuid.uuid4().hex[:8]
+        self.built_at = None
+        self.search = ChatSearchIndex()  # Diálogos e contatos
+
+    @staticmethod
+    def describe(entity, name=None):
+        """Monta o item de diálogo no formato de /api/chats a partir da entidade do Telethon"""
+        if name is None:
+            name = get_display_name(entity)
+        item = {"id": entity.id, "name": name or "(Nome Indisponível)", "type": entity.__class__.__name__}
+        if getattr(entity, 'username', None):
+            item["username"] = entity.username
+        if getattr(entity, 'first_name', None):
+            item["first_name"] = entity.first_name
+        if getattr(entity, 'last_name', None):
+            item["last_name"] = entity.last_name
+            if item["type"] == 'User':
+                item["name"] = f"{entity.first_name or ''} {entity.last_name or ''}".strip()
+        return item
+
+    def build(self, dialogs):
+        """Substitui o índice pelos diálogos informados, como tuplas (chat_id, data, item).
+
+        Os diálogos são ordenados pela data da última atividade (iter_dialogs
+        lista os fixados primeiro, qualquer que seja a data). Chats
+        atualizados pelos handlers enquanto o índice era montado são mantidos,
+        já que são mais recentes do que a listagem.
+        """
+        entries = collections.OrderedDict()
+        for chat_id, date, item in sorted(dialogs, key=lambda dialog: dialog[1].timestamp() if dialog[1] else 0):
+            entries[chat_id] = [date, item]
+        for chat_id, entry in self._entries.items():
+            entries[chat_id] = entry
+            entries.move_to_end(chat_id)
+        self._entries = entries
+        self.search.clear()
+        for chat_id, (_, item) in entries.items():
+            self.search.add(chat_id, item)
+        self.ready = True
+        self.built_at = time.time()
+        self.version += 1
+
+    def touch(self, chat_id, date=None):
+        """Marca atividade no chat; devolve False se o chat ainda não está no índice"""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return False
+        if date is not None and (entry[0] is None or date > entry[0]):
+            entry[0] = date
+        self._entries.move_to_end(chat_id)
+        self.version += 1
+        return True
+
+    def upsert(self, chat_id, entity, date=None):
+        """Inclui ou atualiza o chat a partir da entidade, movendo-o para o topo"""
+        entry = self._entries.get(chat_id)
+        if entry is not None and date is None:
+            date = entry[0]
+        self._entries[chat_id] = [date, self.describe(entity)]
+        self._entries.move_to_end(chat_id)
+        self.search.add(chat_id, self._entries[chat_id][1])
+        self.version += 1
+
+    def refresh(self, chat_id, entity):
+        """Atualiza nome/username do chat sem mudar sua posição"""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return False
+        entry[1] = self.describe(entity)
+        self.search.add(chat_id, entry[1])
+        self.version += 1
+        return True
+
+    def index_contact(self, chat_id, entity):
+        """Inclui na busca um contato que não tem diálogo (não aparece na listagem de chats)"""
+        if chat_id not in self._entries:
+            self.search.add(chat_id, self.describe(entity))
+
+    def remove(self, chat_id):
+        if self._entries.pop(chat_id, None) is not None:
+            self.search.remove(chat_id)
+            self.version += 1
+
+    def recent(self, since=None):
+        """Tuplas (chat_id, data, item) dos diálogos com atividade desde `since`, do mais recente ao mais antigo.
+
+        Como o índice está em ordem de atividade, a varredura para no
+        primeiro diálogo mais antigo que o corte.
+        """
+        for chat_id, (date, item) in reversed(self._entries.items()):
+            if since is not None and (date is None or date < since):
+                break
+            yield chat_id, date, item
+
+    @staticmethod
+    def matches(item, types=None, query=None):
+        """Filtros de /api/chats: tipos ('user', 'chat', 'channel') e texto no nome/username"""
+        if types and item["type"].lower() not in types:
+            return False
+        if query:
+            fields = (item.get("name"), item.get("username"), item.get("first_name"), item.get("last_name"))
+            if not any(value and query in value.lower() for value in fields):
+                return False
+        return True
+
+    def query(self, since=None, types=None, query=None, cursor=None, limit=None):
+        """Página de diálogos filtrados, do mais recente ao mais antigo.
+
+        Returns:
+            Tupla (itens, cursor da próxima página ou None)
+        """
+        items = []
+        last = None
+        pager = DialogCursor(cursor)
+        for chat_id, date, item in self.recent(since):
+            if not pager.after(chat_id, date) or not self.matches(item, types, query):
+                continue
+            if limit is not None and len(items) >= limit:
+                return items, DialogCursor.encode(*last)
+            items.append(item)
+            last = (chat_id, date)
+        return items, None
+
+    def etag(self, *extra):
+        """ETag da listagem atual; `extra` entra na chave (ex.: filtros e tamanho da resposta)"""
+        parts = [self.generation, str(self.version)] + [str(value) for value in extra]
+        return '"' + "-".join(parts) + '"'
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "dialogs": len(self._entries),
+            "searchable": len(self.search),
+            "version": self.version,
+            "built_at": self.built_at,
+        }
+
+
+class DialogCursor:
+    """Cursor de paginação de /api/chats: data e chat_id do último diálogo devolvido ("<timestamp>:<chat_id>")"""
+
+    def __init__(self, value=None):
+        self.timestamp = None
+        self.chat_id = None
+        self._passed = False
+        if value:
+            try:
+                timestamp, chat_id = value.split(":", 1)
+                self.timestamp, self.chat_id = int(timestamp), int(chat_id)
+            except ValueError:
+                raise ValueError(f"Cursor inválido: {value}")
+
+    @property
+    def date(self):
+        return datetime.fromtimestamp(self.timestamp, timezone.utc) if self.timestamp is not None else None
+
+    @staticmethod
+    def encode(chat_id, date):
+        return f"{int(date.timestamp()) if date else 0}:{chat_id}"
+
+    def after(self, chat_id, date):
+        """True se o diálogo vem depois do cursor (deve entrar na página)"""
+        if self.timestamp is None or self._passed:
+            return True
+        timestamp = int(date.timestamp()) if date else 0
+        if timestamp < self.timestamp:
+            self._passed = True
+            return True
+        if timestamp == self.timestamp and chat_id == self.chat_id:
+            # Diálogos com a mesma data que vierem depois do último devolvido entram na próxima página
+            self._passed = True
+        return False
@@ -0,0 +1,739 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Envio de mensagens para o Telegram.
+Todo envio passa por um agendador com limites de taxa (global e por chat)
+que absorve os FloodWait do Telegram; mídias de URLs são baixadas e
+enviadas ao Telegram em paralelo, em partes, e as já enviadas são
+reaproveitadas a partir de um cache. Pedidos repetidos com a mesma chave
+de idempotência não enviam de novo. As rotas de envio também podem apenas
+validar e enfileirar o pedido, respondendo na hora com o ID do job; um pool
+limitado de workers faz o envio, e o resultado fica disponível para consulta
+e, opcionalmente, é avisado num callback.
+"""
+
+import re
+import time
+import uuid
+import random
+import mimetypes
+import asyncio
+import logging
+import collections
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, unquote
+
+import aiohttp
+from telethon.errors import FloodWaitError, SlowModeWaitError
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError
+from telethon.tl import types
+from telethon.tl.functions.upload import SaveFilePartRequest, SaveBigFilePartRequest
+from telethon.utils import get_peer_id, get_input_photo, get_input_document
+
+from telegram_cache import TTLCache
+from webhook_delivery import encode_json
+
+# FloodPremiumWaitError só existe a partir do Telethon 1.37; antes disso chega como FloodWaitError
+try:
+    from telethon.errors import FloodPremiumWaitError
+except ImportError:
+    FloodPremiumWaitError = FloodWaitError
+
+logger = logging.getLogger(__name__)
+
+# Erros do Telegram que pedem para esperar `e.seconds` antes de tentar de novo
+FLOOD_ERRORS = (FloodWaitError, FloodPremiumWaitError, SlowModeWaitError)
+
+
+class TokenBucket:
+    """Token bucket com reserva de fichas, para espaçar envios sem lock.
+
+    Cada `reserve()` consome uma ficha na hora (o saldo pode ficar negativo)
+    e devolve quanto tempo o chamador deve esperar por ela, então quem chega
+    primeiro envia primeiro. `penalize` bloqueia o bucket durante um FloodWait,
+    cancela as reservas feitas (quem estava esperando reserva de novo, atrás do
+    bloqueio) e reduz a taxa multiplicativamente; `recover` devolve a taxa aos
+    poucos para o valor configurado a cada envio bem-sucedido.
+    """
+
+    def __init__(self, rate, burst, min_rate_factor=0.1, recover_factor=0.05):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = rate * min_rate_factor
+        self.recover_factor = recover_factor
+        self.tokens = float(burst)
+        self.updated = time.monotonic()  # No futuro enquanto o bucket está bloqueado por um FloodWait
+        self.penalties = 0
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def reserve(self):
+        """Reserva uma ficha e devolve quantos segundos esperar antes de usá-la"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens) / self.rate + max(0.0, self.updated - now)
+
+    def penalize(self, seconds, factor=0.5):
+        """Bloqueia o bucket por `seconds`, cancela as reservas e reduz a taxa"""
+        now = time.monotonic()
+        self.slow_down(factor)
+        self.tokens = 0.0
+        self.updated = max(self.updated, now + seconds)
+        self.penalties += 1
+
+    def slow_down(self, factor):
+        self._refill(time.monotonic())
+        self.rate = max(self.min_rate, self.rate * factor)
+
+    def recover(self):
+        if self.rate < self.base_rate:
+            self._refill(time.monotonic())
+            self.rate = min(self.base_rate, self.rate + self.base_rate * self.recover_factor)
+
+    @property
+    def idle(self):
+        """Cheio e sem penalidade: pode ser descartado e recriado sem perder nada"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst and self.rate >= self.base_rate
+
+    def stats(self):
+        return {
+            "rate": round(self.rate, 3),
+            "base_rate": self.base_rate,
+            "tokens": round(self.tokens, 2),
+            "blocked_for": round(max(0.0, self.updated - time.monotonic()), 1)
+        }
+
+
+class SendScheduler:
+    """Agendador dos envios ao Telegram, com token bucket global e por chat.
+
+    Antes de cada envio espera uma ficha no bucket do chat (taxas diferentes
+    para conversas privadas e para grupos/canais) e depois no bucket global.
+    Um FloodWait (ou SlowModeWait) bloqueia o bucket do chat pelo tempo pedido,
+    reduz as taxas e o envio é repetido automaticamente; esperas maiores que
+    `max_flood_wait` ou além de `max_retries` tentativas sobem para o chamador.
+
+    Args:
+        rate, burst: Envios por segundo e rajada do bucket global
+        peer_rate: Envios por segundo para cada conversa privada
+        group_rate: Envios por segundo para cada grupo ou canal
+        peer_burst: Rajada dos buckets por chat
+        max_retries: Novas tentativas após FloodWait
+        max_flood_wait: Maior espera (segundos) absorvida pelo agendador
+        max_peers: Buckets por chat mantidos em memória
+    """
+
+    def __init__(self, rate=30.0, burst=30, peer_rate=1.0, group_rate=20 / 60, peer_burst=3,
+                 max_retries=3, max_flood_wait=300.0, max_peers=10000):
+        self.peer_rate = peer_rate
+        self.group_rate = group_rate
+        self.peer_burst = peer_burst
+        self.max_retries = max_retries
+        self.max_flood_wait = max_flood_wait
+        self.max_peers = max_peers
+
+        self.global_bucket = TokenBucket(rate, burst)
+        self._peers = collections.OrderedDict()  # chave do chat -> TokenBucket, do menos ao mais usado
+
+        self.sent = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.gave_up = 0
+
+    @staticmethod
+    def peer_key(peer):
+        """Chave do chat: o peer_id para entidades e IDs numéricos, o username em minúsculas para o resto"""
+        if isinstance(peer, str):
+            value = peer.strip()
+            return int(value) if value.lstrip("-").isdigit() else value.lower().lstrip("@")
+        try:
+            return get_peer_id(peer)
+        except (TypeError, ValueError):
+            return peer
+
+    def _bucket(self, key):
+        bucket = self._peers.get(key)
+        if bucket is None:
+            # IDs negativos são grupos e canais, que têm limite bem menor que conversas privadas
+            rate = self.group_rate if isinstance(key, int) and key < 0 else self.peer_rate
+            bucket = self._peers[key] = TokenBucket(rate, self.peer_burst)
+            if len(self._peers) > self.max_peers:
+                oldest_key, oldest = next(iter(self._peers.items()))
+                if oldest.idle:
+                    del self._peers[oldest_key]
+        self._peers.move_to_end(key)
+        return bucket
+
+    async def _wait(self, bucket):
+        while True:
+            penalties = bucket.penalties
+            delay = bucket.reserve()
+            if delay > 0:
+                self.throttled += 1
+                self.throttled_seconds += delay
+                await asyncio.sleep(delay)
+            if bucket.penalties == penalties:
+                return
+            # Houve FloodWait durante a espera: a reserva foi cancelada, reserva de novo atrás do bloqueio
+
+    async def run(self, peer, send):
+        """Executa `send()` (função que devolve a corrotina de envio) respeitando os limites do chat `peer`"""
+        bucket = self._bucket(self.peer_key(peer))
+        attempt = 0
+        while True:
+            await self._wait(bucket)
+            await self._wait(self.global_bucket)
+            try:
+                result = await send()
+            except FLOOD_ERRORS as e:
+                seconds = e.seconds
+                self.flood_waits += 1
+                self.flood_wait_seconds += seconds
+                bucket.penalize(seconds)
+                if not isinstance(e, SlowModeWaitError):
+                    # FloodWait também indica que o ritmo geral da conta está alto demais
+                    self.global_bucket.slow_down(0.8)
+                attempt += 1
+                if attempt > self.max_retries or seconds > self.max_flood_wait:
+                    self.gave_up += 1
+                    raise
+                logger.warning(f"Telegram pediu {seconds}s de espera ao enviar para {peer}; nova tentativa {attempt}/{self.max_retries} após a espera.")
+                continue
+            bucket.recover()
+            self.global_bucket.recover()
+            self.sent += 1
+            return result
+
+    def stats(self):
+        return {
+            "global": self.global_bucket.stats(),
+            "peers": len(self._peers),
+            "sent": self.sent,
+            "throttled": self.throttled,
+            "throttled_seconds": round(self.throttled_seconds, 1),
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": self.flood_wait_seconds,
+            "gave_up": self.gave_up
+        }
+
+# Erros de uma mídia em cache que o Telegram não aceita mais (referência expirada ou arquivo removido)
+STALE_MEDIA_ERRORS = (FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError)
+
+
+class MediaCache:
+    """Mídias já enviadas ao Telegram, indexadas pela URL de origem.
+
+    Depois do primeiro envio de uma URL guarda o InputPhoto/InputDocument da
+    mensagem enviada; os envios seguintes usam essa referência, sem que a
+    imagem seja baixada e enviada de novo. LRU limitado por quantidade e por
+    tempo (`ttl`), para que uma URL cujo conteúdo mudou volte a ser buscada.
+    """
+
+    def __init__(self, max_size=1000, ttl=3600.0):
+        self._media = TTLCache(max_size=max_size, ttl=ttl)
+        self.stale = 0
+
+    @staticmethod
+    def cacheable(file):
+        return isinstance(file, str) and re.match(r"https?://", file, re.IGNORECASE) is not None
+
+    def get(self, url):
+        return self._media.get(url) if self.cacheable(url) else None
+
+    def remember(self, url, message):
+        """Guarda a mídia de `message` (a mensagem enviada a partir de `url`)"""
+        if not self.cacheable(url) or message is None:
+            return
+        if getattr(message, "photo", None):
+            self._media.set(url, get_input_photo(message.photo))
+        elif getattr(message, "document", None):
+            self._media.set(url, get_input_document(message.document))
+
+    def invalidate(self, url):
+        """Descarta a mídia que o Telegram recusou; o próximo envio usa a URL de novo"""
+        self.stale += 1
+        self._media.invalidate(url)
+
+    def stats(self):
+        stats = self._media.stats()
+        del stats["negative_hits"]
+        stats["stale"] = self.stale
+        return stats
+
+
+class MediaTransferError(Exception):
+    """Falha ao baixar a mídia de uma URL para enviá-la ao Telegram"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MediaUploader:
+    """Sobe para o Telegram o conteúdo de uma URL enquanto ele é baixado.
+
+    O download HTTP é lido em partes de `part_size` bytes e cada parte vai
+    para upload.saveFilePart (ou saveBigFilePart, acima de 10 MB) assim que
+    fica completa, com até `parallel_parts` partes em voo; a leitura espera
+    quando todas estão ocupadas, então a memória de cada transferência fica
+    limitada a cerca de `parallel_parts + 1` partes. Sem Content-Length o
+    total de partes não é conhecido de antemão e o arquivo fica limitado a 10 MB.
+
+    Args:
+        part_size: Tamanho de cada parte (múltiplo de 1 KB que divida 512 KB)
+        parallel_parts: Partes enviadas ao mesmo tempo em cada transferência
+        max_size: Maior arquivo aceito (bytes)
+        timeout: Tempo máximo de cada transferência, do download ao último upload (segundos)
+        connect_timeout: Timeout de conexão com o servidor da URL (segundos)
+    """
+
+    BIG_FILE_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, part_size=512 * 1024, parallel_parts=4, max_size=50 * 1024 * 1024,
+                 timeout=120.0, connect_timeout=10.0):
+        self.part_size = part_size
+        self.parallel_parts = parallel_parts
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._session = None
+
+        self.in_flight = 0
+        self.uploads = 0
+        self.failures = 0
+        self.parts_uploaded = 0
+        self.bytes_uploaded = 0
+
+    async def upload(self, client, url):
+        """Baixa `url` enviando as partes ao Telegram e devolve o InputFile/InputFileBig para send_file"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, connect=self.connect_timeout))
+        self.in_flight += 1
+        try:
+            input_file = await asyncio.wait_for(self._transfer(client, url), self.timeout)
+            self.uploads += 1
+            return input_file
+        except asyncio.TimeoutError:
+            self.failures += 1
+            raise MediaTransferError(f"Tempo esgotado ao transferir {url} ({self.timeout:.0f}s)", 504)
+        except aiohttp.ClientError as e:
+            self.failures += 1
+            raise MediaTransferError(f"Erro ao baixar {url}: {e}") from e
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _file_name(url, response):
+        # O nome (e a extensão) decide se o Telegram recebe uma foto ou um documento
+        name = unquote(urlsplit(url).path.rsplit("/", 1)[-1]) or "file"
+        if not mimetypes.guess_type(name)[0]:
+            extension = mimetypes.guess_extension(response.content_type or "")
+            if extension:
+                name += extension
+        return name
+
+    async def _transfer(self, client, url):
+        async with self._session.get(url) as response:
+            if response.status >= 400:
+                raise MediaTransferError(f"Erro ao baixar {url}: HTTP {response.status}")
+            size = response.content_length
+            if size is not None and size > self.max_size:
+                raise MediaTransferError(f"Arquivo de {url} maior que o limite de {self.max_size} bytes", 413)
+            limit = size if size is not None else min(self.max_size, self.BIG_FILE_SIZE)
+            is_big = size is not None and size > self.BIG_FILE_SIZE
+            total_parts = -(-size // self.part_size) if is_big else None
+            file_id = random.getrandbits(63)
+
+            slots = asyncio.Semaphore(self.parallel_parts)
+            tasks = set()
+            errors = []
+
+            async def save(index, data):
+                try:
+                    if is_big:
+                        request = SaveBigFilePartRequest(file_id, index, total_parts, data)
+                    else:
+                        request = SaveFilePartRequest(file_id, index, data)
+                    if not await client(request):
+                        raise MediaTransferError(f"Telegram recusou a parte {index} de {url}", 502)
+                    self.parts_uploaded += 1
+                    self.bytes_uploaded += len(data)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    slots.release()
+
+            def start(index, data):
+                task = asyncio.create_task(save(index, data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            buffer = bytearray()
+            received = 0
+            parts = 0
+            try:
+                async for chunk in response.content.iter_chunked(self.part_size):
+                    received += len(chunk)
+                    if received > limit:
+                        raise MediaTransferError(f"Arquivo de {url} maior que o limite de {limit} bytes", 413)
+                    buffer += chunk
+                    while len(buffer) >= self.part_size:
+                        await slots.acquire()
+                        if errors:
+                            raise errors[0]
+                        start(parts, bytes(buffer[:self.part_size]))
+                        del buffer[:self.part_size]
+                        parts += 1
+                if not received:
+                    raise MediaTransferError(f"Arquivo vazio em {url}")
+                if size is not None and received != size:
+                    raise MediaTransferError(f"Download incompleto de {url} ({received} de {size} bytes)", 502)
+                if buffer:
+                    await slots.acquire()
+                    start(parts, bytes(buffer))
+                    parts += 1
+                await asyncio.gather(*tasks)
+                if errors:
+                    raise errors[0]
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+        name = self._file_name(url, response)
+        if is_big:
+            return types.InputFileBig(file_id, parts, name)
+        return types.InputFile(file_id, parts, name, md5_checksum="")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "uploads": self.uploads,
+            "failures": self.failures,
+            "parts_uploaded": self.parts_uploaded,
+            "bytes_uploaded": self.bytes_uploaded
+        }
+
+
+class IdempotencyConflict(Exception):
+    """A chave de idempotência já foi usada com outro conteúdo"""
+
+
+class IdempotencyCache:
+    """Resultado dos envios por chave de idempotência.
+
+    O primeiro pedido com uma chave executa o envio; repetições recebem o
+    resultado guardado (por `ttl` segundos, LRU limitado a `max_size`) e
+    repetições que chegam enquanto o primeiro ainda está em andamento
+    aguardam o mesmo future, sem disputar o envio. Só sucessos são guardados:
+    depois de uma falha a mesma chave pode ser tentada de novo. Reusar a
+    chave com outro conteúdo (outro `fingerprint`) levanta IdempotencyConflict.
+    Quando o resultado só vale enquanto algo externo o confirma (o ID de um
+    job que ainda pode falhar), `is_valid(resultado)` decide na repetição se
+    ele continua valendo ou se a operação deve ser executada de novo.
+    """
+
+    def __init__(self, max_size=10000, ttl=86400.0):
+        self._results = TTLCache(max_size=max_size, ttl=ttl)  # chave -> (fingerprint, resultado)
+        self._pending = {}  # chave -> (future, fingerprint)
+
+        self.executed = 0
+        self.replayed = 0
+        self.joined = 0
+        self.conflicts = 0
+        self.expired = 0
+
+    def _check(self, key, stored, fingerprint):
+        if stored != fingerprint:
+            self.conflicts += 1
+            raise IdempotencyConflict(f"Chave de idempotência '{key}' já usada com outro conteúdo")
+
+    async def run(self, key, fingerprint, operation, is_valid=None):
+        """Executa `operation()` uma única vez por chave.
+
+        Returns:
+            Tupla (resultado, True se veio de um pedido anterior com a mesma chave)
+        """
+        entry = self._results.get(key)
+        if entry is not None:
+            self._check(key, entry[0], fingerprint)
+            if is_valid is None or is_valid(entry[1]):
+                self.replayed += 1
+                return entry[1], True
+            # O resultado guardado deixou de valer: a chave volta a executar a operação
+            self._results.invalidate(key)
+            self.expired += 1
+        pending = self._pending.get(key)
+        if pending is not None:
+            future, stored = pending
+            self._check(key, stored, fingerprint)
+            self.joined += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = (future, fingerprint)
+        self.executed += 1
+        try:
+            result = await operation()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Marca como lida: sem repetições esperando, o asyncio não reclama
+            raise
+        finally:
+            self._pending.pop(key, None)
+        self._results.set(key, (fingerprint, result))
+        future.set_result(result)
+        return result, False
+
+    def stats(self):
+        return {
+            "size": self._results.stats()["size"],
+            "in_flight": len(self._pending),
+            "executed": self.executed,
+            "replayed": self.replayed,
+            "joined": self.joined,
+            "conflicts": self.conflicts,
+            "expired": self.expired
+        }
+
+
+# Estados de um job de envio
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+class SendJob:
+    """Um pedido de envio enfileirado e o seu resultado"""
+
+    __slots__ = ("id", "kind", "chat_id", "run", "callback_url", "status", "message_id",
+                 "error", "status_code", "created_at", "started_at", "finished_at")
+
+    def __init__(self, kind, chat_id, run, callback_url=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.chat_id = chat_id
+        self.run = run
+        self.callback_url = callback_url
+        self.status = JOB_QUEUED
+        self.message_id = None
+        self.error = None
+        self.status_code = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.status in (JOB_SUCCEEDED, JOB_FAILED)
+
+    def to_dict(self):
+        def iso(ts):
+            return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "chat_id": self.chat_id,
+            "status": self.status,
+            "message_id": self.message_id,
+            "error": self.error,
+            "status_code": self.status_code,
+            "created_at": iso(self.created_at),
+            "started_at": iso(self.started_at),
+            "finished_at": iso(self.finished_at)
+        }
+
+
+class SendJobQueue:
+    """Fila de jobs de envio drenada por um pool limitado de workers.
+
+    `submit` só enfileira (levanta `asyncio.QueueFull` quando a fila está
+    cheia) e devolve o job; cada worker executa `job.run()` e guarda o
+    message_id ou o erro. Jobs terminados ficam disponíveis para consulta por
+    `retention` segundos, limitados a `max_jobs`.
+
+    Args:
+        workers: Quantidade de envios simultâneos
+        max_pending: Tamanho máximo da fila de jobs ainda não iniciados
+        retention: Tempo (segundos) que um job terminado continua consultável
+        max_jobs: Quantidade máxima de jobs guardados para consulta
+        callback_timeout: Timeout (segundos) de cada POST no callback
+        callback_attempts: Tentativas de entrega do callback
+    """
+
+    def __init__(self, workers=4, max_pending=1000, retention=3600.0, max_jobs=10000,
+                 callback_timeout=10.0, callback_attempts=3):
+        self.workers = workers
+        self.retention = retention
+        self.max_jobs = max_jobs
+        self.callback_timeout = callback_timeout
+        self.callback_attempts = callback_attempts
+
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._jobs = {}  # job_id -> SendJob
+        self._finished = collections.OrderedDict()  # job_id -> SendJob terminado, em ordem de término
+        self._worker_tasks = []
+        self._callback_tasks = set()
+        self._session = None
+
+        self.submitted = 0
+        self.running = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.callbacks_sent = 0
+        self.callbacks_failed = 0
+
+    def start(self):
+        """Inicia os workers (precisa de um loop em execução)"""
+        if self._worker_tasks:
+            return
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(), name=f"send-job-worker-{n}")
+            for n in range(self.workers)
+        ]
+        logger.info(f"Fila de envios iniciada com {self.workers} workers.")
+
+    def submit(self, kind, chat_id, run, callback_url=None):
+        """Enfileira um envio; `run` é uma função sem argumentos que devolve a corrotina de envio"""
+        self._prune()
+        job = SendJob(kind, chat_id, run, callback_url)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise
+        self._jobs[job.id] = job
+        self.submitted += 1
+        return job
+
+    def get(self, job_id):
+        """Devolve o job (ou None se não existir ou já tiver sido descartado)"""
+        return self._jobs.get(job_id)
+
+    def _prune(self):
+        # Só jobs terminados saem; os pendentes já são limitados pelo tamanho da fila
+        cutoff = time.time() - self.retention
+        while self._finished:
+            job = next(iter(self._finished.values()))
+            if job.finished_at >= cutoff and len(self._finished) < self.max_jobs:
+                break
+            del self._finished[job.id]
+            self._jobs.pop(job.id, None)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._execute(job)
+            finally:
+                self._queue.task_done()
+
+    async def _execute(self, job):
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        self.running += 1
+        try:
+            job.message_id = await job.run()
+            job.status = JOB_SUCCEEDED
+            self.succeeded += 1
+        except asyncio.CancelledError:
+            job.status = JOB_FAILED
+            job.error = "Envio cancelado no encerramento do servidor"
+            self.failed += 1
+            raise
+        except Exception as e:
+            # As funções de envio levantam HTTPException (detail/status_code); outros erros vão como texto
+            job.status = JOB_FAILED
+            job.error = str(getattr(e, "detail", None) or e)
+            job.status_code = getattr(e, "status_code", None)
+            self.failed += 1
+            logger.warning(f"Job de envio {job.id} ({job.kind} para {job.chat_id}) falhou: {job.error}")
+        finally:
+            self.running -= 1
+            job.finished_at = time.time()
+            self._finished[job.id] = job
+            if job.callback_url:
+                task = asyncio.create_task(self._send_callback(job), name=f"send-job-callback-{job.id}")
+                self._callback_tasks.add(task)
+                task.add_done_callback(self._callback_tasks.discard)
+
+    async def _send_callback(self, job):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.callback_timeout))
+        body = encode_json(job.to_dict())
+        for attempt in range(1, self.callback_attempts + 1):
+            try:
+                async with self._session.post(job.callback_url, data=body, headers={"Content-Type": "application/json"}) as response:
+                    if response.status < 400:
+                        self.callbacks_sent += 1
+                        return
+                    error = f"HTTP {response.status}"
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            if attempt < self.callback_attempts:
+                await asyncio.sleep(2 ** (attempt - 1))
+        self.callbacks_failed += 1
+        logger.warning(f"Callback do job {job.id} não entregue em {job.callback_url}: {error}")
+
+    async def close(self):
+        """Para os workers; jobs em andamento ou ainda na fila terminam como falhos"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        # Todo job sem fim registrado termina agora, para a consulta mostrar o estado real e a retenção descartá-lo
+        now = time.time()
+        for job in self._jobs.values():
+            if job.finished_at is not None:
+                continue
+            job.status = JOB_FAILED
+            if job.error is None:
+                job.error = "Servidor encerrado antes do envio" if job.started_at is None else "Envio cancelado no encerramento do servidor"
+            job.finished_at = now
+            self._finished[job.id] = job
+            self.failed += 1
+        if self._callback_tasks:
+            await asyncio.gather(*self._callback_tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self._queue.qsize(),
+            "running": self.running,
+            "tracked": len(self._jobs),
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "callbacks_sent": self.callbacks_sent,
+            "callbacks_failed": self.callbacks_failed
+        }
@@ -8,12 +8,20 @@ enviadas e recebidas, enviando-as para um webhook do N8N.
 """
 
 import os
-import json
+import time
+import asyncio
+import mimetypes
 import logging
-import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 from telethon import TelegramClient, events
-from telethon.tl.functions.users import GetFullUserRequest
+from telethon.tl import types
+from telethon.tl.functions.users import GetFullUserRequest, GetUsersRequest
+from telethon.tl.functions.contacts import GetContactsRequest
+from telethon.tl.functions.messages import UploadMediaRequest
+from telethon.utils import get_peer_id, get_input_media, get_input_user, is_image
+from telegram_cache import TTLCache, ProfileStore, DialogIndex, normalize_text
+from telegram_outbound import SendScheduler, MediaCache, MediaUploader, STALE_MEDIA_ERRORS, FLOOD_ERRORS
+from webhook_delivery import WebhookEndpoint, WebhookRouter, DeliveryDeduplicator, WebhookOutbox, AdaptiveConcurrencyLimiter, CircuitBreaker, load_webhook_routes
 
 # Tentar carregar variáveis de ambiente do arquivo .env
 try:
@@ -44,6 +52,108 @@ SESSIONS_DIR = "sessions" # Definir o diretório como uma constante
 # URL do Webhook N8N
 WEBHOOK_URL = os.environ.get("N8N_WEBHOOK_URL", "https://backend.reconquestyourex.com/webhook/telegram-sync")
 
+# Pool de conexões HTTP do webhook (keep-alive) e timeouts por requisição (segundos)
+WEBHOOK_POOL_SIZE = int(os.environ.get("N8N_WEBHOOK_POOL_SIZE", "10"))
+WEBHOOK_TIMEOUT = float(os.environ.get("N8N_WEBHOOK_TIMEOUT", "15"))
+WEBHOOK_CONNECT_TIMEOUT = float(os.environ.get("N8N_WEBHOOK_CONNECT_TIMEOUT", "5"))
+
+# Compressão gzip dos corpos maiores que N bytes (0 desativa)
+WEBHOOK_GZIP_MIN_BYTES = int(os.environ.get("N8N_WEBHOOK_GZIP_MIN_BYTES", "0"))
+WEBHOOK_GZIP_LEVEL = int(os.environ.get("N8N_WEBHOOK_GZIP_LEVEL", "5"))
+
+# Fila de entrega entre os handlers do Telethon e o webhook: uma lane por grupo de chats,
+# cada uma com seu worker (ordem garantida dentro do chat, chats diferentes em paralelo)
+WEBHOOK_LANES = int(os.environ.get("N8N_WEBHOOK_LANES", "8"))
+WEBHOOK_LANE_SIZE = int(os.environ.get("N8N_WEBHOOK_LANE_SIZE", "250"))
+WEBHOOK_OVERFLOW_POLICY = os.environ.get("N8N_WEBHOOK_OVERFLOW_POLICY", "spill") # block, drop_oldest ou spill
+
+# Outbox durável (SQLite em sessions/) e política de novas tentativas
+WEBHOOK_OUTBOX_ENABLED = os.environ.get("N8N_WEBHOOK_OUTBOX", "true").lower() in ("1", "true", "yes")
+WEBHOOK_OUTBOX_FLUSH_INTERVAL = float(os.environ.get("N8N_WEBHOOK_OUTBOX_FLUSH_INTERVAL", "0.02"))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("N8N_WEBHOOK_MAX_ATTEMPTS", "0")) # 0 = tentar até conseguir
+WEBHOOK_RETRY_BASE_DELAY = float(os.environ.get("N8N_WEBHOOK_RETRY_BASE_DELAY", "1"))
+WEBHOOK_RETRY_MAX_DELAY = float(os.environ.get("N8N_WEBHOOK_RETRY_MAX_DELAY", "300"))
+
+# Modo lote (opcional): até N eventos ou X ms por POST, enviados como um array JSON.
+# O padrão (1) mantém um POST por evento, no formato de n8n_workflow_example.json
+WEBHOOK_BATCH_MAX_EVENTS = int(os.environ.get("N8N_WEBHOOK_BATCH_MAX_EVENTS", "1"))
+WEBHOOK_BATCH_MAX_WAIT_MS = int(os.environ.get("N8N_WEBHOOK_BATCH_MAX_WAIT_MS", "500"))
+
+# Concorrência adaptativa (AIMD) e circuit breaker para proteger o N8N quando ele fica lento
+WEBHOOK_CONCURRENCY_INITIAL = int(os.environ.get("N8N_WEBHOOK_CONCURRENCY_INITIAL", "4"))
+WEBHOOK_CONCURRENCY_MIN = int(os.environ.get("N8N_WEBHOOK_CONCURRENCY_MIN", "1"))
+WEBHOOK_CONCURRENCY_MAX = int(os.environ.get("N8N_WEBHOOK_CONCURRENCY_MAX", str(WEBHOOK_POOL_SIZE)))
+WEBHOOK_LATENCY_TARGET_MS = int(os.environ.get("N8N_WEBHOOK_LATENCY_TARGET_MS", "1000"))
+WEBHOOK_BREAKER_THRESHOLD = int(os.environ.get("N8N_WEBHOOK_BREAKER_THRESHOLD", "5"))
+WEBHOOK_BREAKER_RESET_TIMEOUT = float(os.environ.get("N8N_WEBHOOK_BREAKER_RESET_TIMEOUT", "30"))
+
+# Roteamento para múltiplos endpoints: JSON inline ou caminho de um arquivo JSON (vazio = só o endpoint "default")
+WEBHOOK_ROUTES = os.environ.get("N8N_WEBHOOK_ROUTES", "")
+
+# Deduplicação por (chat_id, message_id): janela limitada por quantidade e por tempo (segundos)
+WEBHOOK_DEDUP_ENABLED = os.environ.get("N8N_WEBHOOK_DEDUP", "true").lower() in ("1", "true", "yes")
+WEBHOOK_DEDUP_SIZE = int(os.environ.get("N8N_WEBHOOK_DEDUP_SIZE", "10000"))
+WEBHOOK_DEDUP_TTL = float(os.environ.get("N8N_WEBHOOK_DEDUP_TTL", "86400"))
+WEBHOOK_DEDUP_PERSIST = os.environ.get("N8N_WEBHOOK_DEDUP_PERSIST", "true").lower() in ("1", "true", "yes")
+
+# Cache de usuários (get_user_info): tamanho máximo, validade (segundos) e validade das falhas
+USER_CACHE_SIZE = int(os.environ.get("TELEGRAM_USER_CACHE_SIZE", "5000"))
+USER_CACHE_TTL = float(os.environ.get("TELEGRAM_USER_CACHE_TTL", "3600"))
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get("TELEGRAM_USER_CACHE_NEGATIVE_TTL", "60"))
+
+# Cache de chats (título, tipo), usado quando o update não traz a entidade do chat
+CHAT_CACHE_SIZE = int(os.environ.get("TELEGRAM_CHAT_CACHE_SIZE", "2000"))
+CHAT_CACHE_TTL = float(os.environ.get("TELEGRAM_CHAT_CACHE_TTL", "3600"))
+
+# Perfis de usuários/chats persistidos ao lado da sessão e aquecidos com os diálogos recentes após o login
+PROFILE_STORE_ENABLED = os.environ.get("TELEGRAM_PROFILE_STORE", "true").lower() in ("1", "true", "yes")
+PROFILE_STORE_FLUSH_INTERVAL = float(os.environ.get("TELEGRAM_PROFILE_STORE_FLUSH_INTERVAL", "5"))
+PROFILE_PREWARM_DIALOGS = int(os.environ.get("TELEGRAM_PROFILE_PREWARM_DIALOGS", "200")) # 0 desativa
+
+# Índice de diálogos em memória (montado uma vez após o login e mantido pelos handlers), usado por /api/chats
+DIALOG_INDEX_ENABLED = os.environ.get("TELEGRAM_DIALOG_INDEX", "true").lower() in ("1", "true", "yes")
+
+# Chats "âncora" cujos IDs a UI e o N8N precisam, resolvidos pela busca: "nome=texto" separados por vírgula
+ANCHOR_CHATS = {
+    name.strip(): query.strip()
+    for name, query in (
+        pair.split("=", 1) for pair in os.environ.get("TELEGRAM_ANCHOR_CHATS", "reconquest_map=TheReconquestMap").split(",") if "=" in pair
+    )
+}
+
+# Entradas/saídas de um mesmo chat dentro desta janela viram um único evento users_joined/users_left
+CHAT_ACTION_WINDOW_MS = int(os.environ.get("N8N_CHAT_ACTION_WINDOW_MS", "1000")) # 0 = um evento por ação
+CHAT_ACTION_MAX_USERS = int(os.environ.get("N8N_CHAT_ACTION_MAX_USERS", "500"))
+
+# Limites de envio (mensagens por segundo): global da conta, por conversa privada e por grupo/canal.
+# FloodWaits de até TELEGRAM_SEND_MAX_FLOOD_WAIT segundos são esperados e o envio é repetido
+SEND_RATE = float(os.environ.get("TELEGRAM_SEND_RATE", "30"))
+SEND_BURST = int(os.environ.get("TELEGRAM_SEND_BURST", "30"))
+SEND_PEER_RATE = float(os.environ.get("TELEGRAM_SEND_PEER_RATE", "1"))
+SEND_GROUP_RATE = float(os.environ.get("TELEGRAM_SEND_GROUP_RATE", str(20 / 60)))
+SEND_PEER_BURST = int(os.environ.get("TELEGRAM_SEND_PEER_BURST", "3"))
+SEND_MAX_RETRIES = int(os.environ.get("TELEGRAM_SEND_MAX_RETRIES", "3"))
+SEND_MAX_FLOOD_WAIT = float(os.environ.get("TELEGRAM_SEND_MAX_FLOOD_WAIT", "300"))
+
+# Cache das mídias já enviadas por URL: reenvios da mesma URL não baixam nem sobem a imagem de novo
+MEDIA_CACHE_SIZE = int(os.environ.get("TELEGRAM_MEDIA_CACHE_SIZE", "1000"))
+MEDIA_CACHE_TTL = float(os.environ.get("TELEGRAM_MEDIA_CACHE_TTL", "3600"))
+
+# Mídias de URLs baixadas por este processo e enviadas ao Telegram em partes paralelas, durante o download.
+# Com "false" a URL é repassada ao Telegram, que baixa o arquivo por conta própria
+MEDIA_STREAM_UPLOAD = os.environ.get("TELEGRAM_MEDIA_STREAM_UPLOAD", "true").lower() in ("1", "true", "yes")
+MEDIA_UPLOAD_PARALLEL_PARTS = int(os.environ.get("TELEGRAM_MEDIA_UPLOAD_PARALLEL_PARTS", "4"))
+MEDIA_MAX_SIZE_MB = float(os.environ.get("TELEGRAM_MEDIA_MAX_SIZE_MB", "50"))
+MEDIA_DOWNLOAD_TIMEOUT = float(os.environ.get("TELEGRAM_MEDIA_DOWNLOAD_TIMEOUT", "120"))
+
+def match_anchor_chats(item, anchors):
+    """Preenche em `anchors` os chats âncora ainda não encontrados cujo texto aparece no nome do item"""
+    name = normalize_text(item["name"])
+    for anchor, query in ANCHOR_CHATS.items():
+        if anchors.get(anchor) is None and normalize_text(query) in name:
+            anchors[anchor] = item["id"]
+
+
 class TelegramSync:
     def __init__(self, session_name='telegram_session', api_id=None, api_hash=None):
         if not API_ID or not API_HASH:
@@ -64,6 +174,75 @@ class TelegramSync:
         # Manter o nome base original pode ser útil para logs ou referências internas
         self.session_name_base = base_session_name 
 
+        # Endpoints do webhook e regras de roteamento; cada endpoint tem pool, retry e fila próprios
+        routes = load_webhook_routes(WEBHOOK_ROUTES)
+        endpoint_options = routes.get("endpoints", {})
+        fallback = routes.get("fallback", ["default"])
+        used = set(fallback)
+        for rule in routes.get("rules", []):
+            targets = rule.get("endpoints") or []
+            used.update([targets] if isinstance(targets, str) else targets)
+        unknown = used - set(endpoint_options) - {"default"}
+        if unknown:
+            raise ValueError(f"Endpoints de webhook sem configuração: {', '.join(sorted(unknown))}")
+        self.webhook_router = WebhookRouter(
+            {name: self._build_webhook_endpoint(name, endpoint_options.get(name, {})) for name in sorted(used)},
+            rules=routes.get("rules", []),
+            fallback=fallback
+        )
+
+        # Janela de deduplicação dos eventos reentregues pelo Telethon (reconexões/reinícios)
+        self.webhook_dedup = None
+        if WEBHOOK_DEDUP_ENABLED:
+            self.webhook_dedup = DeliveryDeduplicator(
+                max_size=WEBHOOK_DEDUP_SIZE,
+                ttl=WEBHOOK_DEDUP_TTL,
+                path=f"{self.session_path_prefix}_webhook_dedup.db" if WEBHOOK_DEDUP_PERSIST else None
+            )
+
+        # Cache de informações de usuários, para não chamar get_entity a cada mensagem
+        self.user_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, negative_ttl=USER_CACHE_NEGATIVE_TTL)
+        self.chat_cache = TTLCache(max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL)
+
+        # Perfis persistidos: carregados nos caches ao configurar os handlers, gravados em segundo plano
+        self.profile_store = None
+        if PROFILE_STORE_ENABLED:
+            self.profile_store = ProfileStore(
+                f"{self.session_path_prefix}_profiles.db",
+                flush_interval=PROFILE_STORE_FLUSH_INTERVAL
+            )
+
+        # Índice de diálogos para /api/chats, montado em segundo plano após o login
+        self.dialog_index = DialogIndex()
+        self._dialog_sync_task = None
+
+        # Quantas vezes as entidades vieram no próprio update e quantas exigiram consulta à API
+        self.entity_stats = {
+            "sender_from_update": 0, "sender_fallback": 0,
+            "chat_from_update": 0, "chat_from_cache": 0, "chat_fallback": 0,
+            "peer_cached": 0, "peer_fallback": 0
+        }
+
+        # Entradas/saídas pendentes de envio, agrupadas por (chat_id, tipo)
+        self._chat_action_batches = {}
+
+        # Todo envio ao Telegram passa pelo agendador (limites de taxa e FloodWait)
+        self.send_scheduler = SendScheduler(
+            rate=SEND_RATE,
+            burst=SEND_BURST,
+            peer_rate=SEND_PEER_RATE,
+            group_rate=SEND_GROUP_RATE,
+            peer_burst=SEND_PEER_BURST,
+            max_retries=SEND_MAX_RETRIES,
+            max_flood_wait=SEND_MAX_FLOOD_WAIT
+        )
+        self.media_cache = MediaCache(max_size=MEDIA_CACHE_SIZE, ttl=MEDIA_CACHE_TTL)
+        self.media_uploader = MediaUploader(
+            parallel_parts=MEDIA_UPLOAD_PARALLEL_PARTS,
+            max_size=int(MEDIA_MAX_SIZE_MB * 1024 * 1024),
+            timeout=MEDIA_DOWNLOAD_TIMEOUT
+        ) if MEDIA_STREAM_UPLOAD else None
+
         logger.info(f"Inicializando TelegramClient com prefixo de caminho de sessão: {self.session_path_prefix}")
 
         # Adicionando parâmetros de sistema e versão para evitar o erro UPDATE_APP_TO_LOGIN
@@ -75,7 +254,10 @@ class TelegramSync:
             system_version="Windows 10",
             app_version="1.0.0",
             lang_code="pt-br",
-            system_lang_code="pt-br"
+            system_lang_code="pt-br",
+            # O Telethon não dorme em nenhum FloodWait: todos chegam ao agendador de envios, que espera
+            # e reduz o ritmo do chat. O resto (montagem do índice de diálogos) trata o erro onde é chamado
+            flood_sleep_threshold=0
         )
     
     def format_user_name(self, first_name, last_name):
@@ -84,43 +266,490 @@ class TelegramSync:
         last = last_name or ""
         return f"{first} {last}".strip()
         
+    def _user_to_info(self, user):
+        """Converte uma entidade de usuário do Telethon no dicionário usado nos payloads"""
+        return {
+            "id": user.id,
+            "first_name": getattr(user, 'first_name', ''),
+            "last_name": getattr(user, 'last_name', ''),
+            "username": getattr(user, 'username', '')
+        }
+
     async def get_user_info(self, user_id):
-        """Obtém informações do usuário pelo ID"""
+        """Obtém informações do usuário pelo ID (com cache; falhas ficam em cache por um tempo menor)"""
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return cached
         try:
             # Na versão 1.39.0 do Telethon, primeiro tentamos obter as informações do usuário diretamente
             try:
                 user = await self.client.get_entity(user_id)
-                return {
-                    "id": user.id,
-                    "first_name": getattr(user, 'first_name', ''),
-                    "last_name": getattr(user, 'last_name', ''),
-                    "username": getattr(user, 'username', '')
-                }
+                return self._remember_user(user)
             except Exception as e:
                 logger.error(f"Erro ao obter entidade do usuário {user_id}: {e}")
                 
                 # Fallback: tentar obter informações básicas
-                return {
+                info = {
                     "id": user_id,
                     "first_name": "",
                     "last_name": "",
                     "username": ""
                 }
+                self.user_cache.set(user_id, info, negative=True)
+                return info
         except Exception as e:
             logger.error(f"Erro ao obter informações do usuário {user_id}: {e}")
             return {"id": user_id}
-    
-    async def send_to_webhook(self, payload):
-        """Envia os dados para o webhook do N8N"""
+
+    def _known_input_user(self, user_id):
+        """InputUser a partir do access_hash já conhecido, sem requisição ao Telegram.
+
+        Procura no cache de entidades dos updates do Telethon (onde ficam os
+        usuários que vieram no próprio evento) e depois nas entidades da sessão.
+        """
+        entity_cache = getattr(self.client, "_mb_entity_cache", None)
+        entity = entity_cache.get(user_id) if entity_cache is not None else None
         try:
-            logger.info(f"Enviando mensagem para webhook: {json.dumps(payload, indent=2, ensure_ascii=False)}")
-            response = requests.post(WEBHOOK_URL, json=payload)
-            if response.status_code == 200:
-                logger.info(f"Webhook enviado com sucesso: {response.text}")
+            if entity is not None:
+                return get_input_user(entity._as_input_peer())
+            return get_input_user(self.client.session.get_input_entity(user_id))
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+    async def get_users_info(self, user_ids):
+        """Obtém informações de vários usuários com uma única requisição users.getUsers (até 200 por chamada).
+
+        Returns:
+            Dicionário user_id -> informações; usuários que não puderam ser resolvidos vêm só com o ID
+        """
+        infos = {}
+        input_users = []
+        for user_id in user_ids:
+            cached = self.user_cache.get(user_id)
+            if cached is not None:
+                infos[user_id] = cached
+                continue
+            input_user = self._known_input_user(user_id)
+            if input_user is not None:
+                input_users.append(input_user)
             else:
-                logger.error(f"Erro ao enviar webhook: {response.status_code} - {response.text}")
+                logger.warning(f"Usuário {user_id} sem access_hash conhecido; não entra na consulta em lote")
+        for i in range(0, len(input_users), 200):
+            try:
+                for user in await self.client(GetUsersRequest(input_users[i:i + 200])):
+                    infos[user.id] = self._remember_user(user)
+            except Exception as e:
+                logger.error(f"Erro ao obter informações de {len(input_users[i:i + 200])} usuários: {e}")
+        for user_id in user_ids:
+            if user_id not in infos:
+                infos[user_id] = {"id": user_id, "first_name": "", "last_name": "", "username": ""}
+                self.user_cache.set(user_id, infos[user_id], negative=True)
+        return {user_id: infos[user_id] for user_id in user_ids}
+
+    def _build_webhook_endpoint(self, name, options):
+        """Cria um endpoint do webhook, completando as opções ausentes com as variáveis de ambiente"""
+        url = options.get("url", WEBHOOK_URL if name == "default" else None)
+        if not url:
+            raise ValueError(f"Endpoint de webhook '{name}' sem URL configurada")
+        suffix = "" if name == "default" else f"_{name}"
+        pool_size = options.get("pool_size", WEBHOOK_POOL_SIZE)
+        outbox = None
+        if options.get("outbox", WEBHOOK_OUTBOX_ENABLED):
+            outbox = WebhookOutbox(
+                f"{self.session_path_prefix}_webhook_outbox{suffix}.db",
+                flush_interval=WEBHOOK_OUTBOX_FLUSH_INTERVAL
+            )
+        return WebhookEndpoint(
+            name,
+            url,
+            pool_size=pool_size,
+            timeout=options.get("timeout", WEBHOOK_TIMEOUT),
+            connect_timeout=options.get("connect_timeout", WEBHOOK_CONNECT_TIMEOUT),
+            gzip_min_bytes=options.get("gzip_min_bytes", WEBHOOK_GZIP_MIN_BYTES),
+            gzip_level=options.get("gzip_level", WEBHOOK_GZIP_LEVEL),
+            headers=options.get("headers"),
+            lanes=options.get("lanes", WEBHOOK_LANES),
+            lane_maxsize=options.get("lane_size", WEBHOOK_LANE_SIZE),
+            overflow_policy=options.get("overflow_policy", WEBHOOK_OVERFLOW_POLICY),
+            spill_path=f"{self.session_path_prefix}_webhook_spill{suffix}",
+            outbox=outbox,
+            max_attempts=options.get("max_attempts", WEBHOOK_MAX_ATTEMPTS),
+            retry_base_delay=options.get("retry_base_delay", WEBHOOK_RETRY_BASE_DELAY),
+            retry_max_delay=options.get("retry_max_delay", WEBHOOK_RETRY_MAX_DELAY),
+            batch_max_events=options.get("batch_max_events", WEBHOOK_BATCH_MAX_EVENTS),
+            batch_max_wait=options.get("batch_max_wait_ms", WEBHOOK_BATCH_MAX_WAIT_MS) / 1000,
+            limiter=AdaptiveConcurrencyLimiter(
+                initial=options.get("concurrency_initial", WEBHOOK_CONCURRENCY_INITIAL),
+                min_limit=options.get("concurrency_min", WEBHOOK_CONCURRENCY_MIN),
+                max_limit=options.get("concurrency_max", min(WEBHOOK_CONCURRENCY_MAX, pool_size)),
+                latency_target=options.get("latency_target_ms", WEBHOOK_LATENCY_TARGET_MS) / 1000
+            ),
+            breaker=CircuitBreaker(
+                failure_threshold=options.get("breaker_threshold", WEBHOOK_BREAKER_THRESHOLD),
+                reset_timeout=options.get("breaker_reset_timeout", WEBHOOK_BREAKER_RESET_TIMEOUT)
+            )
+        )
+
+    async def enqueue_webhook(self, payload):
+        """Roteia o payload para as filas de entrega dos endpoints sem esperar o N8N.
+
+        Eventos cuja `idempotency_key` já foi vista dentro da janela de
+        deduplicação são ignorados.
+        """
+        key = payload.get("idempotency_key")
+        dedup = self.webhook_dedup if key else None
+        if dedup is not None and dedup.check_and_add(key):
+            logger.info(f"Evento duplicado ignorado (idempotency_key: {key})")
+            return
+        try:
+            await self.webhook_router.put(payload)
+        except Exception:
+            if dedup is not None:
+                dedup.discard(key)
+            raise
+
+    def _remember_user(self, user):
+        """Converte a entidade do usuário e a registra no cache em memória e no cache persistente"""
+        info = self._user_to_info(user)
+        # Entidades "min" podem vir incompletas; não substituem o que está em cache
+        if isinstance(user, types.User) and not user.min:
+            self.user_cache.set(user.id, info)
+            if self.profile_store is not None:
+                self.profile_store.put("user", user.id, info)
+        return info
+
+    def remember_chat(self, chat):
+        """Converte a entidade do chat em {id, type, is_private, title, username} e a registra nos caches"""
+        if isinstance(chat, types.User):
+            chat_type = "user"
+            self._remember_user(chat)
+        elif getattr(chat, 'broadcast', False):
+            chat_type = "channel"
+        else:
+            chat_type = "group"
+        info = {
+            "id": get_peer_id(chat),
+            "type": chat_type,
+            "is_private": chat_type == "user",
+            "title": getattr(chat, 'title', None),
+            "username": getattr(chat, 'username', None)
+        }
+        self.chat_cache.set(info["id"], info)
+        if self.profile_store is not None and not getattr(chat, 'min', False):
+            self.profile_store.put("chat", info["id"], info)
+        return info
+
+    def invalidate_chat(self, chat_id):
+        """Remove o chat dos caches (ex.: título ou foto alterados)"""
+        invalidated = self.chat_cache.invalidate(chat_id)
+        if self.profile_store is not None:
+            self.profile_store.delete("chat", chat_id)
+        return invalidated
+
+    async def get_chat_info(self, chat_id):
+        """Informações do chat ({id, type, is_private, title, username}) pelo ID, consultando a API só fora do cache"""
+        cached = self.chat_cache.get(chat_id)
+        if cached is not None:
+            return cached
+        return self.remember_chat(await self.client.get_entity(chat_id))
+
+    async def _load_profiles(self):
+        """Abre o cache persistente e carrega os perfis salvos nos caches em memória"""
+        if self.profile_store is None:
+            return
+        try:
+            profiles = await self.profile_store.open()
+            now = time.time()
+            # Cada perfil entra só com o que resta do TTL desde a última confirmação: mudanças
+            # feitas enquanto o processo estava parado não chegam como update
+            for kind, cache in (("user", self.user_cache), ("chat", self.chat_cache)):
+                for profile_id, info in profiles.get(kind, {}).items():
+                    remaining = cache.ttl - (now - (self.profile_store.updated_at(kind, profile_id) or 0))
+                    if remaining > 0:
+                        cache.set(profile_id, info, ttl=remaining)
         except Exception as e:
-            logger.error(f"Erro ao enviar para webhook: {e}")
+            logger.error(f"Erro ao carregar o cache persistente de perfis: {e}", exc_info=True)
+
+    async def iter_recent_dialogs(self, since=None, until=None):
+        """Diálogos com atividade desde `since`, do mais recente ao mais antigo, em ordem estável entre páginas.
+
+        iter_dialogs lista os fixados primeiro, qualquer que seja a data; aqui eles
+        são intercalados pela data, para que um fixado antigo nunca sirva de
+        âncora de cursor à frente de diálogos mais recentes. Com `until`, só
+        entram diálogos com data até esse instante (inclusive, em segundos):
+        os de mesmo segundo que o cursor ficam para o DialogCursor desempatar.
+        """
+        def timestamp(dialog):
+            return int(dialog.date.timestamp())
+
+        def in_window(dialog):
+            return (dialog.date is not None and (since is None or dialog.date >= since)
+                    and (until is None or timestamp(dialog) <= int(until.timestamp())))
+
+        # Os fixados vêm todos no início da primeira página
+        pinned = []
+        async for dialog in self.client.iter_dialogs():
+            if not dialog.pinned:
+                break
+            if in_window(dialog):
+                pinned.append(dialog)
+        pinned.sort(key=timestamp, reverse=True)  # Estável: empates mantêm a ordem do Telegram
+
+        # offset_date é exclusivo: +1s inclui os diálogos do mesmo segundo que o cursor
+        offset_date = until + timedelta(seconds=1) if until is not None else None
+        async for dialog in self.client.iter_dialogs(offset_date=offset_date, ignore_pinned=True):
+            if dialog.date is None or (since is not None and dialog.date < since):
+                break
+            while pinned and timestamp(pinned[0]) >= timestamp(dialog):
+                yield pinned.pop(0)
+            yield dialog
+        for dialog in pinned:
+            yield dialog
+
+    async def find_anchor_chats(self, since=None, anchors=None):
+        """IDs dos chats âncora (TELEGRAM_ANCHOR_CHATS), independentes dos filtros e da paginação da listagem.
+
+        Com o índice de diálogos pronto, cada âncora é resolvida pela busca; sem
+        ele, os diálogos com atividade desde `since` são percorridos até achar
+        todas. `anchors` pode trazer as que a listagem em curso já encontrou.
+        """
+        anchors = dict.fromkeys(ANCHOR_CHATS) if anchors is None else anchors
+        missing = [name for name in ANCHOR_CHATS if anchors.get(name) is None]
+        if not missing:
+            return anchors
+        if self.dialog_index.ready:
+            for name in missing:
+                results = self.dialog_index.search.search(ANCHOR_CHATS[name], limit=1)
+                anchors[name] = results[0][1]["id"] if results else None
+            return anchors
+        async for dialog in self.iter_recent_dialogs(since):
+            match_anchor_chats(DialogIndex.describe(dialog.entity, dialog.name), anchors)
+            if all(anchors.get(name) is not None for name in ANCHOR_CHATS):
+                break
+        return anchors
+
+    async def _sync_dialogs(self, attempts=3):
+        """Percorre os diálogos uma vez após o login: monta o índice de diálogos e aquece os caches com os mais recentes"""
+        try:
+            dialogs = []
+            limit = None if DIALOG_INDEX_ENABLED else PROFILE_PREWARM_DIALOGS
+            async for dialog in self.client.iter_dialogs(limit=limit):
+                if len(dialogs) < PROFILE_PREWARM_DIALOGS:
+                    self.remember_chat(dialog.entity)
+                dialogs.append((dialog.id, dialog.date, DialogIndex.describe(dialog.entity, dialog.name)))
+            if DIALOG_INDEX_ENABLED:
+                self.dialog_index.build(dialogs)
+                # Contatos sem diálogo também entram na busca (uma única requisição)
+                contacts = await self.client(GetContactsRequest(hash=0))
+                for user in getattr(contacts, 'users', []):
+                    self.dialog_index.index_contact(user.id, user)
+                logger.info(f"Índice de diálogos montado com {len(dialogs)} diálogos ({len(self.dialog_index.search)} chats e contatos pesquisáveis)")
+            else:
+                logger.info(f"Caches aquecidos com {len(dialogs)} diálogos recentes")
+        except asyncio.CancelledError:
+            raise
+        except FLOOD_ERRORS as e:
+            if attempts <= 1 or e.seconds > SEND_MAX_FLOOD_WAIT:
+                logger.warning(f"Não foi possível percorrer os diálogos: o Telegram pediu {e.seconds}s de espera")
+                return
+            logger.warning(f"Telegram pediu {e.seconds}s de espera ao percorrer os diálogos; recomeçando após a espera.")
+            await asyncio.sleep(e.seconds)
+            await self._sync_dialogs(attempts - 1)
+        except Exception as e:
+            logger.warning(f"Não foi possível percorrer os diálogos para montar o índice/aquecer os caches: {e}")
+
+    def _start_dialog_sync(self):
+        if not DIALOG_INDEX_ENABLED and PROFILE_PREWARM_DIALOGS <= 0:
+            return
+        if self._dialog_sync_task is None or self._dialog_sync_task.done():
+            self._dialog_sync_task = asyncio.create_task(self._sync_dialogs(), name="dialog-sync")
+
+    async def _touch_dialog(self, chat_id, date, event):
+        """Registra atividade no chat no índice de diálogos, incluindo chats que ainda não estavam nele"""
+        if not DIALOG_INDEX_ENABLED:
+            return
+        try:
+            if self.dialog_index.touch(chat_id, date):
+                return
+            chat = event.chat or await event.get_chat()
+            if chat is not None:
+                self.dialog_index.upsert(chat_id, chat, date)
+        except Exception as e:
+            logger.warning(f"Não foi possível atualizar o índice de diálogos para o chat {chat_id}: {e}")
+
+    async def _resolve_event_sender(self, event):
+        """Remetente do evento: usa a entidade embutida no update e só consulta a API se ela faltar"""
+        sender = event.sender
+        if sender is not None:
+            self.entity_stats["sender_from_update"] += 1
+            return self._remember_user(sender)
+        self.entity_stats["sender_fallback"] += 1
+        return await self.get_user_info(event.sender_id)
+
+    async def _resolve_event_chat(self, event):
+        """Chat do evento ({id, type, is_private, title, username}): usa o cache de chats, depois a entidade
+        embutida no update, e só consulta a API se nenhum dos dois tiver o chat"""
+        cached = self.chat_cache.get(event.chat_id)
+        if cached is not None:
+            self.entity_stats["chat_from_cache"] += 1
+            return cached
+        chat = event.chat
+        if chat is not None:
+            self.entity_stats["chat_from_update"] += 1
+            return self.remember_chat(chat)
+        self.entity_stats["chat_fallback"] += 1
+        return self.remember_chat(await event.get_chat())
+
+    async def _build_message_payload(self, event, direction):
+        """Monta o payload de uma mensagem recebida ("incoming") ou enviada ("outgoing")"""
+        chat = await self._resolve_event_chat(event)
+        chat_id = event.chat_id
+        chat_title = chat.get('title') or 'Direct Message' # Título do grupo ou 'Direct Message'
+        is_private = event.is_private
+
+        if direction == "incoming":
+            sender = await self._resolve_event_sender(event)
+            user_id = str(sender.get("id", event.sender_id)) # Usar sender_id como fallback
+            user_name = self.format_user_name(sender.get('first_name'), sender.get('last_name'))
+            username = sender.get("username") or ""
+        else:
+            # Para mensagens enviadas, o destinatário é o chat
+            user_id = str(chat_id)
+            user_name = chat_title
+            username = ""
+            if is_private:
+                try:
+                    # Em chats privados o usuário do outro lado já entrou no cache junto com o chat
+                    peer_user_id = event.message.peer_id.user_id
+                    if peer_user_id in self.user_cache:
+                        self.entity_stats["peer_cached"] += 1
+                    else:
+                        self.entity_stats["peer_fallback"] += 1
+                    peer_user = await self.get_user_info(peer_user_id)
+                    user_name = self.format_user_name(peer_user.get('first_name'), peer_user.get('last_name'))
+                    username = peer_user.get("username", "")
+                    user_id = str(peer_user_id) # Usar o ID do peer
+                except Exception as e:
+                    logger.warning(f"Não foi possível obter detalhes do usuário para chat privado {chat_id}: {e}")
+
+        return {
+            "event_type": "new_message",
+            "user_id": user_id, # Remetente (recebidas) ou destinatário (enviadas)
+            "user_name": user_name,
+            "username": username,
+            "chat_id": str(chat_id),
+            "chat_name": chat_title,
+            "is_private": is_private,
+            "direction": direction,
+            "message_id": event.message.id,
+            "idempotency_key": f"{chat_id}:{event.message.id}",
+            "message": event.text,
+            "timestamp": datetime.now().isoformat()
+        }
+
+    async def _collect_chat_action(self, kind, chat_id, chat_title, user_ids, known_users, message_id):
+        """Acumula entradas/saídas de usuários de um chat para enviá-las num único evento.
+
+        Args:
+            kind: "joined" ou "left"
+            chat_id: ID do chat
+            chat_title: Título do chat
+            user_ids: IDs dos usuários envolvidos na ação
+            known_users: Informações dos usuários que já vieram no próprio update (sem requisição extra)
+            message_id: ID da mensagem de serviço da ação, se houver
+        """
+        # Ações reentregues pelo Telethon são descartadas antes de entrar no lote
+        if self.webhook_dedup is not None and message_id:
+            user_ids = [
+                user_id for user_id in user_ids
+                if not self.webhook_dedup.check_and_add(f"{chat_id}:{message_id}:{kind}:{user_id}")
+            ]
+        if not user_ids:
+            return
+
+        key = (chat_id, kind)
+        batch = self._chat_action_batches.get(key)
+        if batch is None:
+            batch = {"chat_name": chat_title, "user_ids": {}, "users": {}, "message_ids": [], "task": None}
+            self._chat_action_batches[key] = batch
+            if CHAT_ACTION_WINDOW_MS > 0:
+                batch["task"] = asyncio.create_task(self._flush_chat_action_later(key))
+        batch["user_ids"].update(dict.fromkeys(user_ids))  # Conjunto que preserva a ordem de chegada
+        batch["users"].update(known_users)
+        if message_id:
+            batch["message_ids"].append(message_id)
+
+        if CHAT_ACTION_WINDOW_MS <= 0 or len(batch["user_ids"]) >= CHAT_ACTION_MAX_USERS:
+            await self._flush_chat_action(key)
+
+    async def _flush_chat_action_later(self, key):
+        await asyncio.sleep(CHAT_ACTION_WINDOW_MS / 1000)
+        await self._flush_chat_action(key)
+
+    async def _flush_chat_action(self, key):
+        """Envia o lote de entradas/saídas acumulado para o chat, resolvendo os usuários faltantes de uma vez"""
+        batch = self._chat_action_batches.pop(key, None)
+        if batch is None:
+            return
+        task = batch["task"]
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+
+        chat_id, kind = key
+        try:
+            users = batch["users"]
+            missing = [user_id for user_id in batch["user_ids"] if user_id not in users]
+            if missing:
+                users.update(await self.get_users_info(missing))
+            user_list = [
+                {
+                    "id": str(users[user_id].get("id", user_id)),
+                    "first_name": users[user_id].get("first_name") or "",
+                    "last_name": users[user_id].get("last_name") or "",
+                    "username": users[user_id].get("username") or ""
+                }
+                for user_id in batch["user_ids"]
+            ]
+            logger.info(f"Enviando {len(user_list)} usuário(s) {'entrando' if kind == 'joined' else 'saindo'} do chat {batch['chat_name']} ({chat_id})")
+            payload = {
+                "event_type": f"users_{kind}",
+                "chat_id": str(chat_id),
+                "chat_name": batch["chat_name"],
+                "users": user_list,
+                "user_count": len(user_list),
+                "message_ids": batch["message_ids"],
+                "timestamp": datetime.now().isoformat()
+            }
+            await self.enqueue_webhook(payload)
+        except Exception as e:
+            logger.error(f"Erro ao enviar entradas/saídas do chat {chat_id}: {e}", exc_info=True)
+
+    async def close(self):
+        """Libera os recursos do webhook (filas de entrega, sessões HTTP e conexões dos pools) e grava os caches"""
+        if self._dialog_sync_task is not None:
+            self._dialog_sync_task.cancel()
+            await asyncio.gather(self._dialog_sync_task, return_exceptions=True)
+            self._dialog_sync_task = None
+        # Lotes de entradas/saídas ainda na janela de agrupamento são enviados antes de fechar a fila
+        for key in list(self._chat_action_batches):
+            await self._flush_chat_action(key)
+        try:
+            await self.webhook_router.close()
+        finally:
+            if self.webhook_dedup is not None:
+                await self.webhook_dedup.close()
+            if self.profile_store is not None:
+                await self.profile_store.close()
+            if self.media_uploader is not None:
+                await self.media_uploader.close()
+
+    async def disconnect(self):
+        """Desconecta o cliente do Telegram e fecha a sessão HTTP do webhook"""
+        try:
+            if self.client.is_connected():
+                await self.client.disconnect()
+        finally:
+            await self.close()
     
     async def send_message(self, chat_id, message):
         """Envia uma mensagem para um chat específico (usuário, grupo ou canal)
@@ -142,8 +771,10 @@ class TelegramSync:
             except ValueError:
                 pass  # Manter como string se não for um número válido
             
-            # Enviar a mensagem
-            sent_message = await self.client.send_message(chat_id, message)
+            # Enviar a mensagem respeitando os limites de envio
+            sent_message = await self.send_scheduler.run(
+                chat_id, lambda: self.client.send_message(chat_id, message)
+            )
             
             logger.info(f"Mensagem enviada com sucesso para {chat_id}")
             return sent_message
@@ -173,163 +804,181 @@ class TelegramSync:
             except ValueError:
                 pass  # Manter como string se não for um número válido
             
-            # Enviar a imagem
-            sent_message = await self.client.send_file(
-                entity=chat_id,
-                file=photo_url,
-                caption=caption,
-                parse_mode=parse_mode
-            )
+            sent_message = await self.send_media(chat_id, photo_url, caption, parse_mode)
             
             logger.info(f"Imagem enviada com sucesso para {chat_id}")
             return sent_message
         except Exception as e:
             logger.error(f"Erro ao enviar imagem para {chat_id}: {e}")
             raise e
+
+    async def send_media(self, entity, file, caption=None, parse_mode=None):
+        """Envia um arquivo (URL ou caminho) respeitando os limites de envio.
+
+        Uma URL já enviada antes é reenviada a partir da mídia em cache; se o
+        Telegram recusar a referência, o envio é refeito a partir da URL. URLs
+        novas são baixadas e enviadas ao Telegram em partes ao mesmo tempo.
+        """
+        def send(media):
+            return self.send_scheduler.run(entity, lambda: self.client.send_file(
+                entity, file=media, caption=caption, parse_mode=parse_mode
+            ))
+
+        cached = self.media_cache.get(file)
+        if cached is not None:
+            try:
+                return await send(cached)
+            except STALE_MEDIA_ERRORS as e:
+                logger.info(f"Mídia em cache de {file} recusada pelo Telegram ({e.__class__.__name__}); enviando da URL.")
+                self.media_cache.invalidate(file)
+        media = file
+        if self.media_uploader is not None and MediaCache.cacheable(file):
+            media = await self.media_uploader.upload(self.client, file)
+        sent_message = await send(media)
+        self.media_cache.remember(file, sent_message)
+        return sent_message
+
+    async def send_album(self, entity, files, captions=None, parse_mode=None):
+        """Envia várias fotos (até 10) como um único álbum, com legenda por item.
+
+        As mídias são preparadas ao mesmo tempo (cache, download e upload em
+        partes, registro no Telegram) e o álbum sai numa única requisição. Se
+        o Telegram recusar uma mídia em cache, ela é preparada de novo e o
+        álbum é reenviado uma vez.
+
+        Returns:
+            A lista de mensagens enviadas, na ordem dos arquivos
+        """
+        if len(files) == 1:
+            return [await self.send_media(entity, files[0], captions[0] if captions else None, parse_mode)]
+
+        async def send(retry):
+            from_cache = []
+            media = await asyncio.gather(*(self._album_media(entity, file, from_cache) for file in files))
+            try:
+                return await self.send_scheduler.run(entity, lambda: self.client.send_file(
+                    entity, list(media), caption=captions, parse_mode=parse_mode
+                ))
+            except STALE_MEDIA_ERRORS as e:
+                if not from_cache or not retry:
+                    raise
+                logger.info(f"Mídias em cache do álbum recusadas pelo Telegram ({e.__class__.__name__}); preparando de novo.")
+                for file in from_cache:
+                    self.media_cache.invalidate(file)
+                return await send(retry=False)
+
+        return await send(retry=True)
+
+    async def _album_media(self, entity, file, from_cache):
+        """Prepara um item do álbum: mídia em cache ou upload registrado com messages.uploadMedia"""
+        cached = self.media_cache.get(file)
+        if cached is not None:
+            from_cache.append(file)
+            return get_input_media(cached)
+
+        if MediaCache.cacheable(file) and self.media_uploader is None:
+            # O Telegram baixa a URL por conta própria
+            media = types.InputMediaPhotoExternal(file) if is_image(file) else types.InputMediaDocumentExternal(file)
+        else:
+            if MediaCache.cacheable(file):
+                handle = await self.media_uploader.upload(self.client, file)
+            else:
+                handle = await self.client.upload_file(file)
+            if is_image(handle):
+                media = types.InputMediaUploadedPhoto(handle)
+            else:
+                media = types.InputMediaUploadedDocument(
+                    handle,
+                    mime_type=mimetypes.guess_type(handle.name)[0] or "application/octet-stream",
+                    attributes=[types.DocumentAttributeFilename(handle.name)]
+                )
+        uploaded = await self.client(UploadMediaRequest(entity, media))
+        self.media_cache.remember(file, uploaded)
+        return get_input_media(uploaded)
     
     async def setup_handlers(self):
         """Configura os handlers para mensagens e ações no chat"""
 
         logger.info("Configurando handlers de eventos...")
 
+        # Workers de entrega precisam rodar no mesmo loop do Telethon
+        await self.webhook_router.start()
+        if self.webhook_dedup is not None:
+            await self.webhook_dedup.open()
+        await self._load_profiles()
+
         # Handler para mensagens recebidas
         @self.client.on(events.NewMessage(incoming=True))
         async def handle_incoming_message(event):
             try:
-                sender = await self.get_user_info(event.sender_id)
-                chat = await event.get_chat() # Obter informações do chat
-                chat_title = getattr(chat, 'title', 'Direct Message') # Título do grupo ou 'Direct Message'
-                is_private = event.is_private # Verificar se é mensagem privada
-
-                payload = {
-                    "event_type": "new_message", # Adicionar tipo de evento
-                    "user_id": str(sender.get("id", event.sender_id)), # Usar sender_id como fallback
-                    "user_name": self.format_user_name(sender.get('first_name'), sender.get('last_name')),
-                    "username": sender.get("username") or "",
-                    "chat_id": str(event.chat_id), # Adicionar ID do chat
-                    "chat_name": chat_title, # Adicionar nome do chat
-                    "is_private": is_private, # Indicar se é privada
-                    "direction": "incoming",
-                    "message": event.text,
-                    "timestamp": datetime.now().isoformat()
-                }
-                await self.send_to_webhook(payload)
+                payload = await self._build_message_payload(event, "incoming")
+                await self.enqueue_webhook(payload)
+                await self._touch_dialog(event.chat_id, event.message.date, event)
             except Exception as e:
                 logger.error(f"Erro ao processar mensagem recebida: {e}", exc_info=True)
 
         # Handler para mensagens enviadas
         @self.client.on(events.NewMessage(outgoing=True, forwards=False))
         async def handle_outgoing_message(event):
-             try:
-                # Para mensagens enviadas, o destinatário é o chat
-                chat = await event.get_chat()
-                chat_id = event.chat_id # Ou chat.id
-                chat_title = getattr(chat, 'title', 'Direct Message')
-                is_private = event.is_private
-
-                # Tentar obter info do destinatário se for privado
-                user_name = chat_title
-                username = ""
-                user_id = str(chat_id)
-                if is_private:
-                    try:
-                         # Usar get_peer_id para obter o ID do usuário do outro lado
-                         peer_user_id = event.message.peer_id.user_id 
-                         peer_user = await self.get_user_info(peer_user_id)
-                         user_name = self.format_user_name(peer_user.get('first_name'), peer_user.get('last_name'))
-                         username = peer_user.get("username", "")
-                         user_id = str(peer_user_id) # Usar o ID do peer
-                    except Exception as e:
-                         logger.warning(f"Não foi possível obter detalhes do usuário para chat privado {chat_id}: {e}")
-
-                payload = {
-                    "event_type": "new_message", # Adicionar tipo de evento
-                    "user_id": user_id, # ID do chat/usuário destinatário
-                    "user_name": user_name, # Nome do chat ou usuário
-                    "username": username, # Username se for usuário
-                    "chat_id": str(chat_id), # ID da conversa
-                    "chat_name": chat_title,
-                    "is_private": is_private,
-                    "direction": "outgoing",
-                    "message": event.text,
-                    "timestamp": datetime.now().isoformat()
-                }
-                await self.send_to_webhook(payload)
-             except Exception as e:
+            try:
+                payload = await self._build_message_payload(event, "outgoing")
+                await self.enqueue_webhook(payload)
+                await self._touch_dialog(event.chat_id, event.message.date, event)
+            except Exception as e:
                 logger.error(f"Erro ao processar mensagem enviada: {e}", exc_info=True)
 
+        # Mudanças de nome/username/perfil invalidam o cache do usuário
+        # (events.UserUpdate só traz status online e "digitando", então usamos os updates brutos)
+        @self.client.on(events.Raw(types=(types.UpdateUserName, types.UpdateUser)))
+        async def handle_user_profile_update(update):
+            invalidated = self.user_cache.invalidate(update.user_id)
+            invalidated = self.invalidate_chat(update.user_id) or invalidated
+            if self.profile_store is not None:
+                self.profile_store.delete("user", update.user_id)
+            if invalidated:
+                logger.info(f"Cache do usuário {update.user_id} invalidado após atualização de perfil")
 
-        # NOVO Handler para ações no chat (usuários entrando/saindo etc.)
+        # Handler para ações no chat (usuários entrando/saindo etc.)
         @self.client.on(events.ChatAction)
         async def handle_chat_action(event):
             try:
-                # Verificar especificamente se um usuário ENTROU
+                # Título ou foto alterados: o cache do chat é a única coisa a atualizar
+                if event.new_title or event.new_photo:
+                    self.invalidate_chat(event.chat_id)
+                    if event.chat is not None:
+                        self.dialog_index.refresh(event.chat_id, event.chat)
+                    logger.info(f"Cache do chat {event.chat_id} invalidado (título/foto alterados)")
+                    return
+
                 if event.user_joined or event.user_added:
-                    chat = await event.get_chat()
-                    chat_id = event.chat_id
-                    chat_title = getattr(chat, 'title', '(Chat Desconhecido)')
-
-                    joined_user_ids = event.user_ids
-                    if not joined_user_ids:
-                         if hasattr(event, 'user_id') and event.user_id:
-                              joined_user_ids = [event.user_id]
-                         else:
-                              logger.warning(f"Evento ChatAction (join/add) sem user_ids ou user_id no chat {chat_id}")
-                              return
-
-                    logger.info(f"Detectado usuário(s) entrando no chat: {chat_title} ({chat_id}). IDs: {joined_user_ids}")
-
-                    for user_id in joined_user_ids:
-                        user_info = await self.get_user_info(user_id)
-
-                        payload = {
-                            "event_type": "user_joined",
-                            "chat_id": str(chat_id),
-                            "chat_name": chat_title,
-                            "joined_user": {
-                                "id": str(user_info.get("id", user_id)),
-                                "first_name": user_info.get("first_name", ""),
-                                "last_name": user_info.get("last_name", ""),
-                                "username": user_info.get("username", "")
-                            },
-                            "timestamp": datetime.now().isoformat()
-                            # Opcional: adicionar quem adicionou
-                            # "added_by_user_id": str(event.added_by.id) if event.user_added and event.added_by else None
-                        }
-                        await self.send_to_webhook(payload)
-
-                # Exemplo: adicionar lógica para usuário saindo
+                    kind = "joined"
                 elif event.user_left or event.user_kicked:
-                    chat = await event.get_chat()
-                    chat_id = event.chat_id
-                    chat_title = getattr(chat, 'title', '(Chat Desconhecido)')
-                    
-                    left_user_ids = event.user_ids
-                    if not left_user_ids:
-                         if hasattr(event, 'user_id') and event.user_id:
-                              left_user_ids = [event.user_id]
-                         else:
-                              logger.warning(f"Evento ChatAction (left/kick) sem user_ids ou user_id no chat {chat_id}")
-                              return
-
-                    logger.info(f"Detectado usuário(s) saindo do chat: {chat_title} ({chat_id}). IDs: {left_user_ids}")
-
-                    for user_id in left_user_ids:
-                         user_info = await self.get_user_info(user_id) # Tentar obter info, pode falhar se já saiu
-                         payload = {
-                            "event_type": "user_left",
-                            "chat_id": str(chat_id),
-                            "chat_name": chat_title,
-                            "left_user": {
-                                "id": str(user_info.get("id", user_id)),
-                                "first_name": user_info.get("first_name", ""),
-                                "last_name": user_info.get("last_name", ""),
-                                "username": user_info.get("username", "")
-                            },
-                            "timestamp": datetime.now().isoformat()
-                            # "kicked_by_user_id": str(event.kicked_by.id) if event.user_kicked and event.kicked_by else None
-                        }
-                         await self.send_to_webhook(payload)
+                    kind = "left"
+                else:
+                    return
+
+                chat = await self._resolve_event_chat(event)
+                chat_id = event.chat_id
+                chat_title = chat.get('title') or '(Chat Desconhecido)'
+
+                user_ids = event.user_ids
+                if not user_ids:
+                    if hasattr(event, 'user_id') and event.user_id:
+                        user_ids = [event.user_id]
+                    else:
+                        logger.warning(f"Evento ChatAction ({kind}) sem user_ids ou user_id no chat {chat_id}")
+                        return
+
+                logger.info(f"Detectado usuário(s) {'entrando no' if kind == 'joined' else 'saindo do'} chat: {chat_title} ({chat_id}). IDs: {user_ids}")
+
+                # Usuários que já vieram no próprio update dispensam requisição à API
+                known_users = {user.id: self._remember_user(user) for user in event.users}
+                # Mensagem de serviço do evento (nem todo ChatAction tem uma, ex.: updates de participantes de canal)
+                message_id = event.action_message.id if event.action_message else None
+
+                await self._collect_chat_action(kind, chat_id, chat_title, user_ids, known_users, message_id)
+                if event.action_message is not None:
+                    await self._touch_dialog(chat_id, event.action_message.date, event)
 
             except Exception as e:
                 logger.error(f"Erro ao processar ChatAction: {e}", exc_info=True)
@@ -364,6 +1013,8 @@ class TelegramSync:
             if await self.client.is_user_authorized():
                 me = await self.client.get_me()
                 print(f"Conectado como: {me.first_name} (ID: {me.id})")
+                # Índice de diálogos e aquecimento dos caches em segundo plano, sem atrasar o processamento de updates
+                self._start_dialog_sync()
                 return True
             else:
                 print("Falha na autorização.")
@@ -380,7 +1031,6 @@ class TelegramSync:
             raise
 
 if __name__ == "__main__":
-    import asyncio
     import sys
     
     logger.info("Iniciando Telegram Sync...")
@@ -0,0 +1,116 @@
+import os
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "x")
+
+import main
+from telegram_cache import DialogIndex
+from telegram_sync import TelegramSync
+
+NOW = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def dialog(chat_id, name, minutes_ago, pinned=False):
+    entity = SimpleNamespace(id=chat_id)
+    return SimpleNamespace(id=chat_id, name=name, date=NOW - timedelta(minutes=minutes_ago), pinned=pinned, entity=entity)
+
+
+class FakeClient:
+    """iter_dialogs como o Telegram: fixados primeiro, depois do mais recente ao mais antigo antes de offset_date"""
+
+    def __init__(self, dialogs):
+        self.dialogs = dialogs
+
+    async def iter_dialogs(self, offset_date=None, ignore_pinned=False):
+        if not ignore_pinned and offset_date is None:
+            for item in self.dialogs:
+                if item.pinned:
+                    yield item
+        for item in sorted((d for d in self.dialogs if not d.pinned), key=lambda d: d.date, reverse=True):
+            if offset_date is None or item.date < offset_date:
+                yield item
+
+
+class FakeTelegramSync:
+    iter_recent_dialogs = TelegramSync.iter_recent_dialogs
+    find_anchor_chats = TelegramSync.find_anchor_chats
+
+    def __init__(self, dialogs):
+        self.client = FakeClient(dialogs)
+        self.dialog_index = DialogIndex()
+
+    def remember_chat(self, entity):
+        pass
+
+
+def list_pages(dialogs, limit, **filters):
+    main.telegram_client = FakeTelegramSync(dialogs)
+    pages, cursor = [], None
+
+    async def collect():
+        nonlocal cursor
+        while True:
+            page = {}
+            items = [item["id"] async for item in main.iter_chats(cursor=cursor, limit=limit, page=page, **filters)]
+            pages.append(items)
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    asyncio.run(collect())
+    return pages
+
+
+def test_fallback_pagination_with_old_pinned_dialog():
+    dialogs = [
+        dialog(1, "Fixado antigo", 600, pinned=True),
+        dialog(2, "A", 10), dialog(3, "B", 20), dialog(4, "C", 30), dialog(5, "D", 40),
+    ]
+    pages = list_pages(dialogs, limit=1)
+    assert [chat_id for page in pages for chat_id in page] == [2, 3, 4, 5, 1]
+
+
+def test_fallback_pagination_with_shared_timestamps():
+    dialogs = [
+        dialog(1, "Fixado", 30, pinned=True),
+        dialog(2, "A", 10), dialog(3, "B", 30), dialog(4, "C", 30), dialog(5, "D", 30), dialog(6, "E", 50),
+    ]
+    pages = list_pages(dialogs, limit=2)
+    flat = [chat_id for page in pages for chat_id in page]
+    assert sorted(flat) == [1, 2, 3, 4, 5, 6]
+    assert len(flat) == 6
+    assert all(len(page) <= 2 for page in pages)
+
+
+ANCHOR_DIALOGS = [
+    dialog(1, "Amigo", 5), dialog(2, "Canal de notícias", 10),
+    dialog(3, "TheReconquestMap Brasil", 20), dialog(4, "Família", 30),
+]
+
+
+def anchors_for(dialogs, index_ready, **filters):
+    telegram_client = main.telegram_client = FakeTelegramSync(dialogs)
+    if index_ready:
+        telegram_client.dialog_index.build([(d.id, d.date, DialogIndex.describe(d.entity, d.name)) for d in dialogs])
+
+    async def collect():
+        page = {}
+        items = [item["id"] async for item in main.iter_chats(page=page, **filters)]
+        return items, page["anchors"]
+
+    return asyncio.run(collect())
+
+
+def test_anchors_ignore_filters_and_pagination():
+    for index_ready in (False, True):
+        for filters in ({"query": "amigo"}, {"limit": 1}, {"types": {"user"}}, {"cursor": f"{int(NOW.timestamp())}:1", "limit": 1}):
+            _, anchors = anchors_for(ANCHOR_DIALOGS, index_ready, **filters)
+            assert anchors == {"reconquest_map": 3}, (index_ready, filters)
+
+
+def test_anchor_missing_is_none():
+    _, anchors = anchors_for(ANCHOR_DIALOGS[:2], index_ready=False)
+    assert anchors == {"reconquest_map": None}
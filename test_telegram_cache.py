@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import telegram_cache
+from telegram_cache import ChatSearchIndex, DialogCursor, DialogIndex, TTLCache, normalize_text
+
+
+def build_search(*names):
+    search = ChatSearchIndex()
+    for chat_id, name in enumerate(names, start=1):
+        search.add(chat_id, {"id": chat_id, "name": name, "type": "Chat"})
+    return search
+
+
+def found(search, query, **kwargs):
+    return [chat_id for chat_id, _ in search.search(query, **kwargs)]
+
+
+def test_normalize_text_removes_accents_and_case():
+    assert normalize_text("João Conceição") == "joao conceicao"
+
+
+def test_search_ignores_accents_and_ranks_prefix_before_substring():
+    search = build_search("Grupo do João", "Joana", "Jo")
+    assert found(search, "joao") == [1]
+    assert found(search, "JOÃO") == [1]
+    # Igual ao nome, depois começando com a consulta, depois palavra no meio do nome
+    assert found(search, "jo") == [3, 2, 1]
+
+
+def test_short_accented_query_matches_mid_word():
+    search = build_search("São Paulo", "Ônibus", "Maria")
+    assert found(search, "ão") == [1]
+    assert found(search, "ni") == [2]
+    assert found(search, "a") == [3, 1]
+
+
+def test_search_reindexes_and_removes():
+    search = build_search("Antigo nome")
+    search.add(1, {"id": 1, "name": "Novo nome", "type": "Chat"})
+    assert found(search, "antigo") == []
+    assert found(search, "novo") == [1]
+    search.remove(1)
+    assert found(search, "nome") == []
+    assert len(search) == 0
+
+
+def test_ttl_cache_negative_entries_expire_first(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(telegram_cache.time, "monotonic", lambda: clock[0])
+    cache = TTLCache(max_size=10, ttl=60.0, negative_ttl=5.0)
+    cache.set("found", {"id": 1})
+    cache.set("missing", None, negative=True)
+
+    assert cache.get("missing", "absent") is None
+    assert cache.get("found") == {"id": 1}
+    clock[0] += 6
+    # A falha expira com o TTL curto; o valor positivo continua valendo
+    assert cache.get("missing", "absent") == "absent"
+    assert "found" in cache
+    assert (cache.hits, cache.negative_hits, cache.misses) == (1, 1, 1)
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "b" not in cache and cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.evictions == 1
+    assert cache.invalidate("a") is True and cache.invalidate("a") is False
+
+
+BASE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class User:
+    def __init__(self, id, first_name):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = None
+        self.username = None
+
+
+def build_index(count):
+    index = DialogIndex()
+    index.build([(chat_id, BASE + timedelta(minutes=chat_id), {"id": chat_id, "name": f"Chat {chat_id}", "type": "Chat"})
+                 for chat_id in range(1, count + 1)])
+    return index
+
+
+def test_dialog_index_changes_bump_version_and_etag():
+    index = build_index(3)
+    etag = index.etag(10)
+    assert index.etag(10) == etag
+    assert index.etag(20) != etag
+
+    assert index.touch(1, BASE + timedelta(hours=1)) is True
+    assert index.touch(99) is False
+    assert [chat_id for chat_id, _, _ in index.recent()] == [1, 3, 2]
+    assert index.etag(10) != etag
+
+    version = index.version
+    index.refresh(2, User(2, "Renomeado"))
+    index.remove(3)
+    index.remove(3)
+    assert index.version == version + 2
+    # ETag de outro processo nunca coincide, mesmo com a mesma versão
+    other = build_index(3)
+    other.version = index.version
+    assert other.etag(10) != index.etag(10)
+
+
+def test_dialog_index_recent_stops_at_since():
+    index = build_index(5)
+    index.upsert(7, User(7, "Novo"), BASE + timedelta(hours=1))
+    assert [chat_id for chat_id, _, _ in index.recent(since=BASE + timedelta(minutes=4))] == [7, 5, 4]
+
+
+def test_dialog_cursor_pages_without_gaps_on_shared_timestamps():
+    index = DialogIndex()
+    # Três chats com a mesma data (em segundos) e um mais antigo
+    index.build([(chat_id, BASE, {"id": chat_id, "name": f"Chat {chat_id}", "type": "Chat"}) for chat_id in (1, 2, 3)]
+                + [(4, BASE - timedelta(days=1), {"id": 4, "name": "Antigo", "type": "User"})])
+
+    pages, cursor = [], None
+    while True:
+        items, cursor = index.query(cursor=cursor, limit=2)
+        pages.append([item["id"] for item in items])
+        if cursor is None:
+            break
+    assert pages == [[3, 2], [1, 4]]
+    assert index.query(types={"user"}, limit=2) == ([{"id": 4, "name": "Antigo", "type": "User"}], None)
+
+
+def test_dialog_cursor_encoding():
+    cursor = DialogCursor(DialogCursor.encode(42, BASE))
+    assert (cursor.chat_id, cursor.date) == (42, BASE)
+    assert DialogCursor.encode(5, None) == "0:5"
+    with pytest.raises(ValueError):
+        DialogCursor("abc")
@@ -0,0 +1,230 @@
+import asyncio
+import json
+
+import pytest
+from telethon.errors import FloodWaitError
+
+from telegram_outbound import JOB_FAILED, JOB_SUCCEEDED, IdempotencyCache, IdempotencyConflict, SendJobQueue, SendScheduler, TokenBucket
+
+
+def test_token_bucket_spaces_reservations():
+    bucket = TokenBucket(rate=10.0, burst=2)
+    delays = [bucket.reserve() for _ in range(4)]
+    assert delays[:2] == [0.0, 0.0]
+    assert delays[2] == pytest.approx(0.1, abs=0.01)
+    assert delays[3] == pytest.approx(0.2, abs=0.01)
+
+
+def test_token_bucket_penalty_blocks_and_slows_down():
+    bucket = TokenBucket(rate=4.0, burst=4)
+    bucket.penalize(5)
+    assert bucket.penalties == 1
+    assert bucket.rate == 2.0
+    assert bucket.reserve() == pytest.approx(5.5, abs=0.05)
+    for _ in range(30):
+        bucket.recover()
+    assert bucket.rate == 4.0
+
+
+def test_flood_wait_penalizes_peer_bucket():
+    async def scenario():
+        scheduler = SendScheduler(peer_rate=1.0, max_flood_wait=1)
+
+        async def send():
+            raise FloodWaitError(request=None, capture=5)
+
+        with pytest.raises(FloodWaitError):
+            await scheduler.run(12345, send)
+        bucket = scheduler._bucket(scheduler.peer_key(12345))
+        assert bucket.penalties == 1
+        assert bucket.rate == 0.5
+        assert bucket.stats()["blocked_for"] == pytest.approx(5, abs=0.2)
+        assert scheduler.global_bucket.rate < scheduler.global_bucket.base_rate
+        assert scheduler.stats()["flood_waits"] == 1
+        assert scheduler.stats()["gave_up"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_short_flood_wait_is_retried_by_the_scheduler():
+    async def scenario():
+        scheduler = SendScheduler(peer_rate=100.0, max_retries=2)
+        calls = []
+
+        async def send():
+            calls.append(1)
+            if len(calls) == 1:
+                raise FloodWaitError(request=None, capture=0)
+            return "ok"
+
+        assert await scheduler.run("@Alguem", send) == "ok"
+        assert len(calls) == 2
+        assert scheduler._bucket("alguem").penalties == 1
+        assert scheduler.stats()["sent"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_close_finishes_running_and_queued_jobs():
+    async def scenario():
+        jobs = SendJobQueue(workers=1, retention=60)
+        jobs.start()
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.Event().wait()
+
+        running = jobs.submit("message", 1, hang)
+        queued = jobs.submit("message", 1, hang)
+        await started.wait()
+        await jobs.close()
+
+        for job in (running, queued):
+            assert job.status == JOB_FAILED
+            assert job.finished_at is not None
+            assert job.to_dict()["finished_at"] is not None
+        assert queued.error == "Servidor encerrado antes do envio"
+        assert jobs.stats()["failed"] == 2
+        assert jobs.stats()["running"] == 0
+
+        # Terminados entram na retenção e são descartados depois dela
+        jobs.retention = 0
+        jobs._prune()
+        assert jobs.get(running.id) is None and jobs.get(queued.id) is None
+
+    asyncio.run(scenario())
+
+
+def test_idempotency_joins_pending_and_replays_result():
+    async def scenario():
+        cache = IdempotencyCache()
+        release = asyncio.Event()
+        calls = []
+
+        async def send():
+            calls.append(1)
+            await release.wait()
+            return {"message_id": 10}
+
+        first = asyncio.create_task(cache.run("k", "a", send))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.run("k", "a", send))
+        await asyncio.sleep(0)
+        with pytest.raises(IdempotencyConflict):
+            await cache.run("k", "b", send)
+        release.set()
+
+        assert await first == ({"message_id": 10}, False)
+        assert await second == ({"message_id": 10}, True)
+        assert await cache.run("k", "a", send) == ({"message_id": 10}, True)
+        assert len(calls) == 1
+        assert cache.stats()["joined"] == 1 and cache.stats()["replayed"] == 1
+
+        # Resultado que deixou de valer (ex.: job que falhou) executa de novo
+        assert await cache.run("k", "a", send, is_valid=lambda result: False) == ({"message_id": 10}, False)
+        assert len(calls) == 2 and cache.stats()["expired"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_idempotency_does_not_keep_failures():
+    async def scenario():
+        cache = IdempotencyCache()
+        outcomes = [RuntimeError("falhou"), 7]
+
+        async def send():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        with pytest.raises(RuntimeError):
+            await cache.run("k", "a", send)
+        assert await cache.run("k", "a", send) == (7, False)
+
+    asyncio.run(scenario())
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    """Sessão HTTP falsa que responde aos callbacks com os status informados, em ordem"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.posts = []
+
+    def post(self, url, data=None, headers=None):
+        self.posts.append((url, json.loads(data)))
+        return FakeResponse(self.statuses.pop(0))
+
+    async def close(self):
+        pass
+
+
+def test_jobs_report_results_and_post_callbacks(monkeypatch):
+    real_sleep = asyncio.sleep
+
+    async def fast_sleep(delay, *args):
+        await real_sleep(0)
+
+    async def scenario():
+        jobs = SendJobQueue(workers=2, callback_attempts=2)
+        jobs._session = session = FakeSession(200, 503, 200)
+        monkeypatch.setattr(asyncio, "sleep", fast_sleep)
+        jobs.start()
+
+        async def send():
+            return 123
+
+        async def fail():
+            raise RuntimeError("chat não encontrado")
+
+        ok = jobs.submit("message", 1, send, callback_url="http://n8n.local/ok")
+        failed = jobs.submit("message", 2, fail, callback_url="http://n8n.local/fail")
+        await jobs._queue.join()
+        await jobs.close()
+
+        assert (ok.status, ok.message_id) == (JOB_SUCCEEDED, 123)
+        assert (failed.status, failed.error) == (JOB_FAILED, "chat não encontrado")
+        bodies = {url: body for url, body in session.posts}
+        assert bodies["http://n8n.local/ok"]["message_id"] == 123
+        assert bodies["http://n8n.local/fail"]["status"] == JOB_FAILED
+        # O callback que recebeu 503 foi tentado de novo
+        assert len(session.posts) == 3
+        assert jobs.stats()["callbacks_sent"] == 2 and jobs.stats()["callbacks_failed"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_finished_jobs_are_pruned_by_retention_and_max_jobs():
+    async def scenario():
+        jobs = SendJobQueue(workers=1, retention=60, max_jobs=2)
+        jobs.start()
+
+        async def send():
+            return 1
+
+        done = [jobs.submit("message", 1, send) for _ in range(3)]
+        await jobs._queue.join()
+        jobs.submit("message", 1, send)
+        # Só os `max_jobs` mais recentes entre os terminados continuam consultáveis
+        assert jobs.get(done[0].id) is None and jobs.get(done[1].id) is None
+        assert jobs.get(done[2].id) is done[2]
+
+        done[2].finished_at -= 120
+        jobs._prune()
+        assert jobs.get(done[2].id) is None
+        await jobs.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import os
+import asyncio
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "x")
+
+from telethon.tl import types
+
+from telegram_sync import TelegramSync
+
+
+@pytest.fixture(autouse=True)
+def session_dir(tmp_path, monkeypatch):
+    # A sessão do Telethon e os bancos auxiliares são criados no diretório atual
+    monkeypatch.chdir(tmp_path)
+
+
+def run_with_sync(scenario):
+    """Executa scenario(telegram_sync) num loop novo (o TelegramClient precisa ser criado dentro dele)"""
+    async def main():
+        telegram_sync = TelegramSync("teste")
+        try:
+            return await scenario(telegram_sync)
+        finally:
+            await telegram_sync.close()
+    return asyncio.run(main())
+
+
+def test_client_leaves_flood_waits_to_the_scheduler():
+    async def scenario(telegram_sync):
+        assert telegram_sync.client.flood_sleep_threshold == 0
+
+    run_with_sync(scenario)
+
+
+def test_get_users_info_uses_one_bulk_request_without_resolving_ids():
+    async def scenario(telegram_sync):
+        client = telegram_sync.client
+        # 11 veio num update (cache de entidades do Telethon), 12 está na sessão, 13 é desconhecido
+        client._mb_entity_cache.extend([types.User(id=11, access_hash=111)], [])
+        client.session.process_entities(types.contacts.Contacts(contacts=[], saved_count=0, users=[types.User(id=12, access_hash=122)]))
+        telegram_sync.user_cache.set(14, {"id": 14, "first_name": "Em cache"})
+
+        requests = []
+
+        class CountingClient(type(client)):
+            async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+                requests.append(request)
+                return [types.User(id=user.user_id, access_hash=user.access_hash, first_name=f"U{user.user_id}") for user in request.id]
+
+        async def no_network(*args, **kwargs):
+            raise AssertionError("resolução de entidade pela rede")
+
+        client.__class__ = CountingClient
+        client.get_input_entity = client.get_entity = no_network
+
+        infos = await telegram_sync.get_users_info([11, 12, 13, 14])
+        assert len(requests) == 1
+        assert [(user.user_id, user.access_hash) for user in requests[0].id] == [(11, 111), (12, 122)]
+        assert infos[11]["first_name"] == "U11"
+        assert infos[12]["first_name"] == "U12"
+        assert infos[13]["first_name"] == ""
+        assert infos[14]["first_name"] == "Em cache"
+
+    run_with_sync(scenario)
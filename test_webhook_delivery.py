@@ -0,0 +1,237 @@
+import asyncio
+import itertools
+
+import aiohttp
+import pytest
+
+import webhook_delivery
+from webhook_delivery import (OVERFLOW_BLOCK, AdaptiveConcurrencyLimiter, CircuitBreaker, DeliveryDeduplicator, OutboxEntry,
+                              WebhookEndpoint, WebhookOutbox, WebhookQueue, WebhookRouter)
+
+
+def chats_on_distinct_lanes(queue):
+    """Dois chat_ids que caem em lanes diferentes"""
+    first = queue.lane_for({"chat_id": 0})
+    other = next(chat_id for chat_id in range(1, 100) if queue.lane_for({"chat_id": chat_id}) is not first)
+    return 0, other
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condição não atingida a tempo")
+        await asyncio.sleep(0.01)
+
+
+def test_breaker_open_does_not_stall_idle_lane(tmp_path):
+    async def scenario():
+        n8n_up = False
+        delivered = []
+
+        async def send(payload, body):
+            if not n8n_up:
+                return 503
+            delivered.append(payload["n"])
+            return 200
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        queue = WebhookQueue(send, lanes=2, outbox=WebhookOutbox(str(tmp_path / "outbox.db")), breaker=breaker,
+                             retry_base_delay=0.01, retry_max_delay=0.01)
+        chat_a, chat_b = chats_on_distinct_lanes(queue)
+        await queue.start()
+        try:
+            await queue.put({"chat_id": chat_a, "n": 1})
+            await wait_for(lambda: breaker.is_open)
+
+            # Evento de outra lane (ociosa) chega com o circuito aberto
+            await queue.put({"chat_id": chat_b, "n": 2})
+            n8n_up = True
+            await wait_for(lambda: len(delivered) == 2)
+
+            await queue.put({"chat_id": chat_b, "n": 3})
+            await wait_for(lambda: len(delivered) == 3)
+            assert queue.stats()["backlog"] == 0
+        finally:
+            await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_refill_keeps_order_with_events_arriving_meanwhile(tmp_path):
+    async def scenario():
+        release = asyncio.Event()
+        delivered = []
+
+        async def send(payload, body):
+            await release.wait()
+            delivered.append(payload["n"])
+            return 200
+
+        outbox = WebhookOutbox(str(tmp_path / "outbox.db"))
+        queue = WebhookQueue(send, lanes=1, lane_maxsize=2, outbox=outbox)
+        await queue.start()
+        try:
+            # 1 em entrega, 2 na lane e o resto estacionado no outbox
+            for n in range(8):
+                await queue.put({"chat_id": 1, "n": n})
+
+            # Eventos novos chegam enquanto a lane recarrega os últimos estacionados
+            lane = queue.lane_for({"chat_id": 1})
+            load = outbox.load
+            arrivals = iter(range(8, 14))
+
+            async def load_while_receiving(ids):
+                entries = await load(ids)
+                if not lane.parked or ids[-1] == lane.parked[-1]:
+                    for n in itertools.islice(arrivals, 3):
+                        await queue.put({"chat_id": 1, "n": n})
+                return entries
+
+            outbox.load = load_while_receiving
+            release.set()
+            await wait_for(lambda: queue.stats()["backlog"] == 0 and queue.stats()["depth"] == 0 and len(delivered) >= 14)
+            assert delivered == list(range(14))
+        finally:
+            await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_dedup_discard_survives_restart(tmp_path):
+    path = str(tmp_path / "dedup.db")
+
+    async def first_run():
+        dedup = DeliveryDeduplicator(path=path, flush_interval=60)
+        await dedup.open()
+        assert not dedup.check_and_add("1:10")
+        await dedup.flush()  # 1:10 já está no disco
+        assert not dedup.check_and_add("1:11")  # 1:11 ainda aguarda gravação
+        assert not dedup.check_and_add("1:12")
+        dedup.discard("1:10")
+        dedup.discard("1:11")
+        await dedup.close()
+
+    async def second_run():
+        dedup = DeliveryDeduplicator(path=path, flush_interval=60)
+        await dedup.open()
+        try:
+            assert not dedup.check_and_add("1:10")
+            assert not dedup.check_and_add("1:11")
+            assert dedup.check_and_add("1:12")
+        finally:
+            await dedup.close()
+
+    asyncio.run(first_run())
+    asyncio.run(second_run())
+
+
+def test_stale_transport_failure_does_not_reopen_breaker():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        gates = []
+
+        async def send(payload, body):
+            gate = loop.create_future()
+            gates.append(gate)
+            return await gate
+
+        limiter = AdaptiveConcurrencyLimiter(initial=4, max_limit=4)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+        queue = WebhookQueue(send, overflow_policy=OVERFLOW_BLOCK, limiter=limiter, breaker=breaker)
+
+        slow = asyncio.create_task(queue._send([OutboxEntry({"n": 1})]))
+        fast = asyncio.create_task(queue._send([OutboxEntry({"n": 2})]))
+        await wait_for(lambda: len(gates) == 2)
+        gates[1].set_result(503)
+        await fast
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # O teste do meio-aberto fica em andamento enquanto o envio antigo falha no transporte
+        probe = asyncio.create_task(queue._send([OutboxEntry({"n": 3})]))
+        await wait_for(lambda: len(gates) == 3)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        limit_before = limiter.limit
+        gates[0].set_exception(aiohttp.ClientConnectionError("conexão recusada"))
+        with pytest.raises(aiohttp.ClientConnectionError):
+            await slow
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.stats()["stale_failures"] == 1
+        assert limiter.limit < limit_before
+
+        gates[2].set_result(200)
+        await probe
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def make_router(rules, fallback=("default",)):
+    endpoints = {name: WebhookEndpoint(name, f"http://n8n.local/{name}", overflow_policy=OVERFLOW_BLOCK)
+                 for name in ("default", "incoming", "private", "vip")}
+    return WebhookRouter(endpoints, rules, fallback=fallback)
+
+
+def routed(router, **payload):
+    return [endpoint.name for endpoint in router.route(payload)]
+
+
+def test_router_expands_wildcards_and_merges_matches():
+    router = make_router([
+        {"event_type": "new_message", "direction": "incoming", "endpoints": "incoming"},
+        {"is_private": True, "endpoints": ["private"]},
+        {"chat_ids": [42], "event_type": ["new_message", "message_edited"], "endpoints": ["vip", "incoming"]},
+    ])
+    assert routed(router, event_type="new_message", direction="incoming", is_private=False, chat_id=1) == ["incoming"]
+    assert routed(router, event_type="message_deleted", direction="outgoing", is_private=True, chat_id=1) == ["private"]
+    # Várias regras casando: cada endpoint aparece uma vez, na ordem em que foi declarado
+    assert routed(router, event_type="message_edited", direction="incoming", is_private=True, chat_id=42) == ["incoming", "private", "vip"]
+    assert routed(router, event_type="new_message", direction="outgoing", is_private=False, chat_id=7) == ["default"]
+
+
+def test_router_fallback_and_invalid_rules():
+    router = make_router([{"event_type": "new_message", "endpoints": "incoming"}], fallback=())
+    assert routed(router, event_type="chat_action", chat_id=1) == []
+    with pytest.raises(ValueError):
+        make_router([{"event_type": "new_message", "endpoints": "missing"}])
+    with pytest.raises(ValueError):
+        make_router([], fallback=("missing",))
+
+
+def test_dedup_window_is_bounded_by_size_and_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(webhook_delivery.time, "time", lambda: clock[0])
+    dedup = DeliveryDeduplicator(max_size=2, ttl=60.0)
+
+    assert dedup.check_and_add("a") is False
+    assert dedup.check_and_add("a") is True
+    dedup.check_and_add("b")
+    dedup.check_and_add("c")
+    # "a" era a chave mais antiga e saiu quando a janela passou de 2
+    assert dedup.check_and_add("a") is False
+
+    clock[0] += 61
+    assert dedup.check_and_add("c") is False
+    assert (dedup.hits, dedup.misses) == (1, 5)
+
+
+def test_dedup_keys_are_reloaded_after_restart(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "dedup.db")
+        dedup = DeliveryDeduplicator(max_size=2, path=path)
+        await dedup.open()
+        for key in ("a", "b", "c"):
+            dedup.check_and_add(key)
+        await dedup.close()
+
+        restarted = DeliveryDeduplicator(max_size=2, path=path)
+        await restarted.open()
+        try:
+            assert restarted.check_and_add("c") is True
+            assert restarted.check_and_add("b") is True
+            # Fora da janela de tamanho também no disco
+            assert restarted.check_and_add("a") is False
+        finally:
+            await restarted.close()
+
+    asyncio.run(scenario())
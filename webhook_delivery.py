@@ -0,0 +1,1337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Entrega de eventos para o webhook do N8N.
+Os handlers do Telethon apenas enfileiram os payloads; workers por lane
+drenam a fila e fazem o envio, de modo que a latência do N8N não atrase o
+processamento de updates do Telegram. Opcionalmente cada payload é gravado
+num outbox SQLite antes da entrega, para sobreviver a falhas do N8N e a
+reinícios do processo.
+"""
+
+import os
+import gzip
+import json
+import time
+import zlib
+import uuid
+import random
+import sqlite3
+import asyncio
+import logging
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+# orjson é opcional: serializa bem mais rápido que o json da biblioteca padrão
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Políticas de overflow quando a fila em memória está cheia
+OVERFLOW_BLOCK = "block"              # O handler espera até haver espaço
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # Descarta o evento mais antigo da fila
+OVERFLOW_SPILL = "spill"              # Mantém o excedente em disco e reinjeta depois
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL)
+
+
+def encode_json(obj):
+    """Serializa em JSON compacto (UTF-8), usando orjson quando disponível"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_batch(entries):
+    """Monta o array JSON de um lote reaproveitando o corpo já serializado de cada entrada.
+
+    O `delivery_id` é inserido como primeiro campo de cada objeto, sem
+    serializar o payload de novo.
+    """
+    items = []
+    for entry in entries:
+        body = entry.body
+        prefix = b'{"delivery_id":' + encode_json(entry.delivery_id)
+        items.append(prefix + (b"," + body[1:] if body != b"{}" else b"}"))
+    return b"[" + b",".join(items) + b"]"
+
+
+def is_success_status(status):
+    """Status HTTP 2xx"""
+    return status is not None and 200 <= status < 300
+
+
+def is_retryable_status(status):
+    """Falhas de rede, timeouts, 408, 429 e 5xx valem nova tentativa; outros 4xx não"""
+    return status is None or status in (408, 429) or status >= 500
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Backoff exponencial com jitter completo para a tentativa informada (1, 2, ...)"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+
+
+def parse_batch_failures(response_text):
+    """Extrai os delivery_id que falharam da resposta do N8N a um lote.
+
+    Aceita {"failed": ["id", ...]} ou uma lista de resultados no formato
+    [{"delivery_id": "id", "ok": false}, ...]. Qualquer outra resposta 2xx
+    significa que o lote inteiro foi aceito.
+    """
+    try:
+        data = json.loads(response_text) if response_text else None
+    except ValueError:
+        return set()
+    if isinstance(data, dict) and isinstance(data.get("failed"), list):
+        return {str(item) for item in data["failed"]}
+    if isinstance(data, dict) and isinstance(data.get("results"), list):
+        data = data["results"]
+    if isinstance(data, list):
+        return {
+            str(item["delivery_id"]) for item in data
+            if isinstance(item, dict) and "delivery_id" in item and item.get("ok") is False
+        }
+    return set()
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limite de envios simultâneos ao N8N ajustado por AIMD.
+
+    Respostas 2xx rápidas (abaixo de `latency_target`) aumentam o limite
+    aditivamente (~+1 a cada `limit` sucessos); timeouts, 429 e 5xx o reduzem
+    multiplicativamente. Respostas 2xx lentas mantêm o limite como está.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=10, latency_target=1.0, decrease_factor=0.5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_flight = 0
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        # Acorda tantos envios quantos couberem no limite atual
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def on_success(self, latency):
+        if latency <= self.latency_target:
+            self.limit = min(self.max_limit, self.limit + 1 / int(self.limit))
+            self._wake()
+
+    def on_overload(self):
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+        }
+
+
+class CircuitBreaker:
+    """Circuit breaker para o endpoint do webhook.
+
+    Abre após `failure_threshold` falhas seguidas; depois de `reset_timeout`
+    segundos passa a meio-aberto e libera um único envio de teste. Se o teste
+    der certo o circuito fecha, senão volta a abrir. Cada mudança de estado
+    avança `epoch`; falhas de envios iniciados numa época anterior são ignoradas.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self._probe_in_flight = False
+        self._changed = None
+        self.epoch = 0
+        self.stale_failures = 0
+
+    @property
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def _allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.epoch += 1
+            logger.info("Circuit breaker do webhook meio-aberto: enviando evento de teste.")
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    async def wait_until_allowed(self):
+        """Espera até o circuito permitir um envio (fechado ou teste no meio-aberto)"""
+        while not self._allow():
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            timeout = 1.0
+            if self.state == self.OPEN:
+                timeout = max(0.01, self.reset_timeout - (time.monotonic() - self.opened_at))
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit breaker do webhook fechado: N8N respondendo novamente.")
+            self.epoch += 1
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        self._notify()
+
+    def record_failure(self, epoch=None):
+        """Registra uma falha; `epoch` é a época em que o envio começou"""
+        if epoch is not None and epoch != self.epoch:
+            # Envio anterior à última mudança de estado: o circuito já reagiu a esse período
+            self.stale_failures += 1
+            return
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            self.epoch += 1
+            logger.warning(f"Circuit breaker do webhook aberto após {self.consecutive_failures} falhas seguidas. Novo teste em {self.reset_timeout:g}s.")
+        self._probe_in_flight = False
+        self._notify()
+
+    def cancel_probe(self):
+        """Libera o teste do meio-aberto quando o envio foi cancelado sem resultado"""
+        self._probe_in_flight = False
+        self._notify()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_timeout": self.reset_timeout,
+            "times_opened": self.times_opened,
+            "stale_failures": self.stale_failures,
+        }
+
+
+class OutboxEntry:
+    """Payload em trânsito, com seu corpo JSON já serializado, o ID no outbox e as tentativas já feitas"""
+    __slots__ = ("id", "payload", "body", "attempts", "persisted", "delivery_id")
+
+    def __init__(self, payload, body=None, id=None, attempts=0, persisted=None):
+        self.id = id
+        self.payload = payload
+        self.body = body if body is not None else encode_json(payload)
+        self.attempts = attempts
+        self.persisted = persisted
+        # Identificador do item dentro de um lote, para correlacionar falhas parciais
+        self.delivery_id = str(id) if id is not None else uuid.uuid4().hex
+
+
+class WebhookOutbox:
+    """Outbox durável em SQLite (modo WAL) para os payloads do webhook.
+
+    As escritas são acumuladas em memória e gravadas em uma única transação
+    a cada `flush_interval` segundos (ou ao atingir `batch_size` operações),
+    amortizando o custo de fsync. Todo o acesso ao banco acontece numa única
+    thread dedicada para não bloquear o loop do Telethon.
+    """
+
+    def __init__(self, path, flush_interval=0.02, batch_size=500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._executor = None
+        self._conn = None
+        self._next_id = 1
+        self._ops = []             # Operações pendentes: (sql, params)
+        self._batch_future = None  # Resolvido quando as operações pendentes forem gravadas
+        self._wakeup = None
+        self._flusher_task = None
+
+        self.commits = 0
+        self.written = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open_sync(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_error TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+        conn.commit()
+        self._conn = conn
+        row = conn.execute("SELECT COALESCE(MAX(id), 0) FROM outbox").fetchone()
+        pending = conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()
+        return row[0], pending[0]
+
+    async def open(self):
+        """Abre o banco e inicia a tarefa de gravação em lote. Retorna o total de pendentes"""
+        if self._flusher_task and not self._flusher_task.done():
+            return 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook-outbox")
+        max_id, pending = await self._run(self._open_sync)
+        self._next_id = max_id + 1
+        self._wakeup = asyncio.Event()
+        self._flusher_task = asyncio.create_task(self._flusher(), name="webhook-outbox-flusher")
+        if pending:
+            logger.info(f"Outbox do webhook: {pending} eventos pendentes serão reenviados ({self.path})")
+        return pending
+
+    def add(self, payload, body=None):
+        """Registra o payload para gravação e devolve a entrada (gravação confirmada em entry.persisted)"""
+        entry = OutboxEntry(payload, body, id=self._next_id)
+        self._next_id += 1
+        now = time.time()
+        self._enqueue_op(
+            "INSERT INTO outbox (id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (entry.id, entry.body, now, now)
+        )
+        entry.persisted = self._batch_future
+        return entry
+
+    def mark_done(self, entry_id):
+        self._enqueue_op("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def mark_attempt(self, entry_id, attempts, error=None):
+        self._enqueue_op(
+            "UPDATE outbox SET attempts = ?, last_error = ? WHERE id = ?",
+            (attempts, error, entry_id)
+        )
+
+    def mark_dead(self, entry_id, attempts, error=None):
+        self._enqueue_op(
+            "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+            (attempts, error, entry_id)
+        )
+
+    def _enqueue_op(self, sql, params):
+        if self._batch_future is None:
+            self._batch_future = asyncio.get_running_loop().create_future()
+        self._ops.append((sql, params))
+        if len(self._ops) == 1 or len(self._ops) >= self.batch_size:
+            self._wakeup.set()
+
+    def _commit_sync(self, ops):
+        with self._conn:
+            for sql, params in ops:
+                self._conn.execute(sql, params)
+
+    async def _flusher(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self._ops) < self.batch_size:
+                # Espera curta para agrupar mais operações na mesma transação
+                await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Grava imediatamente todas as operações pendentes numa única transação"""
+        if not self._ops:
+            return
+        ops, future = self._ops, self._batch_future
+        self._ops, self._batch_future = [], None
+        try:
+            await self._run(self._commit_sync, ops)
+            self.commits += 1
+            self.written += len(ops)
+            if not future.done():
+                future.set_result(True)
+        except Exception as e:
+            logger.error(f"Erro ao gravar outbox do webhook ({len(ops)} operações): {e}", exc_info=True)
+            if not future.done():
+                future.set_exception(e)
+                future.exception()  # Evita aviso de exceção não recuperada
+
+    def _load_pending_sync(self, after_id, limit):
+        return self._conn.execute(
+            "SELECT id, payload, attempts FROM outbox WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        ).fetchall()
+
+    async def load_pending(self, after_id=0, limit=500):
+        """Carrega, em ordem de chegada, até `limit` entradas pendentes com ID maior que `after_id`"""
+        rows = await self._run(self._load_pending_sync, after_id, limit)
+        return [self._entry_from_row(*row) for row in rows]
+
+    def _load_sync(self, ids):
+        placeholders = ",".join("?" * len(ids))
+        return self._conn.execute(
+            f"SELECT id, payload, attempts FROM outbox WHERE status = 'pending' AND id IN ({placeholders}) ORDER BY id",
+            ids
+        ).fetchall()
+
+    async def load(self, ids):
+        """Carrega as entradas pendentes com os IDs informados, em ordem de chegada"""
+        if not ids:
+            return []
+        rows = await self._run(self._load_sync, list(ids))
+        return [self._entry_from_row(*row) for row in rows]
+
+    @staticmethod
+    def _entry_from_row(entry_id, stored, attempts):
+        # O corpo é gravado como está (bytes) e reaproveitado no envio; linhas antigas podem estar em texto
+        body = stored if isinstance(stored, bytes) else stored.encode("utf-8")
+        return OutboxEntry(json.loads(body), body, id=entry_id, attempts=attempts)
+
+    def _counts_sync(self):
+        rows = self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return dict(rows)
+
+    async def counts(self):
+        return await self._run(self._counts_sync)
+
+    async def close(self):
+        """Grava o que estiver pendente e fecha o banco"""
+        if self._flusher_task:
+            self._flusher_task.cancel()
+            await asyncio.gather(self._flusher_task, return_exceptions=True)
+            self._flusher_task = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "pending_ops": len(self._ops),
+            "commits": self.commits,
+            "written": self.written,
+        }
+
+
+
+
+class SpillFile:
+    """Arquivo JSONL append-only com os eventos excedentes de uma lane (usado quando não há outbox)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+        self._offset = 0
+        if os.path.exists(path):
+            # Eventos que ficaram em disco numa execução anterior
+            with open(path, "r", encoding="utf-8") as f:
+                self.pending = sum(1 for line in f if line.strip())
+
+    def append(self, body):
+        with open(self.path, "ab") as f:
+            f.write(body + b"\n")
+        self.pending += 1
+
+    def read(self, limit):
+        """Lê até `limit` eventos, na ordem em que foram gravados"""
+        entries = []
+        if not self.pending or limit <= 0:
+            return entries
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            while len(entries) < limit:
+                line = f.readline()
+                if not line:
+                    break
+                body = line.strip()
+                if body:
+                    entries.append(OutboxEntry(json.loads(body), body))
+            self._offset = f.tell()
+        self.pending -= len(entries)
+        if self.pending <= 0 or len(entries) < limit:
+            # Tudo foi lido: o arquivo pode ser truncado
+            self.pending = 0
+            self._offset = 0
+            open(self.path, "wb").close()
+        return entries
+
+    def prepend(self, bodies):
+        """Grava eventos à frente dos que ainda estão pendentes no arquivo"""
+        pending_lines = []
+        if self.pending and os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                pending_lines = [line for line in f if line.strip()]
+        with open(self.path, "wb") as f:
+            for body in bodies:
+                f.write(body + b"\n")
+            f.writelines(pending_lines)
+        self.pending = len(bodies) + len(pending_lines)
+        self._offset = 0
+
+
+class DeliveryLane:
+    """Fila FIFO de uma lane, drenada por um único worker"""
+
+    def __init__(self, index, maxsize, spill_path=None):
+        self.index = index
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.parked = collections.deque()  # IDs no outbox aguardando espaço nesta lane
+        self.spill = SpillFile(spill_path) if spill_path else None
+        self.delivered = 0
+        self.task = None
+
+    @property
+    def backlog(self):
+        """Eventos desta lane mantidos fora da memória (outbox ou arquivo de spill)"""
+        return len(self.parked) + (self.spill.pending if self.spill else 0)
+
+
+class WebhookQueue:
+    """Fila de entrega do webhook dividida em lanes.
+
+    Cada payload vai para a lane escolhida pelo hash do seu `chat_id`, e cada
+    lane é drenada por um único worker: eventos do mesmo chat chegam ao N8N
+    em ordem (FIFO), enquanto chats diferentes são entregues em paralelo. Cada
+    lane tem capacidade própria, então um grupo muito ativo só enche a sua.
+
+    Args:
+        send_func: Corrotina send_func(payload, body) que entrega um payload (body: JSON já serializado)
+            e retorna o status HTTP (None em falha de rede)
+        lanes: Quantidade de lanes (uma tarefa de entrega por lane)
+        lane_maxsize: Capacidade em memória de cada lane
+        overflow_policy: 'block', 'drop_oldest' ou 'spill'
+        spill_path: Prefixo dos arquivos JSONL de spill por lane, quando não há outbox
+        outbox: WebhookOutbox opcional; com ele, cada payload é gravado antes da entrega
+        max_attempts: Tentativas antes de desistir de um evento (0 = tentar até conseguir)
+        retry_base_delay: Atraso base do backoff exponencial (segundos)
+        retry_max_delay: Atraso máximo entre tentativas (segundos)
+        send_batch_func: Corrotina send_batch_func(body, count) que entrega um lote (body: array JSON já
+            serializado) e retorna (status, delivery_ids com falha)
+        batch_max_events: Máximo de eventos por POST em modo lote (1 desativa o modo lote)
+        batch_max_wait: Tempo máximo de espera para completar um lote (segundos)
+        limiter: AdaptiveConcurrencyLimiter opcional para os envios simultâneos entre todas as lanes
+        breaker: CircuitBreaker opcional; aberto, segura os eventos em disco até o N8N se recuperar
+    """
+
+    def __init__(self, send_func, lanes=4, lane_maxsize=250, overflow_policy=OVERFLOW_SPILL, spill_path=None,
+                 outbox=None, max_attempts=0, retry_base_delay=1.0, retry_max_delay=300.0,
+                 send_batch_func=None, batch_max_events=1, batch_max_wait=0.0, limiter=None, breaker=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Política de overflow inválida: {overflow_policy} (use uma de {', '.join(OVERFLOW_POLICIES)})")
+        if overflow_policy == OVERFLOW_SPILL and not spill_path and not outbox:
+            raise ValueError("A política 'spill' exige um spill_path ou um outbox")
+        if lanes < 1 or lane_maxsize < 1:
+            raise ValueError("lanes e lane_maxsize devem ser maiores que zero")
+
+        self.send_func = send_func
+        self.lane_maxsize = lane_maxsize
+        self.overflow_policy = overflow_policy
+        self.outbox = outbox
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.send_batch_func = send_batch_func
+        self.batch_max_events = batch_max_events if send_batch_func else 1
+        self.batch_max_wait = batch_max_wait
+        self.limiter = limiter
+        self.breaker = breaker
+
+        # Sem outbox, a política 'spill' usa um arquivo JSONL por lane
+        use_spill_files = overflow_policy == OVERFLOW_SPILL and not outbox
+        self._lanes = [
+            DeliveryLane(i, lane_maxsize, f"{spill_path}.{i}.jsonl" if use_spill_files else None)
+            for i in range(lanes)
+        ]
+
+        # Contadores expostos via stats()
+        self.enqueued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.dead = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.batches_sent = 0
+        self.held = 0
+
+        spill_pending = sum(lane.backlog for lane in self._lanes)
+        if spill_pending:
+            logger.info(f"{spill_pending} eventos pendentes encontrados nos arquivos de spill do webhook")
+
+    @property
+    def running(self):
+        return any(lane.task and not lane.task.done() for lane in self._lanes)
+
+    def lane_for(self, payload):
+        """Lane responsável pelo chat do payload (hash estável entre execuções)"""
+        chat_id = str(payload.get("chat_id", ""))
+        return self._lanes[zlib.crc32(chat_id.encode("utf-8")) % len(self._lanes)]
+
+    async def start(self):
+        """Reenvia o que ficou no outbox e inicia um worker por lane no loop atual"""
+        if self.running:
+            return
+        if self.outbox:
+            await self.outbox.open()
+            await self._replay_outbox()
+        for lane in self._lanes:
+            lane.task = asyncio.create_task(self._worker(lane), name=f"webhook-lane-{lane.index}")
+        batch_info = f"lotes de até {self.batch_max_events} eventos/{self.batch_max_wait * 1000:.0f}ms" if self.batch_max_events > 1 else "sem lotes"
+        logger.info(f"Fila do webhook iniciada ({len(self._lanes)} lanes de {self.lane_maxsize} eventos, overflow '{self.overflow_policy}', outbox {'ativo' if self.outbox else 'desativado'}, {batch_info})")
+
+    async def _replay_outbox(self):
+        """Redistribui nas lanes os eventos que ficaram pendentes no outbox numa execução anterior"""
+        after_id = 0
+        total = 0
+        while True:
+            entries = await self.outbox.load_pending(after_id)
+            if not entries:
+                break
+            for entry in entries:
+                self._queue_or_park(self.lane_for(entry.payload), entry)
+            after_id = entries[-1].id
+            total += len(entries)
+        if total:
+            self.replayed += total
+            logger.info(f"{total} eventos pendentes do outbox redistribuídos nas lanes do webhook")
+
+    async def put(self, payload, body=None):
+        """Enfileira um payload na lane do seu chat, aplicando a política de overflow"""
+        self.enqueued += 1
+        # Serialização única: o mesmo corpo vai para o outbox, para os logs e para o POST
+        if body is None:
+            body = encode_json(payload)
+        entry = self.outbox.add(payload, body) if self.outbox else OutboxEntry(payload, body)
+        lane = self.lane_for(payload)
+
+        if lane.backlog:
+            # Já há eventos deste chat fora da memória: o novo vai atrás deles para manter a ordem
+            self._park(lane, entry)
+            return
+
+        if self.breaker and self.breaker.is_open and not lane.queue.empty() and (entry.id is not None or lane.spill):
+            # N8N indisponível: o evento aguarda em disco em vez de ocupar a lane. Com a lane vazia
+            # o worker pode estar parado em queue.get() e não veria o disco, então o evento entra
+            # na fila e o worker fica esperando o circuito fechar com ele em mãos
+            self.held += 1
+            self._park(lane, entry)
+            return
+
+        if self.overflow_policy == OVERFLOW_BLOCK:
+            await lane.queue.put(entry)
+            return
+
+        if self.overflow_policy == OVERFLOW_SPILL:
+            self._queue_or_park(lane, entry)
+            return
+
+        # OVERFLOW_DROP_OLDEST
+        if lane.queue.full():
+            try:
+                dropped = lane.queue.get_nowait()
+                lane.queue.task_done()
+                if self.outbox and dropped.id is not None:
+                    self.outbox.mark_dead(dropped.id, dropped.attempts, "descartado: lane cheia")
+                self.dropped += 1
+                logger.warning(f"Lane {lane.index} do webhook cheia ({self.lane_maxsize}). Evento mais antigo descartado.")
+            except asyncio.QueueEmpty:
+                pass
+        lane.queue.put_nowait(entry)
+
+    def _queue_or_park(self, lane, entry):
+        if lane.backlog or lane.queue.full():
+            self._park(lane, entry)
+        else:
+            lane.queue.put_nowait(entry)
+
+    def _park(self, lane, entry):
+        """Mantém o evento fora da memória até haver espaço na lane"""
+        self.spilled += 1
+        if self.outbox and entry.id is not None:
+            # A entrada já está no outbox; basta lembrar o ID
+            lane.parked.append(entry.id)
+        else:
+            lane.spill.append(entry.body)
+
+    async def _refill(self, lane):
+        """Traz de volta para a lane, em ordem, os eventos mantidos fora da memória"""
+        free = lane.queue.maxsize - lane.queue.qsize()
+        if free <= 0:
+            return
+        if lane.parked:
+            # Os IDs só saem de `parked` depois de carregados: durante os awaits o backlog continua
+            # visível e put() estaciona os eventos novos do chat atrás deles, sem furar a fila
+            ids = list(itertools.islice(lane.parked, free))
+            await self.outbox.flush()
+            entries = await self.outbox.load(ids)
+            for _ in ids:
+                lane.parked.popleft()
+            for i, entry in enumerate(entries):
+                if lane.queue.full():
+                    lane.parked.extendleft(reversed([e.id for e in entries[i:]]))
+                    break
+                lane.queue.put_nowait(entry)
+        elif lane.spill and lane.spill.pending:
+            for entry in lane.spill.read(free):
+                lane.queue.put_nowait(entry)
+
+    async def _worker(self, lane):
+        while True:
+            if lane.backlog:
+                try:
+                    await self._refill(lane)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"[Webhook lane {lane.index}] Erro ao recarregar eventos do disco: {e}", exc_info=True)
+                    if lane.queue.empty():
+                        await asyncio.sleep(1)
+                        continue
+
+            entries = await self._next_batch(lane.queue)
+            try:
+                lane.delivered += await self._deliver(entries)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += len(entries)
+                logger.error(f"[Webhook lane {lane.index}] Erro inesperado na entrega: {e}", exc_info=True)
+            finally:
+                for _ in entries:
+                    lane.queue.task_done()
+
+    async def _next_batch(self, queue):
+        """Retira da fila o próximo evento e, em modo lote, os que chegarem dentro da janela"""
+        entries = [await queue.get()]
+        if self.batch_max_events <= 1:
+            return entries
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_max_wait
+        while len(entries) < self.batch_max_events:
+            try:
+                entries.append(queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                entries.append(await asyncio.wait_for(queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return entries
+
+    async def _send(self, entries):
+        """Faz um POST com as entradas (um payload ou um lote). Retorna (status, delivery_ids com falha)"""
+        epoch = None
+        if self.breaker:
+            await self.breaker.wait_until_allowed()
+            epoch = self.breaker.epoch
+        if self.limiter:
+            await self.limiter.acquire()
+        started = time.monotonic()
+        try:
+            if self.batch_max_events <= 1:
+                status, failed_ids = await self.send_func(entries[0].payload, entries[0].body), set()
+            else:
+                self.batches_sent += 1
+                status, failed_ids = await self.send_batch_func(encode_batch(entries), len(entries))
+        except asyncio.CancelledError:
+            if self.breaker:
+                self.breaker.cancel_probe()
+            raise
+        except Exception:
+            # Erro de transporte (timeout, conexão recusada) conta como sobrecarga para o AIMD
+            if self.limiter:
+                self.limiter.on_overload()
+            if self.breaker:
+                self.breaker.record_failure(epoch)
+            raise
+        finally:
+            if self.limiter:
+                self.limiter.release()
+        self._record_outcome(status, time.monotonic() - started, epoch)
+        return status, set(failed_ids or ())
+
+    def _record_outcome(self, status, latency, epoch=None):
+        """Alimenta o limitador AIMD e o circuit breaker com o resultado de um envio"""
+        overloaded = is_retryable_status(status)
+        if self.limiter:
+            if is_success_status(status):
+                self.limiter.on_success(latency)
+            elif overloaded:
+                self.limiter.on_overload()
+        if self.breaker:
+            # Um 4xx definitivo ainda indica que o N8N está respondendo
+            if overloaded:
+                self.breaker.record_failure(epoch)
+            else:
+                self.breaker.record_success()
+
+    def _give_up(self, entries, error):
+        self.dead += len(entries)
+        if self.outbox:
+            for entry in entries:
+                if entry.id is not None:
+                    self.outbox.mark_dead(entry.id, entry.attempts, error)
+
+    async def _deliver(self, entries):
+        """Entrega as entradas, repetindo no lugar (sem furar a fila do chat) as que falharem temporariamente.
+
+        Returns:
+            Quantidade de entradas entregues
+        """
+        for entry in entries:
+            if entry.persisted is not None:
+                # Garante que o payload está no outbox antes de chegar ao N8N
+                try:
+                    await entry.persisted
+                except Exception as e:
+                    logger.warning(f"Evento {entry.id} não foi gravado no outbox ({e}). Entregando mesmo assim.")
+                entry.persisted = None
+
+        delivered = 0
+        pending = entries
+        while pending:
+            for entry in pending:
+                entry.attempts += 1
+            status, failed_ids = await self._send(pending)
+
+            if is_success_status(status):
+                # Em modo lote o N8N pode rejeitar só parte dos itens
+                for entry in pending:
+                    if entry.delivery_id not in failed_ids:
+                        delivered += 1
+                        self.delivered += 1
+                        if self.outbox and entry.id is not None:
+                            self.outbox.mark_done(entry.id)
+                pending = [entry for entry in pending if entry.delivery_id in failed_ids]
+                if not pending:
+                    return delivered
+                error = f"falha parcial no lote (HTTP {status})"
+            elif not is_retryable_status(status):
+                error = f"HTTP {status}"
+                self.failed += len(pending)
+                logger.error(f"Webhook rejeitou {len(pending)} evento(s) ({error}). Não serão reenviados.")
+                self._give_up(pending, error)
+                return delivered
+            else:
+                error = f"HTTP {status}" if status is not None else "falha de rede/timeout"
+
+            self.failed += len(pending)
+            if self.outbox:
+                for entry in pending:
+                    if entry.id is not None:
+                        self.outbox.mark_attempt(entry.id, entry.attempts, error)
+
+            if self.max_attempts:
+                exhausted = [entry for entry in pending if entry.attempts >= self.max_attempts]
+                if exhausted:
+                    logger.error(f"{len(exhausted)} evento(s) desistidos após {self.max_attempts} tentativas ({error}).")
+                    self._give_up(exhausted, error)
+                    pending = [entry for entry in pending if entry.attempts < self.max_attempts]
+                    if not pending:
+                        return delivered
+
+            attempts = max(entry.attempts for entry in pending)
+            delay = backoff_delay(attempts, self.retry_base_delay, self.retry_max_delay)
+            self.retried += len(pending)
+            logger.warning(f"Falha ao entregar {len(pending)} evento(s) ({error}). Tentativa {attempts}, nova tentativa em {delay:.1f}s.")
+            await asyncio.sleep(delay)
+        return delivered
+
+    async def stop(self, drain_timeout=5.0):
+        """Aguarda as lanes esvaziarem (até drain_timeout) e encerra os workers"""
+        if self.running and any(not lane.queue.empty() for lane in self._lanes):
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(lane.queue.join() for lane in self._lanes)),
+                    timeout=drain_timeout
+                )
+            except asyncio.TimeoutError:
+                remaining = sum(lane.queue.qsize() for lane in self._lanes)
+                logger.warning(f"Timeout ao drenar a fila do webhook ({remaining} eventos restantes)")
+
+        tasks = [lane.task for lane in self._lanes if lane.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Eventos ainda em memória são preservados em disco quando possível
+        remaining = 0
+        for lane in self._lanes:
+            lane.task = None
+            entries = []
+            while not lane.queue.empty():
+                entries.append(lane.queue.get_nowait())
+                lane.queue.task_done()
+            remaining += len(entries)
+            if entries and not self.outbox:
+                if lane.spill:
+                    lane.spill.prepend([entry.body for entry in entries])
+                else:
+                    self.dropped += len(entries)
+            # IDs estacionados continuam pendentes no outbox e voltam no próximo start()
+            lane.parked.clear()
+
+        if self.outbox:
+            await self.outbox.close()
+            if remaining:
+                logger.info(f"{remaining} eventos da fila do webhook continuam no outbox para a próxima execução")
+        elif remaining:
+            if self.overflow_policy == OVERFLOW_SPILL:
+                logger.info(f"{remaining} eventos da fila do webhook gravados nos arquivos de spill")
+            else:
+                logger.warning(f"{remaining} eventos da fila do webhook descartados no encerramento")
+
+    def stats(self):
+        """Contadores da fila para monitoramento"""
+        stats = {
+            "lanes": len(self._lanes),
+            "lane_maxsize": self.lane_maxsize,
+            "depth": sum(lane.queue.qsize() for lane in self._lanes),
+            "backlog": sum(lane.backlog for lane in self._lanes),
+            "lane_depths": [lane.queue.qsize() for lane in self._lanes],
+            "lane_backlogs": [lane.backlog for lane in self._lanes],
+            "lane_delivered": [lane.delivered for lane in self._lanes],
+            "overflow_policy": self.overflow_policy,
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dead": self.dead,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "batch_max_events": self.batch_max_events,
+            "batches_sent": self.batches_sent,
+            "held": self.held,
+        }
+        if self.limiter:
+            stats["concurrency"] = self.limiter.stats()
+        if self.breaker:
+            stats["circuit_breaker"] = self.breaker.stats()
+        if self.outbox:
+            stats["outbox"] = self.outbox.stats()
+        return stats
+
+
+class DeliveryDeduplicator:
+    """Janela de deduplicação dos eventos já enfileirados, por chave de idempotência.
+
+    Mantém as chaves num OrderedDict em ordem de chegada: a consulta é O(1) e
+    a janela é limitada tanto pelo tamanho (`max_size`) quanto pelo tempo
+    (`ttl`), descartando sempre as chaves mais antigas. Com `path`, as chaves
+    também vão para um SQLite (gravação em lote, fora do loop) e são
+    recarregadas na inicialização, para que os updates que o Telethon reentrega
+    depois de um reinício também sejam reconhecidos.
+    """
+
+    def __init__(self, max_size=10000, ttl=86400.0, path=None, flush_interval=1.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._seen = collections.OrderedDict()  # chave -> instante em que foi vista
+        self._pending = []  # (chave, instante) a gravar, ou (chave, None) a apagar, em ordem
+        self._executor = None
+        self._conn = None
+        self._flusher_task = None
+
+        self.hits = 0
+        self.misses = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open_sync(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_at ON seen (seen_at)")
+        conn.execute("DELETE FROM seen WHERE seen_at < ?", (time.time() - self.ttl,))
+        conn.commit()
+        self._conn = conn
+        rows = conn.execute("SELECT key, seen_at FROM seen ORDER BY seen_at DESC LIMIT ?", (self.max_size,)).fetchall()
+        return rows[::-1]
+
+    def _write_sync(self, rows):
+        with self._conn:
+            for key, seen_at in rows:
+                if seen_at is None:
+                    self._conn.execute("DELETE FROM seen WHERE key = ?", (key,))
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO seen (key, seen_at) VALUES (?, ?)", (key, seen_at))
+            self._conn.execute("DELETE FROM seen WHERE seen_at < ?", (time.time() - self.ttl,))
+            # Mantém no disco só as `max_size` chaves mais recentes, como na memória
+            self._conn.execute(
+                "DELETE FROM seen WHERE seen_at < (SELECT seen_at FROM seen ORDER BY seen_at DESC LIMIT 1 OFFSET ?)",
+                (self.max_size - 1,)
+            )
+
+    async def open(self):
+        """Carrega as chaves persistidas ainda dentro da janela e inicia a gravação periódica"""
+        if not self.path or self._flusher_task:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook-dedup")
+        for key, seen_at in await self._run(self._open_sync):
+            self._seen[key] = seen_at
+        self._evict(time.time())
+        self._flusher_task = asyncio.create_task(self._flusher(), name="webhook-dedup-flusher")
+        logger.info(f"Deduplicação do webhook: {len(self._seen)} chaves carregadas de {self.path}")
+
+    def _evict(self, now):
+        seen = self._seen
+        while seen and (len(seen) > self.max_size or next(iter(seen.values())) < now - self.ttl):
+            seen.popitem(last=False)
+
+    def check_and_add(self, key):
+        """Registra a chave; devolve True se ela já foi vista dentro da janela (evento duplicado)"""
+        now = time.time()
+        if key in self._seen and self._seen[key] >= now - self.ttl:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self._seen.pop(key, None)
+        self._seen[key] = now
+        self._evict(now)
+        if self.path:
+            self._pending.append((key, now))
+        return False
+
+    def discard(self, key):
+        """Esquece a chave (ex.: o evento não chegou a ser enfileirado), também no disco"""
+        self._seen.pop(key, None)
+        if self.path:
+            # A chave pode estar aguardando gravação ou já gravada: nos dois casos não pode voltar no reinício
+            self._pending = [row for row in self._pending if row[0] != key]
+            self._pending.append((key, None))
+
+    async def flush(self):
+        if not self._pending or self._conn is None:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await self._run(self._write_sync, rows)
+        except Exception as e:
+            logger.error(f"Erro ao gravar chaves de deduplicação do webhook: {e}", exc_info=True)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        """Grava as chaves pendentes e fecha o banco"""
+        if self._flusher_task:
+            self._flusher_task.cancel()
+            await asyncio.gather(self._flusher_task, return_exceptions=True)
+            self._flusher_task = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "size": len(self._seen),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "duplicates": self.hits,
+            "unique": self.misses,
+            "persistent": bool(self.path),
+        }
+
+
+class WebhookEndpoint:
+    """Destino de webhook com pool de conexões, timeouts, política de retry e fila de entrega próprios.
+
+    Args:
+        name: Nome do endpoint usado nas regras de roteamento
+        url: URL do webhook
+        pool_size: Conexões keep-alive simultâneas com o endpoint
+        timeout: Timeout total de cada requisição (segundos)
+        connect_timeout: Timeout para abrir a conexão (segundos)
+        gzip_min_bytes: Corpos a partir deste tamanho vão com Content-Encoding gzip (0 desativa)
+        gzip_level: Nível de compressão gzip
+        headers: Cabeçalhos extras enviados em toda requisição (ex.: autenticação)
+        **queue_options: Argumentos repassados para a WebhookQueue do endpoint
+    """
+
+    def __init__(self, name, url, pool_size=10, timeout=15.0, connect_timeout=5.0,
+                 gzip_min_bytes=0, gzip_level=5, headers=None, **queue_options):
+        self.name = name
+        self.url = url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.gzip_min_bytes = gzip_min_bytes
+        self.gzip_level = gzip_level
+        self.headers = dict(headers or {})
+        self._http_session = None
+        self.queue = WebhookQueue(self.send, send_batch_func=self.send_batch, **queue_options)
+
+    def _get_http_session(self):
+        """Retorna a sessão HTTP do endpoint, criando-a (com pool keep-alive) se necessário"""
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+            timeout = aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout)
+            self._http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            logger.info(f"[{self.name}] Sessão HTTP do webhook criada (pool: {self.pool_size}, timeout: {self.timeout}s)")
+        return self._http_session
+
+    def _post(self, body):
+        """Prepara o POST do corpo JSON já serializado, comprimindo com gzip acima do limite configurado"""
+        headers = {"Content-Type": "application/json", **self.headers}
+        if self.gzip_min_bytes and len(body) >= self.gzip_min_bytes:
+            body = gzip.compress(body, compresslevel=self.gzip_level)
+            headers["Content-Encoding"] = "gzip"
+        return self._get_http_session().post(self.url, data=body, headers=headers)
+
+    async def send(self, payload, body=None):
+        """Envia um evento para o webhook.
+
+        Args:
+            payload: Dicionário do evento
+            body: O mesmo payload já serializado em JSON (bytes), para não serializar de novo
+
+        Returns:
+            O status HTTP da resposta, ou None em caso de falha de rede/timeout
+        """
+        try:
+            if body is None:
+                body = encode_json(payload)
+            logger.info(f"[{self.name}] Enviando mensagem para webhook: {body.decode('utf-8')}")
+            async with self._post(body) as response:
+                response_text = await response.text()
+                if 200 <= response.status < 300:
+                    logger.info(f"[{self.name}] Webhook enviado com sucesso: {response_text}")
+                else:
+                    logger.error(f"[{self.name}] Erro ao enviar webhook: {response.status} - {response_text}")
+                return response.status
+        except asyncio.TimeoutError:
+            logger.error(f"[{self.name}] Timeout ao enviar para webhook ({self.timeout}s)")
+        except Exception as e:
+            logger.error(f"[{self.name}] Erro ao enviar para webhook: {e}")
+        return None
+
+    async def send_batch(self, body, count):
+        """Envia um lote de eventos para o webhook como um único array JSON.
+
+        Cada item carrega um `delivery_id`; o N8N pode responder com
+        {"failed": [delivery_id, ...]} para pedir o reenvio só desses itens.
+
+        Args:
+            body: Array JSON do lote já serializado (bytes)
+            count: Quantidade de eventos no lote
+
+        Returns:
+            Tupla (status HTTP ou None em falha de rede/timeout, delivery_ids que falharam)
+        """
+        try:
+            logger.info(f"[{self.name}] Enviando lote de {count} eventos para webhook ({len(body)} bytes)")
+            async with self._post(body) as response:
+                response_text = await response.text()
+                if 200 <= response.status < 300:
+                    failed_ids = parse_batch_failures(response_text)
+                    logger.info(f"[{self.name}] Lote enviado ao webhook: {count - len(failed_ids)} aceitos, {len(failed_ids)} com falha")
+                    return response.status, failed_ids
+                logger.error(f"[{self.name}] Erro ao enviar lote ao webhook: {response.status} - {response_text}")
+                return response.status, set()
+        except asyncio.TimeoutError:
+            logger.error(f"[{self.name}] Timeout ao enviar lote para webhook ({self.timeout}s)")
+        except Exception as e:
+            logger.error(f"[{self.name}] Erro ao enviar lote para webhook: {e}")
+        return None, set()
+
+    async def start(self):
+        await self.queue.start()
+
+    async def close(self):
+        """Drena a fila do endpoint e fecha a sessão HTTP e as conexões do pool"""
+        await self.queue.stop()
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+            logger.info(f"[{self.name}] Sessão HTTP do webhook fechada.")
+        self._http_session = None
+
+    def stats(self):
+        return dict(self.queue.stats(), url=self.url)
+
+
+_ANY = object()  # Curinga nas chaves do índice de roteamento
+
+
+def _rule_values(value):
+    """Normaliza um critério de regra em lista de chaves (ausente = curinga)"""
+    if value is None:
+        return [_ANY]
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+class WebhookRouter:
+    """Distribui cada payload para os endpoints cujas regras casam com ele.
+
+    Cada regra pode filtrar por `event_type`, `direction` (valor único ou
+    lista), `is_private` e `chat_ids`; critérios ausentes valem para qualquer
+    valor. As regras são pré-compiladas num dicionário indexado pela
+    combinação (event_type, direction, is_private, chat_id), com curingas
+    expandidos, então rotear custa no máximo 16 consultas ao dicionário,
+    não importa quantas regras existam.
+
+    Args:
+        endpoints: Dicionário nome -> WebhookEndpoint
+        rules: Lista de regras, cada uma com a chave "endpoints" (nome ou lista de nomes)
+        fallback: Endpoints usados quando nenhuma regra casa
+    """
+
+    def __init__(self, endpoints, rules=None, fallback=("default",)):
+        self.endpoints = dict(endpoints)
+        self.rules_count = len(rules or [])
+        self._order = {name: i for i, name in enumerate(self.endpoints)}
+
+        index = {}
+        for rule in rules or []:
+            targets = set(_rule_values(rule.get("endpoints")))
+            unknown = targets - set(self.endpoints)
+            if _ANY in targets or unknown:
+                raise ValueError(f"Regra de roteamento com endpoints inválidos: {rule}")
+            privacy = [_ANY] if rule.get("is_private") is None else [bool(rule["is_private"])]
+            chats = [str(chat_id) for chat_id in rule["chat_ids"]] if rule.get("chat_ids") else [_ANY]
+            for key in itertools.product(_rule_values(rule.get("event_type")), _rule_values(rule.get("direction")), privacy, chats):
+                index.setdefault(key, set()).update(targets)
+        self._index = {key: frozenset(names) for key, names in index.items()}
+
+        unknown = set(fallback) - set(self.endpoints)
+        if unknown:
+            raise ValueError(f"Endpoints de fallback desconhecidos: {', '.join(sorted(unknown))}")
+        self._fallback = tuple(self.endpoints[name] for name in fallback)
+
+        self.routed = 0
+        self.unrouted = 0
+
+    def route(self, payload):
+        """Endpoints que devem receber o payload"""
+        is_private = payload.get("is_private")
+        chat_id = payload.get("chat_id")
+        keys = itertools.product(
+            (payload.get("event_type"), _ANY),
+            (payload.get("direction"), _ANY),
+            (bool(is_private) if is_private is not None else None, _ANY),
+            (str(chat_id) if chat_id is not None else None, _ANY),
+        )
+        matched = set()
+        for key in keys:
+            names = self._index.get(key)
+            if names:
+                matched |= names
+        if not matched:
+            return self._fallback
+        return [self.endpoints[name] for name in sorted(matched, key=self._order.__getitem__)]
+
+    async def put(self, payload):
+        """Serializa o payload uma única vez e o enfileira em cada endpoint de destino"""
+        endpoints = self.route(payload)
+        if not endpoints:
+            self.unrouted += 1
+            return
+        self.routed += 1
+        body = encode_json(payload)
+        for endpoint in endpoints:
+            await endpoint.queue.put(payload, body)
+
+    async def start(self):
+        for endpoint in self.endpoints.values():
+            await endpoint.start()
+
+    async def close(self):
+        for endpoint in self.endpoints.values():
+            try:
+                await endpoint.close()
+            except Exception as e:
+                logger.error(f"[{endpoint.name}] Erro ao encerrar endpoint do webhook: {e}", exc_info=True)
+
+    def stats(self):
+        return {
+            "rules": self.rules_count,
+            "routed": self.routed,
+            "unrouted": self.unrouted,
+            "endpoints": {name: endpoint.stats() for name, endpoint in self.endpoints.items()},
+        }
+
+
+def load_webhook_routes(value):
+    """Carrega a configuração de roteamento a partir de JSON inline ou do caminho de um arquivo JSON.
+
+    Formato:
+        {
+          "endpoints": {"crm": {"url": "https://...", "timeout": 10, "max_attempts": 3}},
+          "rules": [{"endpoints": ["crm"], "event_type": "new_message", "is_private": true}],
+          "fallback": ["default"]
+        }
+    """
+    if not value:
+        return {}
+    value = value.strip()
+    if value.startswith("{"):
+        return json.loads(value)
+    with open(value, "r", encoding="utf-8") as f:
+        return json.load(f)